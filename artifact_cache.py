@@ -0,0 +1,129 @@
+"""Size-bounded LRU cache for rendered artifacts (e.g. folium map HTML), keyed by a canonical hash of the view configuration.
+
+One instance is shared by all Streamlit sessions of a server process (see get_map_cache in streamlit_main.py).
+"""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from datetime import date, time
+
+# Benannte Caches des Prozesses, z.B. für Statistiken im Lasttest (load_test.py)
+_registry = {}
+
+
+def _canonical(value):
+    """Converts values of a view configuration into JSON-serializable, order independent values."""
+    if isinstance(value, dict):
+        return {str(key): _canonical(value[key]) for key in sorted(value, key=str)}
+    if isinstance(value, (set, frozenset)):
+        return sorted(_canonical(item) for item in value)
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # numpy-Skalare
+        return value.item()
+    return value
+
+
+def config_key(**config) -> str:
+    """Creates a canonical hash for a view configuration. Key order does not matter, dates and times are
+    serialized as ISO strings.
+
+    Args:
+        **config: selection and layer configuration, e.g. view="months", years=[2022], show_heatmap=True
+
+    Returns:
+        str: hex digest identifying the configuration
+    """
+    serialized = json.dumps(_canonical(config), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+class ArtifactCache:
+    """Thread-safe LRU cache for strings or bytes, bounded by the total size of the stored values.
+
+    Args:
+        max_bytes (int, optional): maximum total size of all values. Defaults to 256 MB.
+        max_entries (int, optional): maximum number of entries. Defaults to 512.
+        name (str, optional): registers the cache under this name (see registered_caches)
+    """
+
+    def __init__(self, max_bytes:int=256 * 1024 ** 2, max_entries:int=512, name:str=None):
+        if name is not None:
+            _registry[name] = self
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(value) -> int:
+        return len(value.encode()) if isinstance(value, str) else len(value)
+
+    def __contains__(self, key:str) -> bool:
+        """Checks whether a key is cached, without counting a hit/miss or changing the LRU order."""
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key:str):
+        """Returns the cached value and marks it as recently used, or None if the key is not cached."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key:str, value) -> None:
+        """Stores a value and evicts the least recently used entries until the size bounds hold.
+        Values larger than max_bytes are not cached."""
+        size = self._size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self._size(self._entries.pop(key))
+            self._entries[key] = value
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes or len(self._entries) > self.max_entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size_bytes -= self._size(evicted)
+                self.evictions += 1
+
+    def get_or_build(self, key:str, build):
+        """Returns the cached value for key or calls build(), caches and returns its result."""
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.put(key, value)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self) -> dict:
+        """Returns hit/miss counters, hit rate, number of entries and total size."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self.size_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+            }
+
+
+def registered_caches() -> dict:
+    """Returns the named caches of the process, {name: ArtifactCache}."""
+    return dict(_registry)
@@ -0,0 +1,230 @@
+"""Headless batch report of the month statistics for all periods, city districts and stations.
+
+Computes the key figures of the month view (rides, median duration, most frequent start/end district,
+station rentals/returns in and outside the city area) for every year x month at once: each trip is
+assigned to its start month and, if different, also to its end month (same selection as the month view),
+then all groups are aggregated with grouped pandas operations. Unlike the month view, which matches
+year and month separately, a trip only counts for the months it actually starts or ends in (differs for
+trips across a year boundary). Levels of the report:
+    month:    one row per year x month
+    district: one row per year x month x start district
+    station:  one row per year x month x rental station (returns counted at the return station)
+
+Optionally a static map per month (districts coloured by rides, stations sized by rentals + returns)
+is rendered, in parallel worker processes.
+
+use: python batch_report.py [--start-year 2022] [--end-year 2023] [--out reports] [--maps] [--workers 4]
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import duration_stats as dstat
+import ingestion as ing
+
+REPORT_DIR = "reports"
+REPORT_COLUMNS = ["LEVEL", "YEAR", "MONTH", "KEY", "RIDES", "MEDIAN_DURATION_SECONDS", "TOP_START_DISTRICT",
+                  "TOP_END_DISTRICT", "STATION_RENTALS_CITY", "STATION_RENTALS_NOT_CITY",
+                  "STATION_RETURNS_CITY", "STATION_RETURNS_NOT_CITY"]
+
+
+def month_rows(df:pd.DataFrame) -> pd.DataFrame:
+    """Assigns every trip to its start month and additionally to its end month if that differs
+    (like the month view: trips that start or end in the month).
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with the calendar columns (see dp.add_calendar_features)
+
+    Returns:
+        pd.DataFrame: one row per trip and month, with YEAR, MONTH and the columns needed for the statistics
+    """
+    columns = ["CITY_DISTRICT_START", "CITY_DISTRICT_END", "RENTAL_STATION_NAME", "RETURN_STATION_NAME",
+               "RENTAL_IS_STATION", "RETURN_IS_STATION", "RENTAL_IS_CITY", "RETURN_IS_CITY"]
+    trips = df[columns].assign(DURATION_SECONDS=dstat.duration_seconds(df))
+    # Kennzeichen als Integer (0/1), damit die Summen der Masken direkt die Anzahlen ergeben
+    trips = trips.assign(
+        STATION_RENTALS_CITY=((trips["RENTAL_IS_STATION"] == 1) & (trips["RENTAL_IS_CITY"] == 1)).astype("int32"),
+        STATION_RENTALS_NOT_CITY=((trips["RENTAL_IS_STATION"] == 1) & (trips["RENTAL_IS_CITY"] == 0)).astype("int32"),
+        STATION_RETURNS_CITY=((trips["RETURN_IS_STATION"] == 1) & (trips["RETURN_IS_CITY"] == 1)).astype("int32"),
+        STATION_RETURNS_NOT_CITY=((trips["RETURN_IS_STATION"] == 1) & (trips["RETURN_IS_CITY"] == 0)).astype("int32"),
+    )
+    crosses_month = (df["START_YEAR"] != df["END_YEAR"]) | (df["START_MONTH"] != df["END_MONTH"])
+    return pd.concat([
+        trips.assign(YEAR=df["START_YEAR"], MONTH=df["START_MONTH"]),
+        trips[crosses_month].assign(YEAR=df.loc[crosses_month, "END_YEAR"], MONTH=df.loc[crosses_month, "END_MONTH"]),
+    ], ignore_index=True)
+
+
+def _top(rows:pd.DataFrame, keys:list, column:str) -> pd.Series:
+    """Most frequent value of column per group (ties: first value in sort order, like Series.mode()[0])."""
+    if column in keys:
+        return rows.groupby(keys, observed=True)[column].first()
+    counts = rows.groupby(keys + [column], observed=True).size().rename("COUNT").reset_index()
+    counts = counts.sort_values(keys + ["COUNT", column], ascending=[True] * len(keys) + [False, True])
+    return counts.drop_duplicates(keys).set_index(keys)[column]
+
+
+def summarize(rows:pd.DataFrame, keys:list) -> pd.DataFrame:
+    """Key figures per group of the month rows.
+
+    Args:
+        rows (pd.DataFrame): result of month_rows (or a subset)
+        keys (list): group columns, e.g. ["YEAR", "MONTH"]
+
+    Returns:
+        pd.DataFrame: one row per group
+    """
+    grouped = rows.groupby(keys, observed=True)
+    summary = grouped.agg(
+        RIDES=("DURATION_SECONDS", "size"),
+        MEDIAN_DURATION_SECONDS=("DURATION_SECONDS", "median"),
+        STATION_RENTALS_CITY=("STATION_RENTALS_CITY", "sum"),
+        STATION_RENTALS_NOT_CITY=("STATION_RENTALS_NOT_CITY", "sum"),
+        STATION_RETURNS_CITY=("STATION_RETURNS_CITY", "sum"),
+        STATION_RETURNS_NOT_CITY=("STATION_RETURNS_NOT_CITY", "sum"),
+    )
+    summary["TOP_START_DISTRICT"] = _top(rows, keys, "CITY_DISTRICT_START")
+    summary["TOP_END_DISTRICT"] = _top(rows, keys, "CITY_DISTRICT_END")
+    return summary.reset_index()
+
+
+def build_report(df:pd.DataFrame) -> pd.DataFrame:
+    """Computes the report table for all months, districts and stations.
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame
+
+    Returns:
+        pd.DataFrame: columns REPORT_COLUMNS, sorted by level, year, month and rides
+    """
+    rows = month_rows(df)
+    period = ["YEAR", "MONTH"]
+
+    months = summarize(rows, period).assign(LEVEL="month", KEY="")
+    districts = summarize(rows, period + ["CITY_DISTRICT_START"]).rename(columns={"CITY_DISTRICT_START": "KEY"}).assign(LEVEL="district")
+
+    # Stationen: Ausleihen an der Ausleihstation, Rückgaben an der Rückgabestation
+    rentals = summarize(rows[rows["RENTAL_IS_STATION"] == 1], period + ["RENTAL_STATION_NAME"]).rename(columns={"RENTAL_STATION_NAME": "KEY"})
+    returns = rows[rows["RETURN_IS_STATION"] == 1].groupby(period + ["RETURN_STATION_NAME"], observed=True)[
+        ["STATION_RETURNS_CITY", "STATION_RETURNS_NOT_CITY"]].sum()
+    returns.index = returns.index.rename(period + ["KEY"])
+    stations = rentals.drop(columns=["STATION_RETURNS_CITY", "STATION_RETURNS_NOT_CITY"]).set_index(period + ["KEY"]).join(
+        returns, how="outer").reset_index().assign(LEVEL="station")
+    stations[["RIDES"] + REPORT_COLUMNS[-4:]] = stations[["RIDES"] + REPORT_COLUMNS[-4:]].fillna(0).astype("int64")
+    stations = stations[stations["KEY"] != ""]
+
+    report = pd.concat([months, districts, stations], ignore_index=True)[REPORT_COLUMNS]
+    level_order = report["LEVEL"].map({"month": 0, "district": 1, "station": 2})
+    return report.assign(_ORDER=level_order).sort_values(["_ORDER", "YEAR", "MONTH", "RIDES"],
+                                                        ascending=[True, True, True, False]).drop(columns="_ORDER").reset_index(drop=True)
+
+
+def render_month_map(year:int, month:int, districts:dict, stations:pd.DataFrame, out_dir:str) -> str:
+    """Renders the static map of one month to PNG (runs in a worker process).
+
+    Args:
+        year (int): year
+        month (int): month
+        districts (dict): {district: rides}
+        stations (pd.DataFrame): STATION_NAME, LAT, LON, TOTAL (rentals + returns)
+        out_dir (str): output directory
+
+    Returns:
+        str: path of the PNG file
+    """
+    import geopandas as gpd
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    city_districts = gpd.read_file("neighbourhoods.geojson")
+    city_districts["RIDES"] = city_districts["neighbourhood"].map(districts).fillna(0)
+
+    fig, ax = plt.subplots(figsize=(8, 8))
+    city_districts.plot(column="RIDES", cmap="Blues", edgecolor="grey", linewidth=0.5, legend=True, ax=ax,
+                        legend_kwds={"label": "Fahrten (Start im Stadtviertel)", "shrink": 0.6})
+    if not stations.empty:
+        sizes = 5 + 200 * stations["TOTAL"] / stations["TOTAL"].max()
+        ax.scatter(stations["LON"], stations["LAT"], s=sizes, color="darkblue", alpha=0.6, label="Stationen")
+        ax.legend(loc="lower right")
+    ax.set_title(f"MVG-Rad {month:02d}/{year}")
+    ax.set_axis_off()
+
+    path = os.path.join(out_dir, f"{year}-{month:02d}.png")
+    fig.savefig(path, dpi=120, bbox_inches="tight")
+    plt.close(fig)
+    return path
+
+
+def render_maps(report:pd.DataFrame, store:str=ing.STORE_DIR, out_dir:str=os.path.join(REPORT_DIR, "maps"),
+                max_workers:int=None) -> list:
+    """Renders the month maps in parallel worker processes.
+
+    Args:
+        report (pd.DataFrame): report table, see build_report
+        store (str, optional): data store with the station registry (coordinates). Defaults to ing.STORE_DIR.
+        out_dir (str, optional): output directory. Defaults to reports/maps.
+        max_workers (int, optional): number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: paths of the rendered maps
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    coordinates = ing.load_aggregate("stations", store)[["STATION_NAME", "LAT", "LON"]] if ing.has_aggregate("stations", store) \
+        else pd.DataFrame(columns=["STATION_NAME", "LAT", "LON"])
+
+    districts = report[report["LEVEL"] == "district"]
+    stations = report[report["LEVEL"] == "station"].merge(coordinates, left_on="KEY", right_on="STATION_NAME")
+    stations = stations.assign(TOTAL=stations["RIDES"] + stations["STATION_RETURNS_CITY"] + stations["STATION_RETURNS_NOT_CITY"])
+
+    # Nur kleine Tabellen je Monat werden an die Prozesse übergeben
+    tasks = []
+    for (year, month), month_districts in districts.groupby(["YEAR", "MONTH"]):
+        month_stations = stations[(stations["YEAR"] == year) & (stations["MONTH"] == month)][["STATION_NAME", "LAT", "LON", "TOTAL"]]
+        tasks.append((int(year), int(month), dict(zip(month_districts["KEY"], month_districts["RIDES"])), month_stations, out_dir))
+
+    paths = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(render_month_map, *task) for task in tasks]
+        for future in as_completed(futures):
+            paths.append(future.result())
+    return sorted(paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monatsstatistiken für alle Zeiträume, Stadtviertel und Stationen.")
+    parser.add_argument("--start-year", type=int, default=None, help="erstes Jahr (Standard: alle Jahre des Datenspeichers bzw. 2020)")
+    parser.add_argument("--end-year", type=int, default=None, help="letztes Jahr (Standard: alle Jahre des Datenspeichers bzw. 2023)")
+    parser.add_argument("--out", default=REPORT_DIR, help="Ausgabeverzeichnis")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv", help="Format der Berichtstabelle")
+    parser.add_argument("--maps", action="store_true", help="statische Karte je Monat erzeugen")
+    parser.add_argument("--workers", type=int, default=None, help="Prozesse für die Karten (Standard: alle Kerne)")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    df = ing.load_cleaned(args.start_year, args.end_year)
+    print(f"{len(df)} Fahrten geladen in {time.perf_counter() - start:.1f} s")
+
+    start = time.perf_counter()
+    report = build_report(df)
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"monthly_report.{args.format}")
+    if args.format == "csv":
+        report.to_csv(path, index=False)
+    else:
+        report.to_parquet(path, index=False)
+    counts = report["LEVEL"].value_counts()
+    print(f"Bericht in {time.perf_counter() - start:.1f} s: {counts.get('month', 0)} Monate, {counts.get('district', 0)} Viertel-Zeilen, "
+          f"{counts.get('station', 0)} Stations-Zeilen, gespeichert in {path}")
+
+    if args.maps:
+        start = time.perf_counter()
+        paths = render_maps(report, out_dir=os.path.join(args.out, "maps"), max_workers=args.workers)
+        print(f"{len(paths)} Karten in {time.perf_counter() - start:.1f} s, gespeichert in {os.path.join(args.out, 'maps')}")
+
+
+if __name__ == "__main__":
+    main()
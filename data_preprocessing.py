@@ -1,9 +1,8 @@
 import numpy as np
 import pandas as pd
-import geopandas as gpd
-from shapely.geometry import shape
-from geopy.distance import geodesic
-import streamlit as st
+
+# geopandas, shapely und geopy werden erst in den Funktionen importiert, die sie benötigen.
+# So bleibt der Import dieses Moduls für die String- und Koordinatenfunktionen schnell.
 
 ## Formatting Functions
 
@@ -228,6 +227,8 @@ def add_city_district(df:pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: modified DataFrame with added CITY_DISTRICT_START and CITY_DISTRICT_END columns
     """
+    import geopandas as gpd
+
     # Einlesen der 
     city_districts = gpd.read_file("neighbourhoods.geojson") # Stadtviertel-geojson, von AirBNB
 
@@ -262,6 +263,9 @@ def add_city_status(df:pd.DataFrame) -> pd.DataFrame:
     Returns:
         pd.DataFrame: modified dataframe with two additional columns for city status
     """
+    import geopandas as gpd
+    from shapely.geometry import shape
+
     city_area = gpd.read_file("city_area.geojson") # city-area-geojson, selbst erstellt auf geojson.io, per Augenmaß anhand der in der MVGO-App ersichtlichen Ränder der city area
 
     # Erstelle zwei Geometrien für Start- und Endpunkte
@@ -305,6 +309,8 @@ def calculate_geodesic(row):
     Returns:
         distance: geodesic distance in kilometres
     """
+    from geopy.distance import geodesic
+
     start_point = (row["STARTLAT"], row["STARTLON"])  # erst Breitengrad, dann Längengrad
     end_point = (row["ENDLAT"], row["ENDLON"])
     
@@ -377,4 +383,161 @@ def get_heatmap_data(df:pd.DataFrame, station_data:dict) -> list:
     heat_data = [[station_data[station][0], station_data[station][1], heat_data_dict[station]] for station in station_data]
     # sortiert nach Anzahl. Für den Fall, dass auf die wichtigsten oder unwichtigsten gefiltert werden soll.
     heat_data_sorted = sorted(heat_data, key=lambda x: x[2], reverse=True)
-    return heat_data_sorted
\ No newline at end of file
+    return heat_data_sorted
+
+## Kalendermerkmale
+
+# Gesetzliche Feiertage in Bayern (inkl. Mariä Himmelfahrt, in München Feiertag), 2019 - 2030
+HOLIDAY_FILE = "bavarian_holidays.csv"
+
+# Spalten je Zeitstempel (Präfix START_ bzw. END_) mit kompaktem Integer-Typ
+CALENDAR_COLUMNS = {
+    "YEAR": "int16",
+    "MONTH": "int8",
+    "DOY": "int16",
+    "WEEKDAY": "int8",
+    "HOUR": "int8",
+    "MINUTE_OF_DAY": "int16",
+    "IS_HOLIDAY": "int8",
+}
+
+
+def load_holidays(path:str=HOLIDAY_FILE) -> np.ndarray:
+    """Reads the bundled Bavarian holiday calendar.
+
+    Args:
+        path (str, optional): csv file with DATE and NAME columns. Defaults to HOLIDAY_FILE.
+
+    Returns:
+        np.ndarray: holiday dates as datetime64[D]
+    """
+    return pd.read_csv(path, parse_dates=["DATE"])["DATE"].to_numpy().astype("datetime64[D]")
+
+
+def add_calendar_features(df:pd.DataFrame, columns:dict=None) -> pd.DataFrame:
+    """Adds compact integer calendar columns for STARTTIME and ENDTIME, computed once so that filters
+    can use vectorized integer comparisons instead of .dt accessors or Python date/time objects.
+    Adds for each prefix: YEAR, MONTH, DOY (day of year), WEEKDAY (0 = Monday), HOUR, MINUTE_OF_DAY, IS_HOLIDAY.
+
+    Args:
+        df (pd.DataFrame): DataFrame with datetime columns
+        columns (dict, optional): {datetime column: prefix}. Defaults to {"STARTTIME": "START_", "ENDTIME": "END_"}.
+
+    Returns:
+        pd.DataFrame: modified DataFrame with added calendar columns
+    """
+    columns = columns or {"STARTTIME": "START_", "ENDTIME": "END_"}
+    holidays = load_holidays()
+
+    for column, prefix in columns.items():
+        timestamps = df[column].dt
+        df[prefix + "YEAR"] = timestamps.year
+        df[prefix + "MONTH"] = timestamps.month
+        df[prefix + "DOY"] = timestamps.dayofyear
+        df[prefix + "WEEKDAY"] = timestamps.weekday
+        df[prefix + "HOUR"] = timestamps.hour
+        df[prefix + "MINUTE_OF_DAY"] = timestamps.hour * 60 + timestamps.minute
+        df[prefix + "IS_HOLIDAY"] = np.isin(df[column].to_numpy().astype("datetime64[D]"), holidays)
+        df = df.astype({prefix + name: dtype for name, dtype in CALENDAR_COLUMNS.items()})
+
+    return df
+
+
+def calendar_dates(year, doy) -> pd.DatetimeIndex:
+    """Converts year and day of year back into dates (e.g. for the few group keys of an aggregation).
+
+    Args:
+        year: years, integer array/Series
+        doy: days of year, integer array/Series
+
+    Returns:
+        pd.DatetimeIndex: dates
+    """
+    years = np.asarray(year, dtype="int64") - 1970
+    return pd.DatetimeIndex(years.astype("datetime64[Y]").astype("datetime64[D]") + np.asarray(doy, dtype="int64") - 1)
+
+
+## Einlesen und Formatieren (gesamte Pipeline, ohne Streamlit nutzbar, z.B. für Batch-Skripte)
+
+def read_file(path:str) -> pd.DataFrame:
+    """Reads one MVG-Rad csv file and removes spaces from the column names.
+
+    Args:
+        path (str): path of the csv file, e.g. "MVG_Rad_Fahrten_2023.csv"
+
+    Returns:
+        pd.DataFrame: Pandas DataFrame
+    """
+    df = pd.read_csv(path, sep=";", decimal=",", parse_dates=["STARTTIME       ", "ENDTIME         "])
+
+    # Entfernen von Leerzeichen in den Columns
+    df.columns = [remove_space(column) for column in df.columns]
+
+    return df
+
+
+def read_files(start_year:int=2020, end_year:int=2023) -> pd.DataFrame:
+    """Reading csv files and concatenating them in a Pandas DataFrame
+
+    Args:
+        start_year (int, optional): year to start with. Defaults to 2020.
+        end_year (int, optional): year to end with. Defaults to 2023.
+
+    Returns:
+        pd.DataFrame: Pandas DataFrame
+    """
+    # Schleife über jedes Jahr, danach alle Daten zu einem einzigen DataFrame kombinieren
+    data_list = [read_file(f"MVG_Rad_Fahrten_{year}.csv") for year in range(start_year, end_year + 1)]
+    return pd.concat(data_list, ignore_index=True)
+
+
+def format_files(df:pd.DataFrame) -> pd.DataFrame:
+    """Formatting and Cleaning Pandas DataFrame. Combines several functions defined and executes them consecutively.
+
+    Args:
+        df (pd.DataFrame): Pandas DataFrame
+
+    Returns:
+        pd.DataFrame: formatted and cleaned DataFrame
+    """
+    # Entfernen von Leerzeichen bei Stationsnamen
+    df["RENTAL_STATION_NAME"] = df["RENTAL_STATION_NAME"].apply(remove_space)
+    df["RETURN_STATION_NAME"] = df["RETURN_STATION_NAME"].apply(remove_space)
+
+    # Löschen von "Row"
+    df = df.drop("Row", axis=1)
+
+    # Formatierung der Koordinaten + Entfernung ungültiger Daten
+    df = handle_coordinates(df)
+
+    # Formatierung von is_station
+    df = handle_is_station(df)
+
+    # Auffüllen fehlender Werte anhand des Vorhandenseins oder Fehlens von "station_name"-Werten
+    df = fill_is_station_values(df)
+
+    # Hinzufügen einer Spalte für die Dauer
+    df["DURATION"] = df["ENDTIME"] - df["STARTTIME"]
+
+    # Entfernen ungültiger Daten
+    df = remove_invalid_datetime(df)
+
+    # Removing data with NULL values
+    df = df.dropna()
+
+    # Hinzufügen der Distanz
+    # dauert lange, uncomment nur, wenn erwünscht und ausreichend Rechenleistung verfügbar!
+    # wird später zur Angabe der mittleren Distanz verwendet
+    # diese Zeilen müssten dann entsprechend auch ent-kommentiert werden: suche nach "Entfernung" und "DISTANCE"
+    # df = calculate_distance(df)
+
+    # Hinzufügen des Stadtviertels
+    df = add_city_district(df)
+
+    # Hinzufügen, ob Punkte in Stadtbereich ("city area")
+    df = add_city_status(df)
+
+    # Kalendermerkmale (Jahr, Monat, Tag im Jahr, Wochentag, Stunde, Minute des Tages, Feiertag) als Integer-Spalten
+    df = add_calendar_features(df)
+
+    return df
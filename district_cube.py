@@ -0,0 +1,111 @@
+"""District x month x hour-of-week cube of trip starts, ends and net flow.
+
+Starts and ends are counted per (start/end district, month, hour of the week) from the integer calendar
+columns (see dp.add_calendar_features). The sparse count table is stored as partial aggregate
+"district_flows" in the data store (see ingestion.py) and merged by adding the counts. For the app it is
+expanded into a dense int32 array with a sorted district index, so a selection of months is one sum over
+an axis and every frame of the choropleth view is a slice of the result, without DataFrame operations.
+
+Trips that start/end outside the city districts of neighbourhoods.geojson are not counted.
+"""
+import numpy as np
+import pandas as pd
+
+HOURS_OF_WEEK = 7 * 24
+WEEKDAYS = ["Mo", "Di", "Mi", "Do", "Fr", "Sa", "So"]
+MEASURES = {"STARTS": "Starts", "ENDS": "Enden", "NET_FLOW": "Nettofluss (Enden - Starts)"}
+KEYS = ["CITY_DISTRICT", "YEAR", "MONTH", "HOUR_OF_WEEK"]
+
+
+def build_flows(df:pd.DataFrame) -> pd.DataFrame:
+    """Builds the sparse flow table: starts and ends per (district, year, month, hour of the week).
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with CITY_DISTRICT_START/END and the calendar columns
+
+    Returns:
+        pd.DataFrame: columns CITY_DISTRICT, YEAR, MONTH, HOUR_OF_WEEK, STARTS, ENDS
+    """
+    counts = []
+    for prefix, district, measure in [("START_", "CITY_DISTRICT_START", "STARTS"), ("END_", "CITY_DISTRICT_END", "ENDS")]:
+        keys = pd.DataFrame({
+            "CITY_DISTRICT": df[district],
+            "YEAR": df[prefix + "YEAR"],
+            "MONTH": df[prefix + "MONTH"],
+            "HOUR_OF_WEEK": (df[prefix + "WEEKDAY"].astype("int16") * 24 + df[prefix + "HOUR"]).astype("int16"),
+        })
+        counts.append(keys.groupby(KEYS, observed=True).size().rename(measure))
+
+    flows = pd.concat(counts, axis=1).fillna(0).astype("int32")
+    return flows.reset_index()
+
+
+def merge_flows(flows:pd.DataFrame) -> pd.DataFrame:
+    """Merges flow tables (e.g. partial tables of several source files) by adding the counts of equal keys.
+
+    Args:
+        flows (pd.DataFrame): flow table(s), see build_flows
+
+    Returns:
+        pd.DataFrame: merged flow table
+    """
+    return flows.groupby(KEYS, as_index=False)[["STARTS", "ENDS"]].sum()
+
+
+class DistrictCube:
+    """Dense district x month x hour-of-week x (starts, ends) array of the flow table.
+
+    Args:
+        flows (pd.DataFrame): flow table, see build_flows
+    """
+
+    def __init__(self, flows:pd.DataFrame):
+        self.districts = pd.Index(np.sort(flows["CITY_DISTRICT"].unique()))
+        # Monate fortlaufend als year * 12 + month - 1
+        months = flows["YEAR"].to_numpy("int32") * 12 + flows["MONTH"].to_numpy("int32") - 1
+        self.months = np.unique(months)
+        self.counts = np.zeros((len(self.districts), len(self.months), HOURS_OF_WEEK, 2), dtype="int32")
+        index = (self.districts.get_indexer(flows["CITY_DISTRICT"]), np.searchsorted(self.months, months),
+                 flows["HOUR_OF_WEEK"].to_numpy())
+        np.add.at(self.counts, index + (0,), flows["STARTS"].to_numpy())
+        np.add.at(self.counts, index + (1,), flows["ENDS"].to_numpy())
+
+    @property
+    def nbytes(self) -> int:
+        return self.counts.nbytes
+
+    def select_months(self, years:list=None, months:list=None) -> np.ndarray:
+        """Boolean mask over the months of the cube, by years and/or months (1-12)."""
+        mask = np.ones(len(self.months), dtype=bool)
+        if years is not None:
+            mask &= np.isin(self.months // 12, years)
+        if months is not None:
+            mask &= np.isin(self.months % 12 + 1, months)
+        return mask
+
+    def frames(self, mask:np.ndarray, measure:str="STARTS") -> np.ndarray:
+        """Values per hour of the week and district for the selected months.
+
+        Args:
+            mask (np.ndarray): selected months, see select_months
+            measure (str, optional): "STARTS", "ENDS" or "NET_FLOW" (ends - starts). Defaults to "STARTS".
+
+        Returns:
+            np.ndarray: array of shape (HOURS_OF_WEEK, number of districts)
+        """
+        selected = self.counts[:, mask].sum(axis=1)
+        if measure == "STARTS":
+            values = selected[..., 0]
+        elif measure == "ENDS":
+            values = selected[..., 1]
+        elif measure == "NET_FLOW":
+            values = selected[..., 1] - selected[..., 0]
+        else:
+            raise ValueError(f"Unbekannte Kennzahl: {measure}")
+        return values.T
+
+
+def hour_label(hour_of_week:int) -> str:
+    """Label of an hour of the week, e.g. 32 -> "Di 08:00"."""
+    weekday, hour = divmod(int(hour_of_week), 24)
+    return f"{WEEKDAYS[weekday]} {hour:02d}:00"
@@ -0,0 +1,210 @@
+"""Duration statistics from mergeable quantile sketches.
+
+Every trip duration is counted in a logarithmic bucket (DDSketch-style, relative accuracy ALPHA).
+The bucket boundaries are fixed, so sketches are merged by adding their bucket counts, exactly and in
+any order. Sketches are pre-aggregated per (start day, end day, start district, station type) bucket
+in the data store (see ingestion.py). Like the SQL selections (query.months_filter, query.days_filter),
+a selection of days contains every trip whose start or end day is selected: trips ending on their start
+day are answered by adding the rows of a dense day x bucket array, the few multi-day trips from a sparse
+list, independent of the number of trips in the selection.
+
+Error bound: for every quantile q, the returned value v satisfies |v - x_q| <= ALPHA * x_q, where x_q
+is the exact q-quantile (lower rank definition) of the durations in the merged sketches. This holds for
+zero durations (own bucket) and durations between MIN_SECONDS and MAX_SECONDS; durations between zero and
+MIN_SECONDS and above MAX_SECONDS are clamped to these bounds.
+"""
+import numpy as np
+import pandas as pd
+
+# relative Genauigkeit: 1 %
+ALPHA = 0.01
+GAMMA = (1 + ALPHA) / (1 - ALPHA)
+MIN_SECONDS = 1
+MAX_SECONDS = 90 * 24 * 3600
+# Bucket 0 zählt Fahrten der Dauer 0, Bucket i >= 1 die Dauern in (GAMMA^(i-2), GAMMA^(i-1)]
+ZERO_BUCKET = 0
+N_BUCKETS = int(np.ceil(np.log(MAX_SECONDS) / np.log(GAMMA))) + 2
+
+# Stationstyp je Fahrt: 2 * RENTAL_IS_STATION + RETURN_IS_STATION
+# 0 = frei -> frei, 1 = frei -> Station, 2 = Station -> frei, 3 = Station -> Station
+STATION_TYPES = {0: "frei -> frei", 1: "frei -> Station", 2: "Station -> frei", 3: "Station -> Station"}
+
+
+def bucket_index(seconds) -> np.ndarray:
+    """Maps durations in seconds to sketch buckets.
+
+    Args:
+        seconds: durations in seconds (scalar or array)
+
+    Returns:
+        np.ndarray: bucket indices (int16)
+    """
+    seconds = np.asarray(seconds, dtype="float64")
+    index = np.ceil(np.log(np.clip(seconds, MIN_SECONDS, MAX_SECONDS)) / np.log(GAMMA)) + 1
+    return np.where(seconds > 0, index, ZERO_BUCKET).astype("int16")
+
+
+def bucket_value(index) -> np.ndarray:
+    """Representative duration in seconds of sketch buckets (relative error <= ALPHA within the bucket).
+
+    Args:
+        index: bucket indices
+
+    Returns:
+        np.ndarray: durations in seconds
+    """
+    index = np.asarray(index, dtype="float64")
+    return np.where(index == ZERO_BUCKET, 0.0, 2 * GAMMA ** (index - 1) / (GAMMA + 1))
+
+
+def quantiles_from_counts(counts:np.ndarray, qs=(0.5, 0.9, 0.99)) -> list:
+    """Reads quantiles from the bucket counts of a (merged) sketch.
+
+    Args:
+        counts (np.ndarray): counts per bucket, length N_BUCKETS
+        qs (tuple, optional): quantiles between 0 and 1. Defaults to (0.5, 0.9, 0.99).
+
+    Returns:
+        list: durations in seconds per quantile, None if the sketch is empty
+    """
+    total = counts.sum()
+    if total == 0:
+        return [None for _ in qs]
+    cumulative = np.cumsum(counts)
+    # Rang wie bei der "lower"-Interpolation: Element mit Index floor(q * (n - 1))
+    ranks = np.floor(np.asarray(qs) * (total - 1))
+    indices = np.searchsorted(cumulative, ranks, side="right")
+    return [float(value) for value in bucket_value(indices)]
+
+
+def duration_seconds(df:pd.DataFrame) -> np.ndarray:
+    """Trip durations in seconds, including multi-day durations (unlike Timedelta.seconds)."""
+    return df["DURATION"].dt.total_seconds().to_numpy()
+
+
+def build_sketches(df:pd.DataFrame) -> pd.DataFrame:
+    """Builds the sparse sketch table: trip counts per (start day, end day, start district, station type, bucket).
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with STARTTIME, ENDTIME, DURATION, CITY_DISTRICT_START,
+            RENTAL_IS_STATION, RETURN_IS_STATION
+
+    Returns:
+        pd.DataFrame: columns DATE (start day), END_DATE, CITY_DISTRICT_START, STATION_TYPE, BUCKET, COUNT
+    """
+    keys = pd.DataFrame({
+        "DATE": df["STARTTIME"].dt.normalize(),
+        "END_DATE": df["ENDTIME"].dt.normalize(),
+        "CITY_DISTRICT_START": df["CITY_DISTRICT_START"],
+        "STATION_TYPE": (2 * df["RENTAL_IS_STATION"].astype("int8") + df["RETURN_IS_STATION"].astype("int8")).astype("int8"),
+        "BUCKET": bucket_index(duration_seconds(df)),
+    })
+    counts = keys.groupby(list(keys.columns), dropna=False, observed=True).size()
+    return counts.rename("COUNT").astype("int32").reset_index()
+
+
+def merge_sketches(sketches:pd.DataFrame) -> pd.DataFrame:
+    """Merges sketch tables (e.g. partial tables of several source files) by adding the counts of equal keys.
+
+    Args:
+        sketches (pd.DataFrame): sketch table(s) with DATE, END_DATE, CITY_DISTRICT_START, STATION_TYPE, BUCKET, COUNT
+
+    Returns:
+        pd.DataFrame: merged sketch table
+    """
+    keys = ["DATE", "END_DATE", "CITY_DISTRICT_START", "STATION_TYPE", "BUCKET"]
+    return sketches.groupby(keys, as_index=False, dropna=False)["COUNT"].sum()
+
+
+class DurationCube:
+    """Duration sketches by day for constant-time statistics of day selections: a dense day x bucket array of
+    the trips ending on their start day and a sparse list of the multi-day trips.
+
+    Args:
+        sketches (pd.DataFrame): sketch table, see build_sketches
+        station_type (int, optional): restrict to one station type (see STATION_TYPES), all if None
+
+    Raises:
+        ValueError: if the sketches have no END_DATE (store of an older version, use python ingestion.py --force)
+    """
+
+    def __init__(self, sketches:pd.DataFrame, station_type:int=None):
+        if "END_DATE" not in sketches.columns:
+            raise ValueError("Dauer-Sketches ohne END_DATE (älterer Datenspeicher), bitte python ingestion.py --force ausführen")
+        if station_type is not None:
+            sketches = sketches[sketches["STATION_TYPE"] == station_type]
+        starts = pd.to_datetime(sketches["DATE"]).to_numpy().astype("datetime64[D]")
+        ends = pd.to_datetime(sketches["END_DATE"]).to_numpy().astype("datetime64[D]")
+        buckets = sketches["BUCKET"].to_numpy()
+        counts = sketches["COUNT"].to_numpy()
+        # alle Start- und Endtage, damit auch Tage auswählbar sind, an denen nur Fahrten enden
+        self.dates = np.union1d(starts, ends)
+        start_rows = np.searchsorted(self.dates, starts)
+        end_rows = np.searchsorted(self.dates, ends)
+        same_day = start_rows == end_rows
+        self.counts = np.zeros((len(self.dates), N_BUCKETS), dtype="int32")
+        np.add.at(self.counts, (start_rows[same_day], buckets[same_day]), counts[same_day])
+        # mehrtägige Fahrten: Start- und Endtag je Zeile
+        self.span_starts = start_rows[~same_day]
+        self.span_ends = end_rows[~same_day]
+        self.span_buckets = buckets[~same_day]
+        self.span_counts = counts[~same_day]
+
+    def select_days(self, years:list=None, months:list=None, start=None, end=None) -> np.ndarray:
+        """Day masks of a selection by years/months or by a date range (inclusive), one row per condition.
+        A trip belongs to the selection if its start or end day meets every condition (as in query.months_filter
+        and query.days_filter).
+
+        Returns:
+            np.ndarray: boolean array, conditions x days of the cube
+        """
+        conditions = [np.ones(len(self.dates), dtype=bool)]
+        if years is not None:
+            conditions.append(np.isin(self.dates.astype("datetime64[Y]").astype(int) + 1970, years))
+        if months is not None:
+            conditions.append(np.isin(self.dates.astype("datetime64[M]").astype(int) % 12 + 1, months))
+        if start is not None or end is not None:
+            in_range = np.ones(len(self.dates), dtype=bool)
+            if start is not None:
+                in_range &= self.dates >= np.datetime64(start, "D")
+            if end is not None:
+                in_range &= self.dates <= np.datetime64(end, "D")
+            conditions.append(in_range)
+        return np.vstack(conditions)
+
+    def quantiles(self, selection:np.ndarray, qs=(0.5, 0.9, 0.99)) -> list:
+        """Merges the sketches of the selected trips and returns the quantiles.
+
+        Args:
+            selection (np.ndarray): day masks of the selection, see select_days
+            qs (tuple, optional): quantiles. Defaults to (0.5, 0.9, 0.99).
+
+        Returns:
+            list: durations in seconds per quantile (relative error <= ALPHA), None if no trips
+        """
+        counts = self.counts[selection.all(axis=0)].sum(axis=0, dtype="int64")
+        spans = (selection[:, self.span_starts] | selection[:, self.span_ends]).all(axis=0)
+        counts += np.bincount(self.span_buckets[spans], weights=self.span_counts[spans],
+                              minlength=N_BUCKETS).astype("int64")
+        return quantiles_from_counts(counts, qs)
+
+
+def format_duration(seconds:float) -> str:
+    """Formats a duration in seconds as text with days, hours and minutes.
+
+    Args:
+        seconds (float): duration in seconds
+
+    Returns:
+        str: e.g. "14 Minuten", "1 Stunden, 5 Minuten" or "2 Tage, 3 Stunden, 0 Minuten"
+    """
+    if seconds is None:
+        return "-"
+    total_minutes = int(round(seconds / 60))
+    days, minutes = divmod(total_minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    if days:
+        return f"{days} Tage, {hours} Stunden, {minutes} Minuten"
+    if total_minutes > 60:
+        return f"{hours} Stunden, {minutes} Minuten"
+    return f"{total_minutes} Minuten"
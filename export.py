@@ -0,0 +1,221 @@
+"""Streaming export of a month/day selection and its aggregates to CSV, Parquet or GeoJSON.
+
+The selection is read with the same conditions as the app (see query.months_filter / days_filter) and
+streamed from DuckDB as Arrow record batches of at most CHUNK_ROWS rows directly into the file writer.
+Memory use is bounded by one chunk, independent of the size of the selection; nothing is materialized
+as DataFrame. Next to the trips, the origin-destination matrix of the city districts and the rentals /
+returns per station of the selection are exported. Rows, bytes and throughput are reported per file.
+Every export is written into its own temporary directory that is renamed into place when complete, so
+parallel exports of the same selection never write into the same files.
+
+use:
+    python export.py --months 2022 2023 --month 6 7 8 --format parquet
+    python export.py --days 2023-06-01 2023-06-07 --daytime 07:00 09:00 --format geojson --out exports/pendler
+"""
+import argparse
+import errno
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import date, datetime
+
+import duckdb
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+
+import query as q
+
+EXPORT_DIR = "exports"
+# Standardverzeichnis eines Exports (wird bei jedem Export ersetzt)
+DEFAULT_OUT_DIR = os.path.join(EXPORT_DIR, "auswahl")
+CHUNK_ROWS = 100_000
+FORMATS = {"csv": ".csv", "parquet": ".parquet", "geojson": ".geojson"}
+
+# Fahrtdauer als Sekunden statt INTERVAL (von CSV / GeoJSON nicht darstellbar)
+TRIPS_SQL = """SELECT * EXCLUDE (DURATION), epoch(ENDTIME) - epoch(STARTTIME) AS DURATION_SECONDS
+               FROM trips WHERE {condition}"""
+OD_MATRIX_SQL = """SELECT CITY_DISTRICT_START, CITY_DISTRICT_END, count(*) AS RIDES,
+                          median(epoch(ENDTIME) - epoch(STARTTIME)) AS MEDIAN_DURATION_SECONDS
+                   FROM trips WHERE {condition}
+                   GROUP BY ALL ORDER BY RIDES DESC"""
+STATION_COUNTS_SQL = """SELECT STATION_NAME, any_value(LAT) AS LAT, any_value(LON) AS LON,
+                               sum(RENTALS)::BIGINT AS RENTALS, sum(RETURNS)::BIGINT AS RETURNS
+                        FROM (SELECT RENTAL_STATION_NAME AS STATION_NAME, STARTLAT AS LAT, STARTLON AS LON, 1 AS RENTALS, 0 AS RETURNS
+                              FROM trips WHERE {condition} AND RENTAL_IS_STATION = 1
+                              UNION ALL
+                              SELECT RETURN_STATION_NAME, ENDLAT, ENDLON, 0, 1
+                              FROM trips WHERE {condition} AND RETURN_IS_STATION = 1)
+                        WHERE STATION_NAME <> ''
+                        GROUP BY ALL ORDER BY sum(RENTALS) + sum(RETURNS) DESC"""
+
+
+def _trip_geometry(row:dict) -> dict:
+    return {"type": "LineString", "coordinates": [[row.pop("STARTLON"), row.pop("STARTLAT")], [row.pop("ENDLON"), row.pop("ENDLAT")]]}
+
+
+def _station_geometry(row:dict) -> dict:
+    return {"type": "Point", "coordinates": [row.pop("LON"), row.pop("LAT")]}
+
+
+# Datensätze des Exports: Dateiname -> (SQL, Anzahl der Filter-Wiederholungen, Geometrie für GeoJSON)
+DATASETS = {
+    "trips": (TRIPS_SQL, 1, _trip_geometry),
+    "od_matrix": (OD_MATRIX_SQL, 1, None),
+    "station_counts": (STATION_COUNTS_SQL, 2, _station_geometry),
+}
+
+
+def stream_batches(sql:str, params:list, con:duckdb.DuckDBPyConnection, chunk_rows:int=CHUNK_ROWS) -> pa.RecordBatchReader:
+    """Runs a query and returns its result as stream of Arrow record batches (at most chunk_rows rows each)."""
+    return con.execute(sql, params).fetch_record_batch(chunk_rows)
+
+
+def write_csv(reader:pa.RecordBatchReader, path:str) -> int:
+    """Writes the batches of a reader to a CSV file, returns the number of rows."""
+    rows = 0
+    with pacsv.CSVWriter(path, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def write_parquet(reader:pa.RecordBatchReader, path:str) -> int:
+    """Writes the batches of a reader to a Parquet file (one row group per batch), returns the number of rows."""
+    rows = 0
+    with pq.ParquetWriter(path, reader.schema, compression="zstd") as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def write_geojson(reader:pa.RecordBatchReader, path:str, geometry=None) -> int:
+    """Writes the batches of a reader as GeoJSON FeatureCollection, feature by feature.
+
+    Args:
+        reader (pa.RecordBatchReader): record batches
+        path (str): output file
+        geometry (optional): function that removes the coordinate columns from a row (dict) and returns
+            the GeoJSON geometry. Features without geometry if None.
+
+    Returns:
+        int: number of rows
+    """
+    rows = 0
+    with open(path, "w", encoding="utf-8") as file:
+        file.write('{"type": "FeatureCollection", "features": [\n')
+        separator = ""
+        for batch in reader:
+            for row in batch.to_pylist():
+                feature = {"type": "Feature", "geometry": geometry(row) if geometry else None, "properties": row}
+                file.write(separator + json.dumps(feature, ensure_ascii=False, default=str))
+                separator = ",\n"
+            rows += batch.num_rows
+        file.write("\n]}\n")
+    return rows
+
+
+def _replace_directory(tmp_dir:str, out_dir:str) -> None:
+    """Renames a completely written export directory to out_dir, replacing an older export there."""
+    while True:
+        try:
+            os.rename(tmp_dir, out_dir)
+            return
+        except OSError as error:
+            if error.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        # älteren Export beiseite schieben und löschen (oder ein paralleler Export hat das schon getan)
+        old_dir = tempfile.mkdtemp(prefix=".old-", dir=os.path.dirname(out_dir))
+        try:
+            os.rename(out_dir, old_dir)
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+
+def _export_dataset(sql:str, params:list, fmt:str, geometry, path:str, chunk_rows:int, con:duckdb.DuckDBPyConnection) -> dict:
+    """Streams one dataset of the export into a file and returns its report entry."""
+    start = time.perf_counter()
+    reader = stream_batches(sql, params, con, chunk_rows)
+    if fmt == "csv":
+        rows = write_csv(reader, path)
+    elif fmt == "parquet":
+        rows = write_parquet(reader, path)
+    else:
+        rows = write_geojson(reader, path, geometry)
+    seconds = time.perf_counter() - start
+    size = os.path.getsize(path)
+    return {"path": path, "rows": rows, "bytes": size, "seconds": seconds,
+            "rows_per_second": rows / seconds if seconds else 0.0,
+            "mb_per_second": size / 1024 ** 2 / seconds if seconds else 0.0}
+
+
+def export_selection(condition:str, params:list, fmt:str="parquet", out_dir:str=DEFAULT_OUT_DIR, chunk_rows:int=CHUNK_ROWS,
+                     con:duckdb.DuckDBPyConnection=None) -> list:
+    """Exports the trips of a selection, the OD matrix and the station counts.
+
+    Args:
+        condition (str): SQL condition of the selection, see q.months_filter / q.days_filter
+        params (list): parameters of the condition
+        fmt (str, optional): "csv", "parquet" or "geojson". Defaults to "parquet".
+        out_dir (str, optional): output directory, replaced as a whole by the new export. Defaults to DEFAULT_OUT_DIR.
+        chunk_rows (int, optional): rows per chunk. Defaults to CHUNK_ROWS.
+        con (duckdb.DuckDBPyConnection, optional): connection, defaults to the shared connection
+
+    Returns:
+        list: one dict per file with path, rows, bytes, seconds, rows_per_second, mb_per_second
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unbekanntes Format: {fmt} (möglich: {', '.join(FORMATS)})")
+    con = con or q.get_connection()
+    out_dir = os.path.abspath(out_dir)
+    os.makedirs(os.path.dirname(out_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(out_dir))
+
+    report = []
+    try:
+        for name, (sql, repeat, geometry) in DATASETS.items():
+            report.append(_export_dataset(sql.format(condition=condition), params * repeat, fmt, geometry,
+                                          os.path.join(tmp_dir, name + FORMATS[fmt]), chunk_rows, con))
+        _replace_directory(tmp_dir, out_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    for entry in report:
+        entry["path"] = os.path.join(out_dir, os.path.basename(entry["path"]))
+    return report
+
+
+def print_report(report:list) -> None:
+    for entry in report:
+        print(f"{entry['path']}: {entry['rows']} Zeilen, {entry['bytes'] / 1024 ** 2:.1f} MB in {entry['seconds']:.2f} s "
+              f"({entry['rows_per_second']:,.0f} Zeilen/s, {entry['mb_per_second']:.1f} MB/s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export einer Monats- oder Tagesauswahl mit Aggregaten.")
+    selection = parser.add_mutually_exclusive_group(required=True)
+    selection.add_argument("--months", nargs="+", type=int, metavar="JAHR", help="Jahre der Monatsauswahl (mit --month)")
+    selection.add_argument("--days", nargs=2, type=date.fromisoformat, metavar=("VON", "BIS"), help="Tage der Tagesauswahl (JJJJ-MM-TT)")
+    parser.add_argument("--month", nargs="+", type=int, default=list(range(1, 13)), help="Monate 1-12 (Standard: alle)")
+    parser.add_argument("--daytime", nargs=2, default=["00:00", "23:59"], metavar=("VON", "BIS"), help="Tageszeit (HH:MM)")
+    parser.add_argument("--format", choices=list(FORMATS), default="parquet", help="Dateiformat")
+    parser.add_argument("--out", default=DEFAULT_OUT_DIR, help="Ausgabeverzeichnis (wird ersetzt)")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Zeilen je Block")
+    args = parser.parse_args()
+
+    if args.months:
+        condition, params = q.months_filter(args.months, args.month)
+    else:
+        daytime = tuple(datetime.strptime(value, "%H:%M").time() for value in args.daytime)
+        condition, params = q.days_filter(args.days[0], args.days[1], daytime)
+
+    print_report(export_selection(condition, params, args.format, args.out, args.chunk_rows))
+
+
+if __name__ == "__main__":
+    main()
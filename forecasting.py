@@ -0,0 +1,469 @@
+"""Batch forecasting with Prophet for the whole city, every city district and the most used stations.
+
+All daily series are built from the cleaned trip data in one pass and fitted in a process pool.
+Each fit has its own timeout, series with too little history are skipped. The forecasts are written
+to a compact Parquet store that the app queries per district or station (load_forecast).
+
+The hourly mode fits the city-wide hourly series with daily and weekly seasonality. Rolling-origin
+cross-validation and the hyperparameter search run as one flat set of (parameters, cutoff) tasks
+in a process pool, so all cores are used. The fitted hourly model and its forecast are stored together
+with the data version, the app uses them instead of fitting the model itself (load_hourly).
+
+use: python forecasting.py [--start-year 2020] [--end-year 2023] [--top-stations 50] [--workers 4] [--timeout 120]
+     python forecasting.py --hourly [--tune] [--workers 4]
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import data_preprocessing as dp
+import ingestion as ing
+
+FORECAST_STORE = "forecasts.parquet"
+FORECAST_REPORT = "forecasts_report.csv"
+HOURLY_FORECAST_STORE = "forecasts_hourly.parquet"
+HOURLY_MODEL_STORE = "forecasts_hourly_model.json"
+HOURLY_TUNING_REPORT = "forecasts_hourly_tuning.csv"
+
+# Mindestanzahl an Tagen zwischen erster und letzter Fahrt, damit eine Reihe modelliert wird
+MIN_HISTORY_DAYS = 180
+# Mindestanteil an Tagen mit Fahrten innerhalb dieses Zeitraums
+MIN_ACTIVE_SHARE = 0.3
+
+
+def _to_prophet_frame(counts:pd.Series) -> pd.DataFrame:
+    """Converts a daily count series (DatetimeIndex) into the ds/y format of Prophet, starting at the first ride."""
+    active = counts[counts > 0]
+    if active.empty:
+        return pd.DataFrame({"ds": pd.Series(dtype="datetime64[ns]"), "y": pd.Series(dtype="float64")})
+    counts = counts.loc[active.index[0]:]
+    return pd.DataFrame({"ds": counts.index, "y": counts.to_numpy(dtype="float64")})
+
+
+def build_daily_series(df:pd.DataFrame, top_stations:int=50) -> dict:
+    """Builds the daily ride counts for the whole city, every city district (by start) and the top stations (by rentals).
+    Days without rides are filled with 0.
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with STARTTIME, CITY_DISTRICT_START, RENTAL_IS_STATION, RENTAL_STATION_NAME
+        top_stations (int, optional): number of stations with the most rentals to include. Defaults to 50.
+
+    Returns:
+        dict: {(kind, key): DataFrame with columns ds and y}, kind is "city", "district" or "station"
+    """
+    dates = df["STARTTIME"].dt.normalize()
+    full_range = pd.date_range(dates.min(), dates.max(), freq="D")
+
+    series = {("city", "München"): _to_prophet_frame(dates.value_counts().reindex(full_range, fill_value=0))}
+
+    # Stadtviertel: eine Gruppierung für alle Viertel, danach spaltenweise Reihen
+    by_district = df.groupby([dates, df["CITY_DISTRICT_START"]]).size().unstack(fill_value=0)
+    by_district = by_district.reindex(full_range, fill_value=0)
+    for district in by_district.columns:
+        series[("district", district)] = _to_prophet_frame(by_district[district])
+
+    # Stationen mit den meisten Ausleihen
+    is_station = df["RENTAL_IS_STATION"] == 1
+    stations = df.loc[is_station, "RENTAL_STATION_NAME"].value_counts().head(top_stations).index
+    station_rows = is_station & df["RENTAL_STATION_NAME"].isin(stations)
+    by_station = df[station_rows].groupby([dates[station_rows], df.loc[station_rows, "RENTAL_STATION_NAME"]]).size().unstack(fill_value=0)
+    by_station = by_station.reindex(full_range, fill_value=0)
+    for station in by_station.columns:
+        series[("station", station)] = _to_prophet_frame(by_station[station])
+
+    return series
+
+
+def has_enough_history(history:pd.DataFrame, min_history_days:int=MIN_HISTORY_DAYS) -> bool:
+    """Checks whether a series covers enough days and has rides on enough of them to be modelled.
+
+    Args:
+        history (pd.DataFrame): series with columns ds and y
+        min_history_days (int, optional): minimum number of days. Defaults to MIN_HISTORY_DAYS.
+
+    Returns:
+        bool: True if the series should be fitted
+    """
+    if len(history) < min_history_days:
+        return False
+    return (history["y"] > 0).mean() >= MIN_ACTIVE_SHARE
+
+
+def fit_series(kind:str, key:str, history:pd.DataFrame, periods:int=365, timeout:float=120) -> dict:
+    """Fits one Prophet model and predicts the given number of days. Runs in a worker process.
+
+    Args:
+        kind (str): "city", "district" or "station"
+        key (str): name of the city district or station
+        history (pd.DataFrame): series with columns ds and y
+        periods (int, optional): number of days to forecast. Defaults to 365.
+        timeout (float, optional): maximum time for the model fit in seconds. Defaults to 120.
+
+    Returns:
+        dict: kind, key, status ("ok", "timeout" or "error: ..."), fit_seconds, n_days and the forecast (or None)
+    """
+    from prophet import Prophet
+
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+
+    result = {"kind": kind, "key": key, "status": "ok", "fit_seconds": None, "n_days": len(history), "forecast": None}
+    start = time.perf_counter()
+    try:
+        model = Prophet(growth='linear', seasonality_mode='additive', interval_width=0.90)
+        # timeout wird an cmdstanpy weitergereicht und beendet die Optimierung
+        model.fit(history, timeout=timeout)
+        result["fit_seconds"] = time.perf_counter() - start
+
+        future = model.make_future_dataframe(periods=periods, freq='D', include_history=True)
+        result["forecast"] = model.predict(future)[["ds", "yhat", "yhat_lower", "yhat_upper"]]
+    except TimeoutError:
+        result["status"] = "timeout"
+        result["fit_seconds"] = time.perf_counter() - start
+    except Exception as error:
+        result["status"] = f"error: {error}"
+        result["fit_seconds"] = time.perf_counter() - start
+
+    return result
+
+
+def batch_forecast(series:dict, periods:int=365, min_history_days:int=MIN_HISTORY_DAYS, timeout:float=120,
+                   max_workers:int=None) -> tuple:
+    """Fits all series in a process pool.
+
+    Args:
+        series (dict): {(kind, key): DataFrame with ds and y}, see build_daily_series
+        periods (int, optional): number of days to forecast. Defaults to 365.
+        min_history_days (int, optional): series with less history are skipped. Defaults to MIN_HISTORY_DAYS.
+        timeout (float, optional): maximum fit time per series in seconds. Defaults to 120.
+        max_workers (int, optional): number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        tuple: (forecasts as DataFrame for save_forecasts, report as DataFrame with status and fit time per series)
+    """
+    report = []
+    forecasts = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {}
+        for (kind, key), history in series.items():
+            if not has_enough_history(history, min_history_days):
+                report.append({"kind": kind, "key": key, "status": "skipped", "fit_seconds": None, "n_days": len(history)})
+                continue
+            futures[pool.submit(fit_series, kind, key, history, periods, timeout)] = (kind, key)
+
+        for future in as_completed(futures):
+            result = future.result()
+            forecast = result.pop("forecast")
+            report.append(result)
+            if forecast is not None:
+                forecasts.append(forecast.assign(KIND=result["kind"], KEY=result["key"]))
+
+    report = pd.DataFrame(report, columns=["kind", "key", "status", "fit_seconds", "n_days"])
+    if not forecasts:
+        return pd.DataFrame(columns=["KIND", "KEY", "ds", "yhat", "yhat_lower", "yhat_upper"]), report
+    return pd.concat(forecasts, ignore_index=True), report
+
+
+def save_forecasts(forecasts:pd.DataFrame, path:str=FORECAST_STORE) -> None:
+    """Writes the forecasts as compact Parquet file: categorical KIND/KEY, float32 values, sorted by series,
+    so that reading one series only touches few row groups.
+
+    Args:
+        forecasts (pd.DataFrame): DataFrame with KIND, KEY, ds, yhat, yhat_lower, yhat_upper
+        path (str, optional): path of the store. Defaults to FORECAST_STORE.
+    """
+    forecasts = forecasts.sort_values(["KIND", "KEY", "ds"]).reset_index(drop=True)
+    forecasts = forecasts.astype({"KIND": "category", "KEY": "category",
+                                  "yhat": "float32", "yhat_lower": "float32", "yhat_upper": "float32"})
+    forecasts[["KIND", "KEY", "ds", "yhat", "yhat_lower", "yhat_upper"]].to_parquet(path, index=False, row_group_size=50_000)
+
+
+def load_forecast(kind:str, key:str, path:str=FORECAST_STORE) -> pd.DataFrame:
+    """Reads the forecast of one series from the store.
+
+    Args:
+        kind (str): "city", "district" or "station"
+        key (str): name of the city district or station
+        path (str, optional): path of the store. Defaults to FORECAST_STORE.
+
+    Returns:
+        pd.DataFrame: columns ds, yhat, yhat_lower, yhat_upper
+    """
+    forecast = pd.read_parquet(path, columns=["ds", "yhat", "yhat_lower", "yhat_upper"],
+                               filters=[("KIND", "==", kind), ("KEY", "==", key)])
+    return forecast.reset_index(drop=True)
+
+
+def list_forecasts(kind:str, path:str=FORECAST_STORE) -> list:
+    """Lists the names of all series of one kind in the store.
+
+    Args:
+        kind (str): "city", "district" or "station"
+        path (str, optional): path of the store. Defaults to FORECAST_STORE.
+
+    Returns:
+        list: sorted names of city districts or stations
+    """
+    keys = pd.read_parquet(path, columns=["KEY"], filters=[("KIND", "==", kind)])["KEY"]
+    return sorted(keys.astype(str).unique())
+
+
+## Stündliche Prognose
+
+# Suchraum für die Hyperparameter der stündlichen Modelle
+HOURLY_PARAM_GRID = {
+    "changepoint_prior_scale": [0.01, 0.1, 0.5],
+    "seasonality_prior_scale": [1.0, 10.0],
+    "seasonality_mode": ["additive", "multiplicative"],
+}
+
+
+def build_hourly_series(df:pd.DataFrame) -> pd.DataFrame:
+    """Aggregates the rides to hourly counts (by start), hours without rides are filled with 0.
+    Uses the integer calendar columns (START_YEAR, START_DOY, START_HOUR, see dp.add_calendar_features) if present.
+
+    Args:
+        df (pd.DataFrame): DataFrame with STARTTIME or with the calendar columns
+
+    Returns:
+        pd.DataFrame: series with columns ds (hourly timestamps) and y
+    """
+    if {"START_YEAR", "START_DOY", "START_HOUR"}.issubset(df.columns):
+        # Gruppierung nach Integer-Schlüsseln, Umwandlung in Zeitstempel nur für die Gruppen
+        counts = df.groupby(["START_YEAR", "START_DOY", "START_HOUR"]).size()
+        keys = counts.index
+        counts.index = dp.calendar_dates(keys.get_level_values(0), keys.get_level_values(1)) \
+            + pd.to_timedelta(keys.get_level_values(2).astype("int64"), unit="h")
+    else:
+        counts = df.groupby([df["STARTTIME"].dt.normalize(), df["STARTTIME"].dt.hour]).size()
+        counts.index = counts.index.get_level_values(0) + pd.to_timedelta(counts.index.get_level_values(1), unit="h")
+    full_range = pd.date_range(counts.index.min(), counts.index.max(), freq="h")
+    counts = counts.reindex(full_range, fill_value=0)
+
+    return pd.DataFrame({"ds": counts.index, "y": counts.to_numpy(dtype="float64")})
+
+
+def make_hourly_model(uncertainty_samples:int=1000, **params):
+    """Creates a Prophet model for hourly data with daily and weekly seasonality.
+
+    Args:
+        uncertainty_samples (int, optional): samples for the uncertainty intervals, 0 disables them. Defaults to 1000.
+        **params: further Prophet parameters, e.g. changepoint_prior_scale
+
+    Returns:
+        Prophet: unfitted model
+    """
+    from prophet import Prophet
+
+    return Prophet(growth='linear', daily_seasonality=True, weekly_seasonality=True, yearly_seasonality=True,
+                   interval_width=0.90, uncertainty_samples=uncertainty_samples, **params)
+
+
+def fit_hourly(history:pd.DataFrame, periods:int=24 * 14, **params) -> tuple:
+    """Fits the hourly model and predicts the given number of hours.
+
+    Args:
+        history (pd.DataFrame): hourly series with columns ds and y, see build_hourly_series
+        periods (int, optional): number of hours to forecast. Defaults to two weeks.
+        **params: Prophet parameters, e.g. the best parameters of tune_hourly
+
+    Returns:
+        tuple: (fitted model, forecast DataFrame)
+    """
+    model = make_hourly_model(**params)
+    model.fit(history)
+    future = model.make_future_dataframe(periods=periods, freq='h', include_history=True)
+    return model, model.predict(future)
+
+
+def data_version(start_year:int=None, end_year:int=None) -> str:
+    """Version of the data a forecast is fitted on, equal to the data version of the app for the same data.
+
+    Args:
+        start_year (int, optional): first year, see ing.load_cleaned
+        end_year (int, optional): last year, see ing.load_cleaned
+
+    Returns:
+        str: data version
+    """
+    if not ing.store_exists():
+        return f"csv-{start_year or 2020}-{end_year or 2023}"
+    if start_year is None and end_year is None:
+        return ing.dataset_version()
+    return f"{ing.dataset_version()}-{start_year}-{end_year}"
+
+
+def save_hourly(model, forecast:pd.DataFrame, version:str, model_path:str=HOURLY_MODEL_STORE,
+                forecast_path:str=HOURLY_FORECAST_STORE) -> None:
+    """Stores the fitted hourly model (Prophet JSON incl. history) and its full forecast (incl. components).
+
+    Args:
+        model (Prophet): fitted model, see fit_hourly
+        forecast (pd.DataFrame): forecast of the model
+        version (str): data version of the history, see data_version
+        model_path (str, optional): path of the model. Defaults to HOURLY_MODEL_STORE.
+        forecast_path (str, optional): path of the forecast. Defaults to HOURLY_FORECAST_STORE.
+    """
+    from prophet.serialize import model_to_json
+
+    forecast.to_parquet(forecast_path, index=False)
+    # Modell zuletzt schreiben: es gilt nur zusammen mit der Prognose des gleichen Laufs
+    with open(model_path + ".tmp", "w") as file:
+        json.dump({"version": version, "model": model_to_json(model)}, file)
+    os.replace(model_path + ".tmp", model_path)
+
+
+def read_hourly_model(version:str, model_path:str=HOURLY_MODEL_STORE) -> str:
+    """Serialized hourly model if it was fitted on the given data version, otherwise None."""
+    if not os.path.exists(model_path):
+        return None
+    with open(model_path) as file:
+        stored = json.load(file)
+    return stored["model"] if stored.get("version") == version else None
+
+
+def load_hourly(version:str, model_path:str=HOURLY_MODEL_STORE, forecast_path:str=HOURLY_FORECAST_STORE) -> tuple:
+    """Loads the stored hourly model and forecast.
+
+    Args:
+        version (str): data version the model must have been fitted on
+        model_path (str, optional): path of the model. Defaults to HOURLY_MODEL_STORE.
+        forecast_path (str, optional): path of the forecast. Defaults to HOURLY_FORECAST_STORE.
+
+    Returns:
+        tuple: (model, forecast), None if nothing is stored or the model belongs to other data
+    """
+    model_json = read_hourly_model(version, model_path)
+    if model_json is None or not os.path.exists(forecast_path):
+        return None
+    from prophet.serialize import model_from_json
+
+    return model_from_json(model_json), pd.read_parquet(forecast_path)
+
+
+def hourly_stamp(model_path:str=HOURLY_MODEL_STORE) -> float:
+    """Modification time of the stored hourly model (part of cache keys), None if none is stored."""
+    return os.path.getmtime(model_path) if os.path.exists(model_path) else None
+
+
+def _evaluate_cutoff(history:pd.DataFrame, params:dict, cutoff:pd.Timestamp, horizon:pd.Timedelta) -> dict:
+    """Fits one model on the data up to the cutoff and evaluates it on the following horizon. Runs in a worker process."""
+    logging.getLogger("cmdstanpy").setLevel(logging.WARNING)
+
+    # ohne Unsicherheitsintervalle, für die Bewertung wird nur yhat gebraucht
+    model = make_hourly_model(uncertainty_samples=0, **params)
+    model.fit(history[history["ds"] <= cutoff])
+
+    test = history[(history["ds"] > cutoff) & (history["ds"] <= cutoff + horizon)]
+    errors = model.predict(test[["ds"]])["yhat"].to_numpy() - test["y"].to_numpy()
+
+    return {"cutoff": cutoff, "rmse": float(np.sqrt(np.mean(errors ** 2))), "mae": float(np.mean(np.abs(errors)))}
+
+
+def tune_hourly(history:pd.DataFrame, param_grid:dict=None, initial:str="730 days", period:str="90 days",
+                horizon:str="7 days", max_workers:int=None) -> pd.DataFrame:
+    """Rolling-origin cross-validation for every parameter combination of the grid. All (parameters, cutoff)
+    fits are distributed over a process pool.
+
+    Args:
+        history (pd.DataFrame): hourly series with columns ds and y
+        param_grid (dict, optional): {parameter: [values]}. Defaults to HOURLY_PARAM_GRID.
+        initial (str, optional): training period before the first cutoff. Defaults to "730 days".
+        period (str, optional): distance between cutoffs. Defaults to "90 days".
+        horizon (str, optional): evaluated forecast horizon after each cutoff. Defaults to "7 days".
+        max_workers (int, optional): number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        pd.DataFrame: one row per parameter combination with mean rmse and mae over all cutoffs, best first
+    """
+    from prophet.diagnostics import generate_cutoffs
+
+    param_grid = param_grid or HOURLY_PARAM_GRID
+    combinations = [dict(zip(param_grid, values)) for values in itertools.product(*param_grid.values())]
+    horizon = pd.Timedelta(horizon)
+    cutoffs = generate_cutoffs(history, horizon, pd.Timedelta(initial), pd.Timedelta(period))
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_evaluate_cutoff, history, params, cutoff, horizon): index
+                   for index, params in enumerate(combinations) for cutoff in cutoffs}
+        for future in as_completed(futures):
+            results.append({"combination": futures[future], **future.result()})
+
+    scores = pd.DataFrame(results).groupby("combination")[["rmse", "mae"]].mean()
+    scores = pd.concat([pd.DataFrame(combinations), scores], axis=1)
+    scores["cutoffs"] = len(cutoffs)
+    return scores.sort_values("rmse").reset_index(drop=True)
+
+
+def best_hourly_params(path:str=HOURLY_TUNING_REPORT) -> dict:
+    """Reads the best parameter combination of a saved tuning report.
+
+    Args:
+        path (str, optional): path of the report written by tune_hourly. Defaults to HOURLY_TUNING_REPORT.
+
+    Returns:
+        dict: Prophet parameters, empty if no report exists
+    """
+    if not os.path.exists(path):
+        return {}
+    best = pd.read_csv(path).iloc[0]
+    return {parameter: best[parameter].item() if hasattr(best[parameter], "item") else best[parameter]
+            for parameter in HOURLY_PARAM_GRID if parameter in best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prophet-Prognosen für Stadt, Stadtviertel und Stationen im Batch.")
+    parser.add_argument("--start-year", type=int, default=None, help="erstes Jahr (Standard: alle Jahre des Datenspeichers bzw. 2020)")
+    parser.add_argument("--end-year", type=int, default=None, help="letztes Jahr (Standard: alle Jahre des Datenspeichers bzw. 2023)")
+    parser.add_argument("--top-stations", type=int, default=50, help="Anzahl der meistgenutzten Stationen")
+    parser.add_argument("--periods", type=int, default=365, help="Prognosehorizont in Tagen")
+    parser.add_argument("--min-history", type=int, default=MIN_HISTORY_DAYS, help="Mindesthistorie in Tagen")
+    parser.add_argument("--timeout", type=float, default=120, help="maximale Fit-Dauer pro Reihe in Sekunden")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Anzahl der Prozesse")
+    parser.add_argument("--output", default=FORECAST_STORE)
+    parser.add_argument("--hourly", action="store_true", help="stündliche Prognose für die ganze Stadt")
+    parser.add_argument("--tune", action="store_true", help="mit --hourly: Hyperparametersuche per Kreuzvalidierung")
+    args = parser.parse_args()
+
+    # aus dem Datenspeicher (python ingestion.py), sonst direkt aus den csv-Dateien
+    df = ing.load_cleaned(start_year=args.start_year, end_year=args.end_year)
+
+    if args.hourly:
+        history = build_hourly_series(df)
+        if args.tune:
+            start = time.perf_counter()
+            scores = tune_hourly(history, max_workers=args.workers)
+            scores.to_csv(HOURLY_TUNING_REPORT, index=False)
+            print(scores.to_string())
+            print(f"Kreuzvalidierung in {time.perf_counter() - start:.1f} s, gespeichert in {HOURLY_TUNING_REPORT}")
+
+        model, forecast = fit_hourly(history, **best_hourly_params())
+        save_hourly(model, forecast, data_version(args.start_year, args.end_year))
+        print(f"Stündliches Modell und Prognose gespeichert in {HOURLY_MODEL_STORE} und {HOURLY_FORECAST_STORE}")
+        return
+
+    series = build_daily_series(df, top_stations=args.top_stations)
+
+    start = time.perf_counter()
+    forecasts, report = batch_forecast(series, periods=args.periods, min_history_days=args.min_history,
+                                       timeout=args.timeout, max_workers=args.workers)
+    total = time.perf_counter() - start
+
+    save_forecasts(forecasts, args.output)
+    report.to_csv(FORECAST_REPORT, index=False)
+
+    fitted = report[report["status"] == "ok"]
+    print(report.groupby(["kind", "status"]).size().to_string())
+    print(f"{len(fitted)} Modelle in {total:.1f} s (Fit-Dauer Median {fitted['fit_seconds'].median():.2f} s, "
+          f"Maximum {fitted['fit_seconds'].max():.2f} s), gespeichert in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
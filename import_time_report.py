@@ -0,0 +1,122 @@
+"""Import-time report for the modules used by the Streamlit app.
+
+Every module is imported in a fresh interpreter with ``python -X importtime``, so the numbers
+correspond to a cold start. Results can be saved as a baseline and compared later to catch
+startup regressions.
+
+use: python import_time_report.py [--save baseline.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Module, die beim Start der App bzw. in den einzelnen Ansichten geladen werden
+# (auch die eigenen Module der App, damit schwere Importe auf oberster Ebene auffallen)
+MODULES = [
+    "data_preprocessing",
+    "query",
+    "ingestion",
+    "sampling",
+    "district_cube",
+    "map_layers",
+    "pandas",
+    "numpy",
+    "streamlit",
+    "geopandas",
+    "shapely",
+    "geopy",
+    "folium",
+    "plotly.express",
+    "prophet",
+]
+
+# Bibliotheken, die nur in einzelnen Ansichten bzw. Verarbeitungsschritten gebraucht werden
+HEAVY_MODULES = ["duckdb", "pyarrow", "geopandas", "shapely", "geopy", "folium", "plotly", "prophet"]
+
+
+def measure_import(module:str) -> dict:
+    """Imports a module in a fresh interpreter and parses the output of -X importtime.
+
+    Args:
+        module (str): name of the module, e.g. "plotly.express"
+
+    Returns:
+        dict: {"module", "cumulative_ms", "self_ms", "heavy_modules"}; cumulative_ms is None if the import failed
+    """
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    # im Verzeichnis der App, damit deren eigene Module gefunden werden
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    report = {"module": module, "cumulative_ms": None, "self_ms": None, "heavy_modules": []}
+    if result.returncode != 0:
+        print(f"Import fehlgeschlagen: {module}", file=sys.stderr)
+        return report
+
+    # Zeilenformat: "import time:  self [us] | cumulative | imported package"
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            report["self_ms"] = int(parts[0]) / 1000
+            report["cumulative_ms"] = int(parts[1]) / 1000
+
+    heavy = result.stdout.strip()
+    report["heavy_modules"] = [m for m in heavy.split(",") if m and m != module.split(".")[0]]
+    return report
+
+
+def compare_reports(reports:list, baseline:dict, tolerance:float=0.2) -> list:
+    """Compares cumulative import times with a saved baseline.
+
+    Args:
+        reports (list): results of measure_import
+        baseline (dict): {module: cumulative_ms} from an earlier run
+        tolerance (float, optional): allowed relative increase. Defaults to 0.2.
+
+    Returns:
+        list: modules whose import time increased by more than the tolerance
+    """
+    regressions = []
+    for report in reports:
+        old = baseline.get(report["module"])
+        new = report["cumulative_ms"]
+        if old and new and new > old * (1 + tolerance):
+            regressions.append(report["module"])
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Misst die Importzeiten der von der App verwendeten Module.")
+    parser.add_argument("modules", nargs="*", default=MODULES, help="zu messende Module")
+    parser.add_argument("--save", help="Ergebnis als Baseline (JSON) speichern")
+    parser.add_argument("--compare", help="mit gespeicherter Baseline (JSON) vergleichen")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="erlaubte relative Verschlechterung")
+    args = parser.parse_args()
+
+    reports = [measure_import(module) for module in args.modules]
+
+    print(f"{'Modul':<20} {'kumulativ [ms]':>15} {'selbst [ms]':>12}  zieht nach sich")
+    for report in sorted(reports, key=lambda r: r["cumulative_ms"] or 0, reverse=True):
+        cumulative = f"{report['cumulative_ms']:.1f}" if report["cumulative_ms"] is not None else "-"
+        own = f"{report['self_ms']:.1f}" if report["self_ms"] is not None else "-"
+        print(f"{report['module']:<20} {cumulative:>15} {own:>12}  {', '.join(report['heavy_modules'])}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump({r["module"]: r["cumulative_ms"] for r in reports}, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        regressions = compare_reports(reports, baseline, args.tolerance)
+        if regressions:
+            print(f"Langsamere Importe als in der Baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+"""Incremental ingestion of the MVG-Rad csv files into a persisted store of cleaned data.
+
+New or changed source files (MVG_Rad_Fahrten_*.csv) are detected via a manifest (size, modification
+time, content hash). Only those files run through the data_preprocessing pipeline. Every source file
+gets its own Parquet file with the cleaned trips, and every derived aggregate keeps one partial result
+per source file. Updating a source therefore replaces only its partials, the aggregates are merged
+when read. Re-running without changes does nothing.
+
+Layout of the store:
+    data_store/manifest.json
+    data_store/trips/<source>.parquet
+    data_store/sample/<source>.parquet (stratified sample of the trips, see sampling.py)
+    data_store/aggregates/{daily_counts,stations,district_stats,duration_sketches,district_flows}.parquet
+
+use: python ingestion.py [--source-dir .] [--store data_store] [--force]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+
+import pandas as pd
+
+import data_preprocessing as dp
+import district_cube as dcube
+import duration_stats as dstat
+import sampling as smp
+
+STORE_DIR = "data_store"
+SOURCE_PATTERN = "MVG_Rad_Fahrten_*.csv"
+AGGREGATES = ["daily_counts", "stations", "district_stats", "duration_sketches", "district_flows"]
+
+
+def _manifest_path(store:str) -> str:
+    return os.path.join(store, "manifest.json")
+
+
+def _trips_path(store:str, source:str) -> str:
+    return os.path.join(store, "trips", os.path.splitext(source)[0] + ".parquet")
+
+
+def _sample_path(store:str, source:str) -> str:
+    return os.path.join(store, "sample", os.path.splitext(source)[0] + ".parquet")
+
+
+def _aggregate_path(store:str, name:str) -> str:
+    return os.path.join(store, "aggregates", f"{name}.parquet")
+
+
+def _write_parquet(df:pd.DataFrame, path:str) -> None:
+    """Writes a Parquet file atomically (temporary file + rename), so readers never see half-written files."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+
+
+def file_hash(path:str) -> str:
+    """Calculates the sha256 hash of a file in chunks.
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 ** 2), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_manifest(store:str=STORE_DIR) -> dict:
+    """Reads the manifest of the store.
+
+    Args:
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        dict: {source file name: {"size", "mtime", "sha256", "rows", "ingested_at"}}, empty if no store exists
+    """
+    if not os.path.exists(_manifest_path(store)):
+        return {}
+    with open(_manifest_path(store)) as file:
+        return json.load(file)
+
+
+def _write_manifest(manifest:dict, store:str) -> None:
+    os.makedirs(store, exist_ok=True)
+    with open(_manifest_path(store) + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(_manifest_path(store) + ".tmp", _manifest_path(store))
+
+
+def find_changes(source_dir:str=".", store:str=STORE_DIR) -> list:
+    """Detects source files that are new or whose content changed since the last ingestion.
+    The hash is only calculated if size or modification time differ from the manifest.
+
+    Args:
+        source_dir (str, optional): directory with the csv files. Defaults to ".".
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        list: paths of the new or changed source files, sorted by name
+    """
+    manifest = read_manifest(store)
+    changed = []
+    touched = False
+    for path in sorted(glob.glob(os.path.join(source_dir, SOURCE_PATTERN))):
+        entry = manifest.get(os.path.basename(path))
+        stat = os.stat(path)
+        if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            continue
+        if entry and entry["size"] == stat.st_size and entry["sha256"] == file_hash(path):
+            # nur der Zeitstempel hat sich geändert (z.B. erneut heruntergeladen): neuen Zeitstempel merken,
+            # damit die Datei beim nächsten Lauf nicht wieder gehasht wird
+            entry["mtime"] = stat.st_mtime
+            touched = True
+            continue
+        changed.append(path)
+    if touched:
+        _write_manifest(manifest, store)
+    return changed
+
+
+## Teilaggregate je Quelldatei
+
+def daily_counts(df:pd.DataFrame) -> pd.DataFrame:
+    """Number of rides per day and start district.
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with STARTTIME and CITY_DISTRICT_START
+
+    Returns:
+        pd.DataFrame: columns DATE, CITY_DISTRICT_START, RIDES
+    """
+    # dropna=False: Fahrten außerhalb der Stadtviertel zählen für die Gesamtzahl mit
+    counts = df.groupby([df["STARTTIME"].dt.normalize().rename("DATE"), "CITY_DISTRICT_START"], dropna=False).size()
+    return counts.rename("RIDES").reset_index()
+
+
+def station_registry(df:pd.DataFrame) -> pd.DataFrame:
+    """Registry of all stations with coordinates of the first use, first/last use and number of rentals and returns.
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with station and coordinate columns
+
+    Returns:
+        pd.DataFrame: columns STATION_NAME, LAT, LON, FIRST_SEEN, LAST_SEEN, RENTALS, RETURNS
+    """
+    rentals = df.loc[df["RENTAL_IS_STATION"] == 1, ["RENTAL_STATION_NAME", "STARTLAT", "STARTLON", "STARTTIME"]]
+    rentals.columns = ["STATION_NAME", "LAT", "LON", "TIME"]
+    returns = df.loc[df["RETURN_IS_STATION"] == 1, ["RETURN_STATION_NAME", "ENDLAT", "ENDLON", "ENDTIME"]]
+    returns.columns = ["STATION_NAME", "LAT", "LON", "TIME"]
+    events = pd.concat([rentals.assign(RENTALS=1, RETURNS=0), returns.assign(RENTALS=0, RETURNS=1)])
+    events = events[events["STATION_NAME"] != ""].sort_values("TIME")
+
+    return events.groupby("STATION_NAME").agg(LAT=("LAT", "first"), LON=("LON", "first"), FIRST_SEEN=("TIME", "min"),
+                                              LAST_SEEN=("TIME", "max"), RENTALS=("RENTALS", "sum"),
+                                              RETURNS=("RETURNS", "sum")).reset_index()
+
+
+def district_stats(df:pd.DataFrame) -> pd.DataFrame:
+    """Starts, ends, total duration and station rentals/returns per city district (sums, so they can be merged).
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame
+
+    Returns:
+        pd.DataFrame: columns CITY_DISTRICT, STARTS, ENDS, DURATION_SECONDS, STATION_RENTALS, STATION_RETURNS
+    """
+    starts = df.groupby("CITY_DISTRICT_START").agg(STARTS=("STARTTIME", "size"),
+                                                   DURATION_SECONDS=("DURATION", lambda d: d.dt.total_seconds().sum()),
+                                                   STATION_RENTALS=("RENTAL_IS_STATION", "sum"))
+    ends = df.groupby("CITY_DISTRICT_END").agg(ENDS=("ENDTIME", "size"), STATION_RETURNS=("RETURN_IS_STATION", "sum"))
+    stats = starts.join(ends, how="outer").fillna(0)
+    stats.index.name = "CITY_DISTRICT"
+    return stats.reset_index().astype({"STARTS": "int64", "ENDS": "int64", "STATION_RENTALS": "int64", "STATION_RETURNS": "int64"})
+
+
+PARTIAL_AGGREGATES = {"daily_counts": daily_counts, "stations": station_registry, "district_stats": district_stats,
+                      "duration_sketches": dstat.build_sketches, "district_flows": dcube.build_flows}
+
+
+def _replace_partial(store:str, name:str, source:str, partial:pd.DataFrame) -> None:
+    """Replaces the partial result of one source file in an aggregate."""
+    path = _aggregate_path(store, name)
+    partial = partial.assign(SOURCE=source)
+    if os.path.exists(path):
+        existing = pd.read_parquet(path)
+        partial = pd.concat([existing[existing["SOURCE"] != source], partial], ignore_index=True)
+    _write_parquet(partial, path)
+
+
+def ingest_file(path:str, store:str=STORE_DIR) -> int:
+    """Runs one source file through the pipeline, writes its cleaned trips and replaces its partial aggregates.
+
+    Args:
+        path (str): path of the csv file
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        int: number of cleaned rows
+    """
+    source = os.path.basename(path)
+    df = dp.format_files(dp.read_file(path))
+    df = df.sort_values("STARTTIME").reset_index(drop=True)
+
+    _write_parquet(df, _trips_path(store, source))
+    _write_parquet(smp.stratified_sample(df, label=source), _sample_path(store, source))
+    for name, aggregate in PARTIAL_AGGREGATES.items():
+        _replace_partial(store, name, source, aggregate(df))
+
+    # Manifest zuletzt aktualisieren: bricht die Verarbeitung ab, wird die Datei beim nächsten Lauf erneut verarbeitet
+    stat = os.stat(path)
+    manifest = read_manifest(store)
+    manifest[source] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_hash(path),
+                        "rows": len(df), "ingested_at": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    _write_manifest(manifest, store)
+
+    return len(df)
+
+
+def ingest(source_dir:str=".", store:str=STORE_DIR, force:bool=False) -> dict:
+    """Ingests all new or changed source files (all files with force=True).
+
+    Args:
+        source_dir (str, optional): directory with the csv files. Defaults to ".".
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+        force (bool, optional): reprocess all source files. Defaults to False.
+
+    Returns:
+        dict: {source file name: number of cleaned rows} of the processed files
+    """
+    paths = sorted(glob.glob(os.path.join(source_dir, SOURCE_PATTERN))) if force else find_changes(source_dir, store)
+    return {os.path.basename(path): ingest_file(path, store) for path in paths}
+
+
+## Lesen aus dem Speicher
+
+def store_exists(store:str=STORE_DIR) -> bool:
+    """Checks whether the store contains ingested data."""
+    return bool(read_manifest(store))
+
+
+def has_aggregate(name:str, store:str=STORE_DIR) -> bool:
+    """Checks whether an aggregate exists (stores created by older versions may lack newer aggregates, use --force)."""
+    return os.path.exists(_aggregate_path(store, name))
+
+
+def dataset_version(store:str=STORE_DIR) -> str:
+    """Short hash of the manifest. Changes whenever a source file is (re-)ingested, usable as part of cache keys."""
+    manifest = read_manifest(store)
+    content = json.dumps({source: entry["sha256"] for source, entry in manifest.items()}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def available_years(store:str=STORE_DIR) -> list:
+    """Years of the ingested source files (from the file names MVG_Rad_Fahrten_<year>.csv).
+
+    Args:
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        list: sorted years
+    """
+    years = []
+    for source in read_manifest(store):
+        year = os.path.splitext(source)[0].rsplit("_", 1)[-1]
+        if year.isdigit():
+            years.append(int(year))
+    return sorted(years)
+
+
+def load_trips(columns:list=None, store:str=STORE_DIR, filters:list=None) -> pd.DataFrame:
+    """Reads the cleaned trips of all ingested source files.
+
+    Args:
+        columns (list, optional): columns to read, all if None
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+        filters (list, optional): pyarrow row filters, e.g. [("STARTTIME", ">=", pd.Timestamp(2022, 1, 1))]
+
+    Returns:
+        pd.DataFrame: cleaned trips
+    """
+    paths = [_trips_path(store, source) for source in sorted(read_manifest(store))]
+    return pd.concat([pd.read_parquet(path, columns=columns, filters=filters) for path in paths], ignore_index=True)
+
+
+def has_sample(store:str=STORE_DIR) -> bool:
+    """Checks whether the store contains the stratified samples of all source files (older stores: use --force)."""
+    sources = read_manifest(store)
+    return bool(sources) and all(os.path.exists(_sample_path(store, source)) for source in sources)
+
+
+def load_sample(columns:list=None, store:str=STORE_DIR) -> pd.DataFrame:
+    """Reads the stratified samples of all ingested source files (see sampling.py).
+
+    Args:
+        columns (list, optional): columns to read, all if None
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        pd.DataFrame: sampled trips with the stratum columns and SAMPLE_WEIGHT
+    """
+    paths = [_sample_path(store, source) for source in sorted(read_manifest(store))]
+    return pd.concat([pd.read_parquet(path, columns=columns) for path in paths], ignore_index=True)
+
+
+def load_aggregate(name:str, store:str=STORE_DIR) -> pd.DataFrame:
+    """Reads an aggregate and merges the partial results of all source files.
+
+    Args:
+        name (str): "daily_counts", "stations", "district_stats", "duration_sketches" or "district_flows"
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        pd.DataFrame: merged aggregate
+    """
+    partials = pd.read_parquet(_aggregate_path(store, name)).drop(columns="SOURCE")
+
+    if name == "daily_counts":
+        return partials.groupby(["DATE", "CITY_DISTRICT_START"], as_index=False, dropna=False)["RIDES"].sum()
+    if name == "stations":
+        partials = partials.sort_values("FIRST_SEEN")
+        return partials.groupby("STATION_NAME").agg(LAT=("LAT", "first"), LON=("LON", "first"), FIRST_SEEN=("FIRST_SEEN", "min"),
+                                                    LAST_SEEN=("LAST_SEEN", "max"), RENTALS=("RENTALS", "sum"),
+                                                    RETURNS=("RETURNS", "sum")).reset_index()
+    if name == "district_stats":
+        return partials.groupby("CITY_DISTRICT", as_index=False).sum()
+    if name == "duration_sketches":
+        return dstat.merge_sketches(partials)
+    if name == "district_flows":
+        return dcube.merge_flows(partials)
+    raise ValueError(f"Unbekanntes Aggregat: {name}")
+
+
+def load_cleaned(start_year:int=None, end_year:int=None, store:str=STORE_DIR) -> pd.DataFrame:
+    """Cleaned trips from the store if it exists, otherwise read and formatted from the csv files.
+
+    Args:
+        start_year (int, optional): year to start with (by start time in the store). Defaults to all years of
+            the store, without store to 2020.
+        end_year (int, optional): year to end with. Defaults to all years of the store, without store to 2023.
+        store (str, optional): directory of the store. Defaults to STORE_DIR.
+
+    Returns:
+        pd.DataFrame: cleaned trips
+    """
+    if store_exists(store):
+        filters = []
+        if start_year is not None:
+            filters.append(("STARTTIME", ">=", pd.Timestamp(start_year, 1, 1)))
+        if end_year is not None:
+            filters.append(("STARTTIME", "<", pd.Timestamp(end_year + 1, 1, 1)))
+        return load_trips(store=store, filters=filters or None)
+    return dp.format_files(dp.read_files(start_year=start_year or 2020, end_year=end_year or 2023))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inkrementelles Einlesen neuer oder geänderter MVG-Rad-Dateien.")
+    parser.add_argument("--source-dir", default=".", help="Verzeichnis mit den csv-Dateien")
+    parser.add_argument("--store", default=STORE_DIR, help="Verzeichnis des Datenspeichers")
+    parser.add_argument("--force", action="store_true", help="alle Dateien neu verarbeiten")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    processed = ingest(args.source_dir, args.store, args.force)
+    if not processed:
+        print("Keine neuen oder geänderten Dateien.")
+    for source, rows in processed.items():
+        print(f"{source}: {rows} Zeilen")
+    print(f"Fertig in {time.perf_counter() - start:.1f} s, Datenstand {dataset_version(args.store)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""Load test of the Streamlit app with concurrent sessions on a synthetic dataset.
+
+Every session is a headless app run (streamlit.testing.v1.AppTest) in a thread of this process, so all
+sessions share the caches of one server process (st.cache_data / st.cache_resource, map cache, layer cache)
+like real users of one server. The sessions follow scripted flows (time series + Prophet, month map, day
+map, district view) with random selections from a small set, so that repeated selections hit the caches.
+
+Reported: latency percentiles per interaction, peak memory of the process and cache hit rates. Results can
+be saved as baseline and compared later to catch regressions (p95 latency per interaction).
+
+The synthetic dataset (csv files in the MVG-Rad format, neighbourhoods.geojson, city_area.geojson) is
+generated into --data-dir and ingested into a data store there; the app runs with --data-dir as working
+directory. With --service the sessions run as thin clients of a query service (see query_service.py)
+started in a background thread of this process.
+
+use: python load_test.py [--sessions 20] [--iterations 2] [--flows monate tage] [--save baseline.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+import artifact_cache
+import ingestion as ing
+import map_layers as ml
+
+APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "streamlit_main.py")
+DATA_DIR = "load_test_data"
+APP_TIMEOUT = 600
+
+# Ausschnitt um München für die synthetischen Koordinaten (Breite, Länge)
+LAT_RANGE = (48.06, 48.25)
+LON_RANGE = (11.36, 11.72)
+
+
+## Synthetischer Datensatz
+
+def _polygon(lat_min:float, lat_max:float, lon_min:float, lon_max:float) -> dict:
+    return {"type": "Polygon", "coordinates": [[[lon_min, lat_min], [lon_max, lat_min], [lon_max, lat_max],
+                                                [lon_min, lat_max], [lon_min, lat_min]]]}
+
+
+def write_geojson_files(out_dir:str, grid:int=5) -> None:
+    """Writes synthetic city districts (grid x grid rectangles "Viertel <i>") and a central city area."""
+    lats = np.linspace(*LAT_RANGE, grid + 1)
+    lons = np.linspace(*LON_RANGE, grid + 1)
+    features = [{"type": "Feature", "properties": {"neighbourhood": f"Viertel {row * grid + column}", "neighbourhood_group": None},
+                 "geometry": _polygon(lats[row], lats[row + 1], lons[column], lons[column + 1])}
+                for row in range(grid) for column in range(grid)]
+    with open(os.path.join(out_dir, "neighbourhoods.geojson"), "w") as file:
+        json.dump({"type": "FeatureCollection", "features": features}, file)
+
+    city_area = {"type": "Feature", "properties": {}, "geometry": _polygon(48.10, 48.20, 11.48, 11.64)}
+    with open(os.path.join(out_dir, "city_area.geojson"), "w") as file:
+        json.dump({"type": "FeatureCollection", "features": [city_area]}, file)
+
+
+def write_trip_file(path:str, year:int, trips:int, stations:list, rng:np.random.Generator) -> None:
+    """Writes one csv file with synthetic trips in the format of the MVG-Rad files (";", decimal comma,
+    padded column names and station names)."""
+    start = pd.Timestamp(f"{year}-01-01") + pd.to_timedelta(np.sort(rng.random(trips)) * 365 * 86400, unit="s")
+    start = start.floor("min")
+    end = start + pd.to_timedelta(rng.gamma(2, 8, trips).astype(int) + 1, unit="m")
+
+    def coordinates(is_station, station_index):
+        lat = np.where(is_station, stations[station_index, 0], rng.uniform(*LAT_RANGE, trips))
+        lon = np.where(is_station, stations[station_index, 1], rng.uniform(*LON_RANGE, trips))
+        return lat, lon
+
+    def names(is_station, station_index):
+        return np.where(is_station, np.char.add(np.char.add(" Station ", station_index.astype(str)), "   "), " ")
+
+    def decimal_comma(values):
+        return np.char.replace(np.char.mod("%.5f", values), ".", ",")
+
+    rental_is_station, return_is_station = rng.random(trips) < 0.3, rng.random(trips) < 0.3
+    rental_station, return_station = rng.integers(0, len(stations), trips), rng.integers(0, len(stations), trips)
+    start_lat, start_lon = coordinates(rental_is_station, rental_station)
+    end_lat, end_lon = coordinates(return_is_station, return_station)
+
+    pd.DataFrame({
+        "Row": np.arange(1, trips + 1),
+        "STARTTIME       ": start.strftime("%Y-%m-%d %H:%M"),
+        "ENDTIME         ": end.strftime("%Y-%m-%d %H:%M"),
+        "STARTLAT": decimal_comma(start_lat), "STARTLON": decimal_comma(start_lon),
+        "ENDLAT": decimal_comma(end_lat), "ENDLON": decimal_comma(end_lon),
+        "RENTAL_IS_STATION": rental_is_station.astype(int), "RENTAL_STATION_NAME": names(rental_is_station, rental_station),
+        "RETURN_IS_STATION": return_is_station.astype(int), "RETURN_STATION_NAME": names(return_is_station, return_station),
+    }).to_csv(path, sep=";", index=False)
+
+
+def make_dataset(out_dir:str=DATA_DIR, years:list=(2022, 2023), trips_per_year:int=20_000, n_stations:int=40,
+                 seed:int=0, store:bool=True) -> None:
+    """Generates the synthetic dataset and (optionally) ingests it into a data store in out_dir.
+
+    Args:
+        out_dir (str, optional): output directory. Defaults to DATA_DIR.
+        years (list, optional): years, one csv file each. Defaults to (2022, 2023).
+        trips_per_year (int, optional): trips per file. Defaults to 20_000.
+        n_stations (int, optional): number of stations. Defaults to 40.
+        seed (int, optional): seed of the random generator. Defaults to 0.
+        store (bool, optional): ingest into out_dir/data_store, otherwise the app reads the csv files. Defaults to True.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    stations = np.column_stack([rng.uniform(48.10, 48.20, n_stations), rng.uniform(11.50, 11.65, n_stations)])
+
+    write_geojson_files(out_dir)
+    shutil.copy(os.path.join(os.path.dirname(APP), "bavarian_holidays.csv"), out_dir)
+    for year in years:
+        write_trip_file(os.path.join(out_dir, f"MVG_Rad_Fahrten_{year}.csv"), year, trips_per_year, stations, rng)
+
+    if store:
+        # Die Pipeline liest die geojson-Dateien relativ zum Arbeitsverzeichnis
+        cwd = os.getcwd()
+        os.chdir(out_dir)
+        try:
+            ing.ingest(".", ing.STORE_DIR, force=True)
+        finally:
+            os.chdir(cwd)
+
+
+## Abläufe einer Sitzung
+
+def _sidebar_button(at, label:str):
+    return next(button for button in at.sidebar.button if button.label == label)
+
+
+def _button(at, key:str):
+    return next(button for button in at.button if button.key == key)
+
+
+def _widget(elements, label:str):
+    return next(element for element in elements if element.label == label)
+
+
+def step_start(at, rng, years):
+    return at.run()
+
+
+def step_time_series(at, rng, years):
+    return _sidebar_button(at, "Zeitreihenanalyse starten").click().run()
+
+
+def step_forecast_view(at, rng, years):
+    return _sidebar_button(at, "Prophet-Vorhersage").click().run()
+
+
+def step_open_months(at, rng, years):
+    return _sidebar_button(at, "Überblick nach Monaten").click().run()
+
+
+def step_month_map(at, rng, years):
+    # kleine Auswahl an Kombinationen, damit sich Sitzungen wie echte Nutzer teilweise wiederholen
+    at.multiselect[0].set_value(rng.choice([years[-1:], years]))
+    at.multiselect[1].set_value(rng.choice([[6], [6, 7, 8], list(range(1, 13))]))
+    _widget(at.checkbox, "Heatmap").set_value(rng.random() < 0.5)
+    _widget(at.checkbox, "Stationen").set_value(rng.random() < 0.5)
+    return _button(at, "map_months").click().run()
+
+
+def step_open_days(at, rng, years):
+    return _sidebar_button(at, "Detailansicht nach Tagen").click().run()
+
+
+def step_day_map(at, rng, years):
+    start = date(years[-1], rng.choice([3, 6, 9]), 1)
+    at.date_input[0].set_value(start)
+    at.date_input[1].set_value(start + timedelta(days=rng.choice([0, 2, 6])))
+    at.run()
+    _widget(at.checkbox, "Startpunkte").set_value(True)
+    _widget(at.checkbox, "Endpunkte").set_value(rng.random() < 0.5)
+    return _button(at, "map_days").click().run()
+
+
+def step_open_districts(at, rng, years):
+    return _sidebar_button(at, "Stadtviertel im Wochenverlauf").click().run()
+
+
+def step_district_measure(at, rng, years):
+    return _widget(at.radio, "Kennzahl:").set_value(rng.choice(["Starts", "Enden", "Nettofluss (Enden - Starts)"])).run()
+
+
+# Abläufe: Name -> Schritte (Name der Interaktion, Funktion)
+FLOWS = {
+    "zeitreihe": [("zeitreihe_starten", step_time_series), ("prophet_ansicht", step_forecast_view)],
+    "monate": [("monate_oeffnen", step_open_months), ("monatskarte", step_month_map), ("monatskarte_2", step_month_map)],
+    "tage": [("tage_oeffnen", step_open_days), ("tageskarte", step_day_map)],
+    "viertel": [("viertel_oeffnen", step_open_districts), ("viertel_kennzahl", step_district_measure)],
+}
+
+
+# Streamlit-Version, für die use_shared_runtime geschrieben ist (wie in requirements.txt)
+SHARED_RUNTIME_STREAMLIT = "1.29.0"
+
+
+def check_streamlit_internals() -> None:
+    """Fails loudly if the Streamlit internals patched by use_shared_runtime have changed.
+
+    Raises:
+        RuntimeError: other Streamlit version, or Runtime.instance / Runtime.exists / the ScriptCache of
+            LocalScriptRunner / the runtime handling of AppTest no longer look as expected
+    """
+    import inspect
+    import streamlit
+    from streamlit.runtime import Runtime
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    problems = []
+    if streamlit.__version__ != SHARED_RUNTIME_STREAMLIT:
+        problems.append(f"Streamlit {streamlit.__version__} statt {SHARED_RUNTIME_STREAMLIT}")
+    for name in ("instance", "exists"):
+        if not isinstance(inspect.getattr_static(Runtime, name, None), classmethod):
+            problems.append(f"Runtime.{name} ist keine Klassenmethode mehr")
+    if "ScriptCache()" not in inspect.getsource(local_script_runner.LocalScriptRunner.__init__):
+        problems.append("LocalScriptRunner erzeugt keinen eigenen ScriptCache mehr")
+    if "Runtime._instance" not in inspect.getsource(app_test.AppTest._run):
+        problems.append("AppTest setzt Runtime._instance nicht mehr")
+    if problems:
+        raise RuntimeError("use_shared_runtime passt nicht zu dieser Streamlit-Version (" + "; ".join(problems) +
+                           "), bitte prüfen und SHARED_RUNTIME_STREAMLIT anpassen")
+
+
+def use_shared_runtime() -> None:
+    """AppTest sets the global Streamlit runtime for every run and removes it afterwards, which breaks runs
+    in parallel threads. For the load test all sessions use one runtime (media files, cache storage), like
+    the sessions of one server process. Like the server, all runs share one script cache: AppTest compiles
+    the script anew for every run (also for every st.rerun), and parallel compiles in threads can fail
+    in Python 3.11 ("AST constructor recursion depth mismatch").
+
+    This patches private parts of Streamlit (Runtime.instance, Runtime.exists, the ScriptCache of
+    LocalScriptRunner); check_streamlit_internals stops the load test if they change with an upgrade.
+    """
+    check_streamlit_internals()
+
+    from unittest.mock import MagicMock
+    from streamlit.runtime import Runtime
+    from streamlit.runtime.caching.storage.dummy_cache_storage import MemoryCacheStorageManager
+    from streamlit.runtime.media_file_manager import MediaFileManager
+    from streamlit.runtime.memory_media_file_storage import MemoryMediaFileStorage
+    from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+    from streamlit.testing.v1 import local_script_runner
+
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = MediaFileManager(MemoryMediaFileStorage("/mock/media"))
+    runtime.cache_storage_manager = MemoryCacheStorageManager()
+    Runtime.instance = classmethod(lambda cls: runtime)
+    Runtime.exists = classmethod(lambda cls: True)
+    script_cache = ScriptCache()
+    local_script_runner.ScriptCache = lambda: script_cache
+
+
+def run_session(session:int, flows:list, iterations:int, years:list, seed:int=0) -> list:
+    """Runs one session: app start, then iterations x the flows in random order.
+
+    Returns:
+        list: one dict per interaction with session, flow, step, seconds, error
+    """
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(seed * 1000 + session)
+    at = AppTest.from_file(APP, default_timeout=APP_TIMEOUT)
+    plan = [("start", "start", step_start)]
+    for _ in range(iterations):
+        for flow in rng.sample(flows, len(flows)):
+            plan += [(flow, step, function) for step, function in FLOWS[flow]]
+
+    results = []
+    for flow, step, function in plan:
+        start = time.perf_counter()
+        try:
+            at = function(at, rng, years)
+            error = "; ".join(str(exception.message) for exception in at.exception) or None
+        except Exception as exception:  # Fehler einer Sitzung sollen den Lasttest nicht abbrechen
+            error = repr(exception)
+        results.append({"session": session, "flow": flow, "step": step, "seconds": time.perf_counter() - start, "error": error})
+    return results
+
+
+## Messung und Auswertung
+
+class MemorySampler:
+    """Samples the resident memory of the process in a background thread (peak RSS during the test)."""
+
+    def __init__(self, interval:float=0.05):
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def current_bytes() -> int:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_bytes = max(self.peak_bytes, self.current_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+
+
+def latency_table(results:list) -> pd.DataFrame:
+    """Latency percentiles in ms and number of errors per interaction."""
+    frame = pd.DataFrame(results)
+    grouped = frame.groupby("step", sort=False)
+    table = grouped["seconds"].describe(percentiles=[0.5, 0.9, 0.95, 0.99])[["count", "50%", "90%", "95%", "99%", "max"]]
+    table[["50%", "90%", "95%", "99%", "max"]] *= 1000
+    table["errors"] = grouped["error"].count()
+    return table.rename(columns={"50%": "p50_ms", "90%": "p90_ms", "95%": "p95_ms", "99%": "p99_ms", "max": "max_ms"})
+
+
+def cache_report() -> dict:
+    """Hit rates of the map cache(s) and of the cached GeoJSON layers."""
+    report = {name: cache.stats() for name, cache in artifact_cache.registered_caches().items()}
+    info = ml.layer_geojson.cache_info()
+    requests = info.hits + info.misses
+    report["layer_geojson"] = {"hits": info.hits, "misses": info.misses, "entries": info.currsize,
+                               "hit_rate": info.hits / requests if requests else 0.0}
+    return report
+
+
+def compare_reports(table:pd.DataFrame, baseline:dict, tolerance:float=0.2) -> list:
+    """Interactions whose p95 latency increased by more than the tolerance compared to a baseline {step: p95_ms}."""
+    return [step for step, p95 in table["p95_ms"].items() if baseline.get(step) and p95 > baseline[step] * (1 + tolerance)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lasttest der Streamlit-App mit parallelen Sitzungen.")
+    parser.add_argument("--sessions", type=int, default=20, help="Anzahl paralleler Sitzungen")
+    parser.add_argument("--iterations", type=int, default=2, help="Wiederholungen der Abläufe je Sitzung")
+    parser.add_argument("--flows", nargs="+", choices=list(FLOWS), default=list(FLOWS), help="Abläufe der Sitzungen")
+    parser.add_argument("--data-dir", default=DATA_DIR, help="Verzeichnis des synthetischen Datensatzes")
+    parser.add_argument("--years", nargs="+", type=int, default=[2022, 2023], help="Jahre des Datensatzes")
+    parser.add_argument("--trips-per-year", type=int, default=20_000, help="Fahrten je Jahr")
+    parser.add_argument("--no-store", action="store_true", help="ohne Datenspeicher (App liest die csv-Dateien)")
+    parser.add_argument("--regenerate", action="store_true", help="Datensatz neu erzeugen")
+    parser.add_argument("--seed", type=int, default=0, help="Startwert der Zufallsauswahl")
+    parser.add_argument("--save", help="p95-Latenzen als Baseline (JSON) speichern")
+    parser.add_argument("--compare", help="mit gespeicherter Baseline (JSON) vergleichen")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="erlaubte relative Verschlechterung")
+    parser.add_argument("--service", action="store_true", help="Sitzungen als Clients eines lokalen Abfragedienstes")
+    args = parser.parse_args()
+
+    if args.regenerate and os.path.exists(args.data_dir):
+        shutil.rmtree(args.data_dir)
+    if not os.path.exists(args.data_dir):
+        print(f"Erzeuge synthetischen Datensatz in {args.data_dir} ...")
+        make_dataset(args.data_dir, args.years, args.trips_per_year, seed=args.seed, store=not args.no_store)
+
+    save, compare = [os.path.abspath(path) if path else None for path in (args.save, args.compare)]
+    # Die App liest alle Dateien relativ zum Arbeitsverzeichnis
+    os.chdir(args.data_dir)
+    memory_before = MemorySampler.current_bytes()
+
+    if args.service:
+        import query_service as qs
+
+        # Stand-in-Dienst im selben Prozess, die App liest die Adresse aus der Umgebungsvariable
+        years = {"start_year": min(args.years), "end_year": max(args.years)} if args.no_store else {}
+        server = qs.serve_in_background(qs.QueryBackend(**years))
+        os.environ[qs.ENV_VARIABLE] = server.url
+        print(f"Abfragedienst: {server.url}")
+
+    use_shared_runtime()
+    start = time.perf_counter()
+    with MemorySampler() as memory, ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        futures = [executor.submit(run_session, session, args.flows, args.iterations, args.years, args.seed)
+                   for session in range(args.sessions)]
+        results = [result for future in futures for result in future.result()]
+    duration = time.perf_counter() - start
+
+    table = latency_table(results)
+    print(f"{args.sessions} Sitzungen, {len(results)} Interaktionen in {duration:.1f} s")
+    print(table.round(1).to_string())
+    print(f"Speicher: {memory_before / 1024 ** 2:.0f} MB vor dem Test, Spitze {memory.peak_bytes / 1024 ** 2:.0f} MB "
+          f"(max. RSS des Prozesses {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB)")
+    for name, stats in cache_report().items():
+        print(f"Cache {name}: Trefferquote {stats['hit_rate']:.0%} ({stats['hits']} Treffer, {stats['misses']} Fehlzugriffe, "
+              f"{stats['entries']} Einträge)")
+
+    errors = [result for result in results if result["error"]]
+    for error in errors[:5]:
+        print(f"Fehler in Sitzung {error['session']}, {error['step']}: {error['error']}", file=sys.stderr)
+
+    if save:
+        with open(save, "w") as file:
+            json.dump(table["p95_ms"].round(1).to_dict(), file, indent=2)
+
+    if compare:
+        with open(compare) as file:
+            baseline = json.load(file)
+        regressions = compare_reports(table, baseline, args.tolerance)
+        if regressions:
+            print(f"Langsamere Interaktionen als in der Baseline (p95): {', '.join(regressions)}")
+            sys.exit(1)
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
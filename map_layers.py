@@ -0,0 +1,207 @@
+"""Cached, pre-simplified GeoJSON overlays for the folium maps (city districts, city area).
+
+The polygons are simplified once per zoom level, their coordinates are quantized and the result
+is serialized to a compact GeoJSON string. The string is kept in a process-wide cache, so it is
+reused across reruns and Streamlit sessions instead of re-serializing the GeoDataFrame every time.
+
+use: python map_layers.py (prints size and build time of raw vs. cached layers)
+"""
+import json
+import math
+import time
+from functools import lru_cache
+
+# Größe eines Pixels in Metern am Äquator bei Zoomstufe 0 (Web-Mercator-Kacheln mit 256 px)
+METERS_PER_PIXEL_ZOOM_0 = 156543.03392
+METERS_PER_DEGREE = 111320
+MUNICH_LATITUDE = 48.137154
+
+# Eigenschaften, die für die Overlays gebraucht werden (Tooltips / Zuordnung)
+LAYER_PROPERTIES = {
+    "neighbourhoods.geojson": ["neighbourhood"],
+    "city_area.geojson": [],
+}
+
+
+def tolerance_for_zoom(zoom:int, pixels:float=0.5, latitude:float=MUNICH_LATITUDE) -> float:
+    """Calculates a simplification tolerance in degrees that is not visible at the given zoom level.
+
+    Args:
+        zoom (int): Leaflet zoom level of the map
+        pixels (float, optional): maximum allowed deviation on screen in pixels. Defaults to 0.5.
+        latitude (float, optional): latitude used for the scale of the map. Defaults to Munich city centre.
+
+    Returns:
+        float: tolerance in degrees
+    """
+    meters_per_pixel = METERS_PER_PIXEL_ZOOM_0 * math.cos(math.radians(latitude)) / 2 ** zoom
+    return meters_per_pixel * pixels / METERS_PER_DEGREE
+
+
+def precision_for_zoom(zoom:int) -> int:
+    """Number of decimal places that are still relevant at the given zoom level (5 decimals = approx. 1 metre).
+
+    Args:
+        zoom (int): Leaflet zoom level of the map
+
+    Returns:
+        int: number of decimal places for the coordinates
+    """
+    return min(6, max(3, math.ceil(-math.log10(tolerance_for_zoom(zoom)))))
+
+
+def round_coordinates(coordinates, precision:int):
+    """Rounds nested GeoJSON coordinate lists and drops consecutive duplicates created by the rounding.
+
+    Args:
+        coordinates: GeoJSON coordinates (position or nested lists of positions)
+        precision (int): number of decimal places
+
+    Returns:
+        list: rounded coordinates
+    """
+    if isinstance(coordinates[0], (int, float)):
+        return [round(value, precision) for value in coordinates]
+    rounded = [round_coordinates(part, precision) for part in coordinates]
+    if isinstance(rounded[0][0], (int, float)):
+        # Ring bzw. Linie: doppelte aufeinanderfolgende Punkte entfernen, Ring bleibt geschlossen
+        deduplicated = [rounded[0]] + [point for previous, point in zip(rounded, rounded[1:]) if point != previous]
+        if len(deduplicated) >= 4 or len(deduplicated) == len(rounded):
+            return deduplicated
+    return rounded
+
+
+def simplify_coverage(geometries, tolerance:float) -> list:
+    """Simplifies polygons that share borders (a coverage, e.g. the city districts) without gaps or overlaps.
+
+    Simplifying every polygon on its own moves a shared border differently on both sides. Here the borders
+    are split into edges at the points where they meet, every edge is simplified once (end points fixed)
+    and the polygons are rebuilt from the simplified edges, so neighbours keep an identical border.
+    (shapely >= 2.1 offers the same as shapely.coverage_simplify.)
+
+    Args:
+        geometries: polygons / multipolygons (None or empty entries stay None)
+        tolerance (float): simplification tolerance in coordinate units
+
+    Returns:
+        list: simplified geometries in the order of the input
+    """
+    import numpy as np
+    import shapely
+
+    geometries = np.array(list(geometries), dtype=object)
+    valid = np.array([geometry is not None and not geometry.is_empty for geometry in geometries])
+    result = [None] * len(geometries)
+    if not valid.any():
+        return result
+
+    # Ränder vereinigen (gemeinsame Grenzen nur einmal, geteilt an Kreuzungspunkten) und zu Kanten zwischen den Knoten verbinden
+    edges = shapely.get_parts(shapely.line_merge(shapely.union_all(shapely.boundary(geometries[valid]))))
+    # nach dem Vereinfachen erneut vereinigen: fallen Kanten zusammen (schmale Splitter zwischen ungenau
+    # aneinanderliegenden Polygonen) oder kreuzen sie sich, entstehen daraus gültige Flächen
+    simplified = shapely.union_all(shapely.simplify(edges, tolerance, preserve_topology=True))
+    faces = shapely.get_parts(shapely.polygonize(shapely.get_parts(simplified)))
+
+    # Jede Fläche dem Polygon zuordnen, das sie zum größten Teil überdeckt (Löcher gehören zu keinem)
+    tree = shapely.STRtree(geometries[valid])
+    indices = np.flatnonzero(valid)
+    parts = {index: [] for index in indices}
+    for face in faces:
+        candidates = tree.query(face)
+        if len(candidates) == 0:
+            continue
+        areas = shapely.area(shapely.intersection(face, tree.geometries[candidates]))
+        best = areas.argmax()
+        if areas[best] > 0.5 * face.area:
+            parts[indices[candidates[best]]].append(face)
+    for index, polygons in parts.items():
+        if polygons:
+            result[index] = shapely.union_all(polygons)
+    return result
+
+
+@lru_cache(maxsize=16)
+def layer_geojson(path:str, zoom:int) -> str:
+    """Reads a GeoJSON file, simplifies it for the zoom level (as coverage, neighbouring polygons keep a common
+    border, see simplify_coverage), quantizes the coordinates and returns a compact GeoJSON string.
+    Cached per (path, zoom) for the lifetime of the process.
+
+    Args:
+        path (str): path of the GeoJSON file, e.g. "neighbourhoods.geojson"
+        zoom (int): Leaflet zoom level the layer is shown at
+
+    Returns:
+        str: compact GeoJSON FeatureCollection, can be passed to folium.GeoJson
+    """
+    import geopandas as gpd
+
+    gdf = gpd.read_file(path).to_crs(epsg=4326)
+    properties = LAYER_PROPERTIES.get(path, [column for column in gdf.columns if column != "geometry"])
+
+    # Vereinfachen, ohne dass Polygone ungültig werden oder zwischen Nachbarn Lücken / Überlappungen entstehen
+    geometry = simplify_coverage(gdf.geometry, tolerance_for_zoom(zoom))
+    precision = precision_for_zoom(zoom)
+
+    features = []
+    for (_, row), geom in zip(gdf.iterrows(), geometry):
+        if geom is None or geom.is_empty:
+            continue
+        geo = geom.__geo_interface__
+        features.append({
+            "type": "Feature",
+            "properties": {column: row[column] for column in properties},
+            "geometry": {"type": geo["type"], "coordinates": round_coordinates(geo["coordinates"], precision)},
+        })
+
+    return json.dumps({"type": "FeatureCollection", "features": features}, separators=(",", ":"), ensure_ascii=False)
+
+
+def layer_report(path:str, zoom:int) -> dict:
+    """Compares size and folium build time of the raw GeoDataFrame layer with the cached, simplified layer.
+
+    Args:
+        path (str): path of the GeoJSON file
+        zoom (int): Leaflet zoom level
+
+    Returns:
+        dict: sizes of the GeoJSON and the rendered map HTML in bytes, build times in milliseconds
+    """
+    import folium
+    import geopandas as gpd
+
+    def build_map(data):
+        start = time.perf_counter()
+        munich_map = folium.Map(location=[MUNICH_LATITUDE, 11.576124], zoom_start=zoom)
+        folium.GeoJson(data).add_to(munich_map)
+        html = munich_map.get_root().render()
+        return len(html.encode()), (time.perf_counter() - start) * 1000
+
+    raw = gpd.read_file(path)
+    raw_html_bytes, raw_ms = build_map(raw)
+
+    layer_geojson.cache_clear()
+    start = time.perf_counter()
+    compact = layer_geojson(path, zoom)
+    first_ms = (time.perf_counter() - start) * 1000
+    compact_html_bytes, compact_ms = build_map(layer_geojson(path, zoom))
+
+    return {
+        "layer": path,
+        "zoom": zoom,
+        "geojson_bytes_raw": len(raw.to_json().encode()),
+        "geojson_bytes_cached": len(compact.encode()),
+        "map_html_bytes_raw": raw_html_bytes,
+        "map_html_bytes_cached": compact_html_bytes,
+        "map_build_ms_raw": round(raw_ms, 1),
+        "map_build_ms_cached": round(compact_ms, 1),
+        "layer_preparation_ms_once": round(first_ms, 1),
+    }
+
+
+if __name__ == "__main__":
+    for layer in LAYER_PROPERTIES:
+        for zoom_level in (11, 12):
+            try:
+                print(layer_report(layer, zoom_level))
+            except Exception as error:  # z.B. fehlende neighbourhoods.geojson (nicht im Repository enthalten)
+                print(f"{layer}: {error}")
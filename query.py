@@ -0,0 +1,233 @@
+"""Embedded SQL query layer over the cleaned trips and aggregates (DuckDB, in-process).
+
+The views "trips", "daily_counts", "stations" and "district_stats" read the Parquet files of the data
+store (see ingestion.py) lazily. DuckDB pushes the selected columns and the filters into the Parquet
+scan, so a query only reads the needed columns and skips files/row groups outside the filter (the trip
+files are sorted by STARTTIME). Without a store, an in-memory DataFrame can be registered as "trips".
+
+use (e.g. in notebooks):
+    import query as q
+    q.query("SELECT CITY_DISTRICT_START, dayname(STARTTIME) AS WEEKDAY, count(*) AS RIDES FROM trips GROUP BY ALL")
+"""
+import os
+import threading
+from datetime import date, datetime, time, timedelta
+
+import duckdb
+import pandas as pd
+
+import ingestion as ing
+
+_connection = None
+_lock = threading.Lock()
+
+# Zusammenführen der Teilaggregate je Quelldatei (entspricht ing.load_aggregate)
+AGGREGATE_VIEWS = {
+    "daily_counts": "SELECT DATE, CITY_DISTRICT_START, sum(RIDES) AS RIDES FROM {source} GROUP BY ALL",
+    "stations": """SELECT STATION_NAME, arg_min(LAT, FIRST_SEEN) AS LAT, arg_min(LON, FIRST_SEEN) AS LON,
+                          min(FIRST_SEEN) AS FIRST_SEEN, max(LAST_SEEN) AS LAST_SEEN,
+                          sum(RENTALS) AS RENTALS, sum(RETURNS) AS RETURNS
+                   FROM {source} GROUP BY ALL""",
+    "district_stats": """SELECT CITY_DISTRICT, sum(STARTS) AS STARTS, sum(ENDS) AS ENDS, sum(DURATION_SECONDS) AS DURATION_SECONDS,
+                                sum(STATION_RENTALS) AS STATION_RENTALS, sum(STATION_RETURNS) AS STATION_RETURNS
+                         FROM {source} GROUP BY ALL""",
+    # alle Schlüsselspalten (END_DATE fehlt in Datenspeichern älterer Versionen)
+    "duration_sketches": "SELECT * EXCLUDE (SOURCE, COUNT), sum(COUNT) AS COUNT FROM {source} GROUP BY ALL",
+    "district_flows": """SELECT CITY_DISTRICT, YEAR, MONTH, HOUR_OF_WEEK, sum(STARTS) AS STARTS, sum(ENDS) AS ENDS
+                         FROM {source} GROUP BY ALL""",
+}
+
+
+def connect(store:str=ing.STORE_DIR, df:pd.DataFrame=None) -> duckdb.DuckDBPyConnection:
+    """Creates an in-memory DuckDB connection with views over the data store.
+
+    Args:
+        store (str, optional): directory of the store. Defaults to ing.STORE_DIR.
+        df (pd.DataFrame, optional): cleaned trips to register as "trips" if no store exists
+
+    Returns:
+        duckdb.DuckDBPyConnection: connection with the views trips, trips_sample, daily_counts, stations, district_stats,
+            duration_sketches, district_flows
+    """
+    con = duckdb.connect()
+    if ing.store_exists(store):
+        trips = os.path.join(store, "trips", "*.parquet")
+        # DURATION wird von Parquet als Integer gelesen, deshalb als INTERVAL neu berechnet (=> pd.Timedelta)
+        con.execute(f"CREATE VIEW trips AS SELECT * REPLACE (ENDTIME - STARTTIME AS DURATION) FROM read_parquet('{trips}')")
+        if ing.has_sample(store):
+            sample = os.path.join(store, "sample", "*.parquet")
+            con.execute(f"CREATE VIEW trips_sample AS SELECT * REPLACE (ENDTIME - STARTTIME AS DURATION) FROM read_parquet('{sample}')")
+        for name, sql in AGGREGATE_VIEWS.items():
+            path = os.path.join(store, "aggregates", name + ".parquet")
+            if not os.path.exists(path):
+                continue
+            source = f"read_parquet('{path}')"
+            con.execute(f"CREATE VIEW {name} AS {sql.format(source=source)}")
+    elif df is not None:
+        # als View über die Relation (ein mit register() angemeldeter DataFrame ist in Cursorn nicht sichtbar)
+        con.from_df(df).create_view("trips")
+    else:
+        raise FileNotFoundError(f"Kein Datenspeicher in {store}, bitte python ingestion.py ausführen oder df übergeben.")
+    return con
+
+
+def get_connection(store:str=ing.STORE_DIR, df:pd.DataFrame=None) -> duckdb.DuckDBPyConnection:
+    """Returns a cursor of the shared connection (created on first use). Cursors can be used in parallel threads.
+
+    Args:
+        store (str, optional): directory of the store. Defaults to ing.STORE_DIR.
+        df (pd.DataFrame, optional): cleaned trips to register if no store exists
+
+    Returns:
+        duckdb.DuckDBPyConnection: cursor of the shared connection
+    """
+    global _connection
+    with _lock:
+        if _connection is None:
+            _connection = connect(store, df)
+        return _connection.cursor()
+
+
+def reset_connection() -> None:
+    """Closes the shared connection, e.g. after new data has been ingested."""
+    global _connection
+    with _lock:
+        if _connection is not None:
+            _connection.close()
+        _connection = None
+
+
+def query(sql:str, params:list=None, con:duckdb.DuckDBPyConnection=None) -> pd.DataFrame:
+    """Runs a SQL query and returns the result as DataFrame.
+
+    Args:
+        sql (str): SQL query over trips, daily_counts, stations, district_stats; parameters as ?
+        params (list, optional): values for the ? placeholders
+        con (duckdb.DuckDBPyConnection, optional): connection, defaults to the shared connection
+
+    Returns:
+        pd.DataFrame: query result
+    """
+    con = con or get_connection()
+    return con.execute(sql, params or []).df()
+
+
+def _columns(columns:list) -> str:
+    return ", ".join(f'"{column}"' for column in columns) if columns else "*"
+
+
+def _day_key(day:date) -> int:
+    return day.year * 1000 + day.timetuple().tm_yday
+
+
+def _minute_of_day(daytime:time) -> int:
+    return daytime.hour * 60 + daytime.minute
+
+
+def months_filter(years:list, months:list) -> tuple:
+    """WHERE condition and parameters of the month selection (trips that start or end in one of the years
+    and in one of the months), shared by select_months and the export (see export.py).
+
+    Args:
+        years (list): years, e.g. [2022, 2023]
+        months (list): months 1-12
+
+    Returns:
+        tuple: (SQL condition with ? placeholders, parameters)
+    """
+    # Die ersten beiden Bedingungen folgen aus dem Rest (ENDTIME >= STARTTIME), sind aber einfache Vergleiche
+    # und werden deshalb in den Parquet-Scan übernommen (Überspringen von Dateien / Row Groups).
+    # Jahr und Monat als vorberechnete Integer-Spalten (dp.add_calendar_features) statt year()/month() je Zeile
+    condition = """STARTTIME < ? AND ENDTIME >= ?
+          AND (START_YEAR IN (SELECT unnest(?)) OR END_YEAR IN (SELECT unnest(?)))
+          AND (START_MONTH IN (SELECT unnest(?)) OR END_MONTH IN (SELECT unnest(?)))"""
+    params = [datetime(max(years) + 1, 1, 1), datetime(min(years), 1, 1), years, years, months, months]
+    return condition, params
+
+
+def days_filter(start:date, end:date, daytime:tuple=(time(0), time(23, 59, 59))) -> tuple:
+    """WHERE condition and parameters of the day selection (trips that start or end between two dates and
+    start or end within the time of day), shared by select_days and the export (see export.py).
+
+    Args:
+        start (date): first day
+        end (date): last day (inclusive)
+        daytime (tuple, optional): (from, to) time of day. Defaults to the whole day.
+
+    Returns:
+        tuple: (SQL condition with ? placeholders, parameters)
+    """
+    # Tag als YEAR * 1000 + DOY und Uhrzeit als Minute des Tages: reine Integer-Vergleiche auf den Kalenderspalten
+    condition = """STARTTIME < ? AND ENDTIME >= ?
+          AND ((START_YEAR::INTEGER * 1000 + START_DOY BETWEEN ? AND ?) OR (END_YEAR::INTEGER * 1000 + END_DOY BETWEEN ? AND ?))
+          AND ((START_MINUTE_OF_DAY BETWEEN ? AND ?) OR (END_MINUTE_OF_DAY BETWEEN ? AND ?))"""
+    first_day, last_day = _day_key(start), _day_key(end)
+    first_minute, last_minute = _minute_of_day(daytime[0]), _minute_of_day(daytime[1])
+    params = [datetime.combine(end + timedelta(days=1), time(0)), datetime.combine(start, time(0)),
+              first_day, last_day, first_day, last_day, first_minute, last_minute, first_minute, last_minute]
+    return condition, params
+
+
+def select_months(years:list, months:list, columns:list=None, con:duckdb.DuckDBPyConnection=None,
+                  table:str="trips") -> pd.DataFrame:
+    """Trips that start or end in one of the years and in one of the months (selection of the month view).
+
+    Args:
+        years (list): years, e.g. [2022, 2023]
+        months (list): months 1-12
+        columns (list, optional): columns to read, all if None
+        con (duckdb.DuckDBPyConnection, optional): connection, defaults to the shared connection
+        table (str, optional): "trips" or "trips_sample" (stratified sample, see sampling.py). Defaults to "trips".
+
+    Returns:
+        pd.DataFrame: selected trips
+    """
+    condition, params = months_filter(years, months)
+    return query(f"SELECT {_columns(columns)} FROM {table} WHERE {condition}", params, con)
+
+
+def select_days(start:date, end:date, daytime:tuple=(time(0), time(23, 59, 59)), columns:list=None,
+                con:duckdb.DuckDBPyConnection=None) -> pd.DataFrame:
+    """Trips that start or end between two dates and start or end within the time of day (selection of the day view).
+
+    Args:
+        start (date): first day
+        end (date): last day (inclusive)
+        daytime (tuple, optional): (from, to) time of day. Defaults to the whole day.
+        columns (list, optional): columns to read, all if None
+        con (duckdb.DuckDBPyConnection, optional): connection, defaults to the shared connection
+
+    Returns:
+        pd.DataFrame: selected trips
+    """
+    condition, params = days_filter(start, end, daytime)
+    return query(f"SELECT {_columns(columns)} FROM trips WHERE {condition}", params, con)
+
+
+def rides_per_district_weekday(con:duckdb.DuckDBPyConnection=None) -> pd.DataFrame:
+    """Number of rides per start district and weekday (0 = Sunday ... 6 = Saturday, DuckDB dayofweek).
+
+    Returns:
+        pd.DataFrame: districts as rows, weekdays as columns
+    """
+    counts = query("""SELECT CITY_DISTRICT_START, (START_WEEKDAY + 1) % 7 AS WEEKDAY, count(*) AS RIDES
+                      FROM trips GROUP BY ALL""", con=con)
+    return counts.pivot(index="CITY_DISTRICT_START", columns="WEEKDAY", values="RIDES").fillna(0).astype("int64")
+
+
+def median_duration(rental_is_station:int=None, return_is_station:int=None, con:duckdb.DuckDBPyConnection=None) -> pd.Timedelta:
+    """Median duration of the trips, optionally restricted to station or free-floating rentals/returns,
+    e.g. station to free-floating: median_duration(1, 0).
+
+    Args:
+        rental_is_station (int, optional): 1 = rental at a station, 0 = free-floating, None = both
+        return_is_station (int, optional): 1 = return at a station, 0 = free-floating, None = both
+        con (duckdb.DuckDBPyConnection, optional): connection, defaults to the shared connection
+
+    Returns:
+        pd.Timedelta: median duration
+    """
+    sql = """SELECT median(epoch(ENDTIME) - epoch(STARTTIME)) AS SECONDS FROM trips
+             WHERE (? IS NULL OR RENTAL_IS_STATION = ?) AND (? IS NULL OR RETURN_IS_STATION = ?)"""
+    seconds = query(sql, [rental_is_station, rental_is_station, return_is_station, return_is_station], con)["SECONDS"][0]
+    return pd.Timedelta(seconds=seconds)
@@ -0,0 +1,143 @@
+"""Client of the local query service (see query_service.py) for the Streamlit app in thin-client mode.
+
+Kept apart from the service, so the app as client imports neither the data store nor the SQL layer
+(ingestion, query, duckdb): only the standard library, pandas and pyarrow for the Arrow IPC tables.
+"""
+import datetime as dt
+import http.client
+import json
+import queue
+import struct
+from urllib.parse import urlsplit
+
+ENV_VARIABLE = "MVG_QUERY_SERVICE"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+# Länge des JSON-Headers und der Nutzdaten eines Antwort-Frames
+FRAME_HEADER = struct.Struct("!IQ")
+
+
+class QueryServiceError(RuntimeError):
+    """Error reported by the query service (unknown operation, invalid arguments, failed query)."""
+
+
+def _json_default(value):
+    if isinstance(value, (dt.date, dt.time)):
+        return value.isoformat()
+    if hasattr(value, "item"):  # numpy-Skalare
+        return value.item()
+    raise TypeError(f"Nicht serialisierbar: {type(value).__name__}")
+
+
+def decode_frames(body:bytes) -> list:
+    """Decodes the response frames of a batch; errors are returned as QueryServiceError instances."""
+    results = []
+    offset = 0
+    while offset < len(body):
+        header_size, payload_size = FRAME_HEADER.unpack_from(body, offset)
+        offset += FRAME_HEADER.size
+        header = json.loads(body[offset:offset + header_size])
+        offset += header_size
+        payload = body[offset:offset + payload_size]
+        offset += payload_size
+        if header["status"] != "ok":
+            results.append(QueryServiceError(header["error"]))
+        elif header["kind"] == "table":
+            import pyarrow as pa
+
+            results.append(pa.ipc.open_stream(payload).read_pandas())
+        else:
+            results.append(json.loads(payload))
+    return results
+
+
+class QueryClient:
+    """Thread-safe client of the query service with a pool of persistent HTTP/1.1 connections.
+
+    Args:
+        url (str, optional): address of the service. Defaults to http://127.0.0.1:8765.
+        pool_size (int, optional): maximum number of idle connections kept open. Defaults to 8.
+        timeout (float, optional): socket timeout in seconds. Defaults to 300.
+    """
+
+    def __init__(self, url:str=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", pool_size:int=8, timeout:float=300):
+        parsed = urlsplit(url)
+        self.host = parsed.hostname or DEFAULT_HOST
+        self.port = parsed.port or DEFAULT_PORT
+        self.timeout = timeout
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self.requests = 0
+        self.connections = 0
+
+    def _acquire(self) -> http.client.HTTPConnection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            self.connections += 1
+            return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _release(self, connection:http.client.HTTPConnection) -> None:
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def _request(self, method:str, path:str, body:bytes=None) -> bytes:
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        # Eine vom Dienst inzwischen geschlossene Verbindung aus dem Pool wird einmal durch eine neue ersetzt
+        # (alle Operationen sind lesend bzw. wiederholbar)
+        for attempt in range(2):
+            connection = self._acquire()
+            try:
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            self.requests += 1
+            if response.status != 200:
+                raise QueryServiceError(f"HTTP {response.status}: {data.decode(errors='replace')}")
+            return data
+
+    def health(self) -> dict:
+        return json.loads(self._request("GET", "/health"))
+
+    def batch(self, requests:list) -> list:
+        """Sends several operations in one request.
+
+        Args:
+            requests (list): (operation, arguments dict) pairs, e.g. [("daily_counts", {}), ("hourly_series", {})]
+
+        Returns:
+            list: results in the order of the requests (DataFrame or JSON value)
+
+        Raises:
+            QueryServiceError: if one of the operations failed
+        """
+        body = json.dumps({"requests": [{"op": op, "args": args} for op, args in requests]}, default=_json_default)
+        results = decode_frames(self._request("POST", "/batch", body.encode()))
+        for result in results:
+            if isinstance(result, QueryServiceError):
+                raise result
+        return results
+
+    def call(self, op:str, **args):
+        """Runs one operation, e.g. client.call("select_months", years=[2023], months=[6])."""
+        return self.batch([(op, args)])[0]
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
@@ -0,0 +1,409 @@
+"""Local query service: trip store, aggregates and forecasts over HTTP, shared by many app processes.
+
+The service loads and queries the data once; the Streamlit app becomes a thin client if the environment
+variable MVG_QUERY_SERVICE holds the address of the service (e.g. http://127.0.0.1:8765), so UI processes
+stay small and can be scaled independently.
+
+Protocol (HTTP/1.1 with keep-alive, JSON requests, binary responses):
+    GET  /health  status, data version, cache statistics (JSON)
+    POST /batch   {"requests": [{"op": "select_months", "args": {"years": [2023], "months": [6]}}, ...]}
+                  Response: one frame per request, in order: 4-byte header length, 8-byte payload length
+                  (network byte order), JSON header {"status": "ok"|"error", "kind": "table"|"json", "error": ...},
+                  payload (Arrow IPC stream for tables, JSON otherwise).
+
+The requests of a batch run in parallel on a bounded worker pool (equal requests only once). Encoded
+responses are cached per data version in an ArtifactCache, so repeated selections of all clients are
+answered without a query. Only the operations in OPERATIONS exist; clients send selections, never SQL.
+The client (QueryClient) and the frame format are in query_client.py.
+The service never changes the data store or the forecasts. The only operation that writes is export:
+it writes the export files of a selection into exports/ of the service (see export.py), which clients
+read from there, as the app does without the service.
+
+use: python query_service.py [--port 8765] [--workers 8] [--cache-mb 512]
+     MVG_QUERY_SERVICE=http://127.0.0.1:8765 streamlit run streamlit_main.py
+"""
+import argparse
+import contextlib
+import datetime as dt
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+import data_preprocessing as dp
+import ingestion as ing
+import query as q
+from artifact_cache import ArtifactCache, config_key
+# Client und Protokoll (ohne Datenspeicher / SQL-Schicht, für die App als Client), hier mit exportiert
+from query_client import (DEFAULT_HOST, DEFAULT_PORT, ENV_VARIABLE, FRAME_HEADER, QueryClient,  # noqa: F401
+                          QueryServiceError, decode_frames)
+
+logger = logging.getLogger(__name__)
+
+
+## Server
+
+class QueryBackend:
+    """Data of the service: DuckDB connection over the data store, or the cleaned csv files if no store exists.
+
+    The backend has its own connection (not the shared one of query.py), so several backends, e.g. over
+    different stores, can run in one process. After a new ingestion the next operations get a new
+    connection; the old one is closed when the last operation still using it has finished.
+
+    Args:
+        store (str, optional): directory of the store. Defaults to ing.STORE_DIR.
+        start_year (int, optional): first year, only without store (the service always serves the whole store).
+            Defaults to 2020.
+        end_year (int, optional): last year, only without store. Defaults to 2023.
+    """
+
+    def __init__(self, store:str=ing.STORE_DIR, start_year:int=None, end_year:int=None):
+        if ing.store_exists(store) and (start_year is not None or end_year is not None):
+            raise ValueError("Jahresauswahl nur ohne Datenspeicher möglich, der Dienst liefert immer den ganzen Datenspeicher")
+        self.store = store
+        self.start_year = start_year or 2020
+        self.end_year = end_year or 2023
+        self.df = None
+        self._version = None
+        self._connection = None
+        # laufende Operationen je Verbindung (auch für ersetzte Verbindungen, bis sie geschlossen sind)
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def refresh(self) -> str:
+        """Returns the current data version; after new ingestions the next operations use a new connection."""
+        with self._lock:
+            if ing.store_exists(self.store):
+                version = ing.dataset_version(self.store)
+                if self._version is not None and version != self._version:
+                    self._retire_connection()
+            else:
+                version = f"csv-{self.start_year}-{self.end_year}"
+            self._current_connection()
+            self._version = version
+            return version
+
+    def _current_connection(self):
+        # Aufruf nur mit self._lock: öffnet die Verbindung beim ersten Gebrauch bzw. nach einer neuen Datenversion
+        if self._connection is None:
+            if not ing.store_exists(self.store) and self.df is None:
+                self.df = ing.load_cleaned(self.start_year, self.end_year, self.store)
+            self._connection = q.connect(self.store, self.df)
+            self._users[self._connection] = 0
+        return self._connection
+
+    def _retire_connection(self) -> None:
+        # Aufruf nur mit self._lock: die Verbindung wird sofort geschlossen, wenn keine Operation sie nutzt,
+        # sonst von der letzten Operation (siehe cursor)
+        old, self._connection = self._connection, None
+        if old is not None and self._users[old] == 0:
+            del self._users[old]
+            old.close()
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Cursor of the current connection for one operation; the connection stays open until it is released.
+
+        Yields:
+            duckdb.DuckDBPyConnection: cursor, usable in parallel to the cursors of other operations
+        """
+        with self._lock:
+            connection = self._current_connection()
+            self._users[connection] += 1
+        cursor = connection.cursor()
+        try:
+            yield cursor
+        finally:
+            cursor.close()
+            with self._lock:
+                self._users[connection] -= 1
+                if connection is not self._connection and self._users[connection] == 0:
+                    del self._users[connection]
+                    connection.close()
+
+    def close(self) -> None:
+        """Closes the connection (operations still running keep theirs until they finish)."""
+        with self._lock:
+            self._retire_connection()
+
+    def years(self) -> list:
+        if ing.store_exists(self.store):
+            return ing.available_years(self.store)
+        return list(range(self.start_year, self.end_year + 1))
+
+
+def _days_arguments(start:str, end:str, daytime:list=("00:00:00", "23:59:59")) -> tuple:
+    """Converts the ISO strings of a day selection (JSON) back into date and time values."""
+    return dt.date.fromisoformat(start), dt.date.fromisoformat(end), tuple(dt.time.fromisoformat(value) for value in daytime)
+
+
+def op_info(backend:QueryBackend) -> dict:
+    import export as ex
+    import forecasting as fc
+
+    version = backend.refresh()
+    return {"version": version, "years": backend.years(),
+            "sample": ing.store_exists(backend.store) and ing.has_sample(backend.store),
+            "forecasts": os.path.exists(fc.FORECAST_STORE), "hourly_forecast": fc.hourly_stamp(),
+            "export_formats": list(ex.FORMATS)}
+
+
+def op_select_months(backend:QueryBackend, years:list, months:list, table:str="trips") -> pd.DataFrame:
+    if table not in ("trips", "trips_sample"):
+        raise ValueError(f"Unbekannte Tabelle: {table}")
+    with backend.cursor() as con:
+        return q.select_months(years, months, con=con, table=table)
+
+
+def op_select_days(backend:QueryBackend, **selection) -> pd.DataFrame:
+    with backend.cursor() as con:
+        return q.select_days(*_days_arguments(**selection), con=con)
+
+
+def op_daily_counts(backend:QueryBackend) -> pd.DataFrame:
+    with backend.cursor() as con:
+        counts = q.query("""SELECT START_YEAR, START_DOY, count(*) AS DAILY_COUNTS FROM trips
+                            GROUP BY ALL ORDER BY START_YEAR, START_DOY""", con=con)
+    counts["DATE"] = dp.calendar_dates(counts["START_YEAR"], counts["START_DOY"])
+    return counts
+
+
+def op_hourly_series(backend:QueryBackend) -> pd.DataFrame:
+    import forecasting as fc
+
+    with backend.cursor() as con:
+        trips = q.query("SELECT START_YEAR, START_DOY, START_HOUR FROM trips", con=con)
+    return fc.build_hourly_series(trips)
+
+
+def op_hourly_model(backend:QueryBackend) -> str:
+    import forecasting as fc
+
+    return fc.read_hourly_model(backend.refresh())
+
+
+def op_hourly_forecast(backend:QueryBackend) -> pd.DataFrame:
+    import forecasting as fc
+
+    return pd.read_parquet(fc.HOURLY_FORECAST_STORE)
+
+
+def op_aggregate(backend:QueryBackend, name:str) -> pd.DataFrame:
+    import district_cube as dcube
+    import duration_stats as dstat
+
+    if ing.store_exists(backend.store) and ing.has_aggregate(name, backend.store):
+        return ing.load_aggregate(name, backend.store)
+    # ohne Datenspeicher aus den bereinigten Fahrten berechnen (wie in streamlit_main.py)
+    builders = {"duration_sketches": dstat.build_sketches, "district_flows": dcube.build_flows}
+    if name not in builders:
+        raise ValueError(f"Unbekanntes Aggregat: {name}")
+    return builders[name](backend.df)
+
+
+def op_forecast_keys(backend:QueryBackend, kind:str) -> list:
+    import forecasting as fc
+
+    return fc.list_forecasts(kind)
+
+
+def op_forecast(backend:QueryBackend, kind:str, key:str) -> pd.DataFrame:
+    import forecasting as fc
+
+    return fc.load_forecast(kind, key)
+
+
+def op_export(backend:QueryBackend, view:str, selection:dict, fmt:str="parquet", name:str="auswahl") -> list:
+    import export as ex
+
+    if view == "months":
+        condition, params = q.months_filter(selection["years"], selection["months"])
+    else:
+        condition, params = q.days_filter(*_days_arguments(**selection))
+    out_dir = os.path.abspath(os.path.join(ex.EXPORT_DIR, os.path.basename(name)))
+    with backend.cursor() as con:
+        return ex.export_selection(condition, params, fmt, out_dir, con=con)
+
+
+# Operationen des Dienstes: Name -> (Funktion, Antwort cachebar)
+# Nicht cachebar: Datenversion / Zustand (info), Dateien, die sich ohne neue Datenversion ändern (Prognosen, Export)
+OPERATIONS = {
+    "info": (op_info, False),
+    "select_months": (op_select_months, True),
+    "select_days": (op_select_days, True),
+    "daily_counts": (op_daily_counts, True),
+    "hourly_series": (op_hourly_series, True),
+    "aggregate": (op_aggregate, True),
+    "forecast_keys": (op_forecast_keys, False),
+    "forecast": (op_forecast, False),
+    "hourly_model": (op_hourly_model, False),
+    "hourly_forecast": (op_hourly_forecast, False),
+    "export": (op_export, False),
+}
+
+
+def _encode_frame(header:dict, payload:bytes=b"") -> bytes:
+    header = json.dumps(header).encode()
+    return FRAME_HEADER.pack(len(header), len(payload)) + header + payload
+
+
+def encode_result(result) -> bytes:
+    """Encodes the result of an operation as response frame: DataFrames as Arrow IPC stream, everything else as JSON."""
+    if isinstance(result, pd.DataFrame):
+        import pyarrow as pa
+
+        table = pa.Table.from_pandas(result, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return _encode_frame({"status": "ok", "kind": "table"}, sink.getvalue().to_pybytes())
+    return _encode_frame({"status": "ok", "kind": "json"}, json.dumps(result, default=str).encode())
+
+
+class QueryServer(ThreadingHTTPServer):
+    """HTTP server of the query service. Connections are handled in threads, queries run on a bounded worker pool.
+
+    Args:
+        address (tuple): (host, port), port 0 chooses a free port
+        backend (QueryBackend, optional): data of the service. Defaults to QueryBackend().
+        workers (int, optional): size of the worker pool. Defaults to the number of CPUs.
+        cache_bytes (int, optional): maximum size of the response cache. Defaults to 512 MB.
+    """
+    daemon_threads = True
+
+    def __init__(self, address:tuple, backend:QueryBackend=None, workers:int=None, cache_bytes:int=512 * 1024 ** 2):
+        super().__init__(address, QueryHandler)
+        self.backend = backend or QueryBackend()
+        self.workers = workers or os.cpu_count()
+        self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="query")
+        self.cache = ArtifactCache(max_bytes=cache_bytes, max_entries=4096, name="query_service")
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def execute(self, op:str, args:dict, version:str) -> bytes:
+        """Runs one operation (or answers it from the cache) and returns its encoded response frame."""
+        if op not in OPERATIONS:
+            return _encode_frame({"status": "error", "error": f"Unbekannte Operation: {op}"})
+        function, cacheable = OPERATIONS[op]
+        key = config_key(op=op, data=version, args=args)
+        if cacheable:
+            frame = self.cache.get(key)
+            if frame is not None:
+                return frame
+        try:
+            frame = encode_result(function(self.backend, **args))
+        except Exception as error:
+            logger.exception("Operation %s fehlgeschlagen", op)
+            return _encode_frame({"status": "error", "error": f"{type(error).__name__}: {error}"})
+        if cacheable:
+            self.cache.put(key, frame)
+        return frame
+
+    def run_batch(self, requests:list) -> bytes:
+        """Runs the requests of a batch in parallel on the worker pool, equal requests only once."""
+        version = self.backend.refresh()
+        futures = {}
+        keys = []
+        for request in requests:
+            op, args = request.get("op"), request.get("args") or {}
+            key = config_key(op=op, args=args)
+            if key not in futures:
+                futures[key] = self.pool.submit(self.execute, op, args, version)
+            keys.append(key)
+        return b"".join(futures[key].result() for key in keys)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        self.backend.close()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """Request handler of the query service (HTTP/1.1, connections stay open between requests)."""
+    protocol_version = "HTTP/1.1"
+    # offene Verbindungen ohne Anfrage werden nach dieser Zeit (Sekunden) geschlossen
+    timeout = 120
+
+    def _send(self, status:int, body:bytes, content_type:str="application/json") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error_json(self, status:int, message:str) -> None:
+        self._send(status, json.dumps({"error": message}).encode())
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send_error_json(404, f"Unbekannter Pfad: {self.path}")
+        body = {"status": "ok", "version": self.server.backend.refresh(), "workers": self.server.workers,
+                "cache": self.server.cache.stats()}
+        self._send(200, json.dumps(body).encode())
+
+    def do_POST(self):
+        if self.path != "/batch":
+            return self._send_error_json(404, f"Unbekannter Pfad: {self.path}")
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            requests = body["requests"]
+            if not all(isinstance(request, dict) for request in requests):
+                raise TypeError("requests muss eine Liste von Objekten sein")
+        except (ValueError, KeyError, TypeError) as error:
+            return self._send_error_json(400, f"Ungültige Anfrage: {error}")
+        self._send(200, self.server.run_batch(requests), "application/octet-stream")
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve_in_background(backend:QueryBackend=None, host:str=DEFAULT_HOST, port:int=0, workers:int=None) -> QueryServer:
+    """Starts a service in a background thread of the current process (stand-in server, e.g. for the load test).
+
+    Returns:
+        QueryServer: running server, stop with shutdown() and server_close()
+    """
+    server = QueryServer((host, port), backend, workers)
+    threading.Thread(target=server.serve_forever, name="query_service", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lokaler Abfragedienst für Fahrten, Aggregate, Prognosen und Exporte.")
+    parser.add_argument("--host", default=DEFAULT_HOST, help="Adresse")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port")
+    parser.add_argument("--workers", type=int, default=None, help="Größe des Worker-Pools (Standard: Anzahl Kerne)")
+    parser.add_argument("--cache-mb", type=int, default=512, help="Größe des Antwort-Caches in MB")
+    parser.add_argument("--start-year", type=int, default=None, help="erstes Jahr (nur ohne Datenspeicher, Standard: 2020)")
+    parser.add_argument("--end-year", type=int, default=None, help="letztes Jahr (nur ohne Datenspeicher, Standard: 2023)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    try:
+        backend = QueryBackend(start_year=args.start_year, end_year=args.end_year)
+    except ValueError as error:
+        parser.error(str(error))
+    start = time.perf_counter()
+    version = backend.refresh()
+    server = QueryServer((args.host, args.port), backend, args.workers, args.cache_mb * 1024 ** 2)
+    print(f"Abfragedienst (Datenversion {version}, {server.workers} Worker) bereit in {time.perf_counter() - start:.1f} s: "
+          f"{server.url}")
+    print(f"App als Client starten: {ENV_VARIABLE}={server.url} streamlit run streamlit_main.py")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
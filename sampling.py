@@ -0,0 +1,134 @@
+"""Stratified trip sample for progressive (sample-first) answers of large selections.
+
+At ingestion every source file gets a sample stratified by start day and rental station (free-floating
+rentals form one stratum per day): from a stratum with N trips ceil(SAMPLE_FRACTION * N) trips are drawn
+without replacement. Every sampled trip carries its stratum id, stratum size N, sample size n and the
+weight N / n, so estimates for any selection (domain) of the sample are weighted sums.
+
+Confidence intervals use the variance of a stratified estimate of a total,
+    Var = sum_h N_h^2 * (1 - n_h / N_h) * s_h^2 / n_h,
+for counts, and the Woodruff interval (confidence interval of the estimated share below the median,
+mapped back through the weighted quantile function) for medians. Strata with only one sampled trip
+contribute no variance, so the intervals are slightly too narrow for very sparse selections.
+"""
+import numpy as np
+import pandas as pd
+
+SAMPLE_FRACTION = 0.05
+# 95%-Konfidenzintervall
+Z_95 = 1.96
+
+
+def stratified_sample(df:pd.DataFrame, fraction:float=SAMPLE_FRACTION, seed:int=0, label:str="") -> pd.DataFrame:
+    """Draws the stratified sample of the cleaned trips of one source file.
+
+    Args:
+        df (pd.DataFrame): cleaned DataFrame with STARTTIME and RENTAL_STATION_NAME
+        fraction (float, optional): sampling fraction per stratum. Defaults to SAMPLE_FRACTION.
+        seed (int, optional): seed of the random generator (reproducible samples). Defaults to 0.
+        label (str, optional): source name, part of the stratum id so that strata of different files stay apart
+
+    Returns:
+        pd.DataFrame: sampled trips with the additional columns STRATUM, STRATUM_SIZE, STRATUM_SAMPLE, SAMPLE_WEIGHT
+    """
+    shuffled = df.iloc[np.random.default_rng(seed).permutation(len(df))]
+    keys = pd.DataFrame({"SOURCE": label, "DAY": shuffled["STARTTIME"].dt.normalize(),
+                         "STATION": shuffled["RENTAL_STATION_NAME"].fillna("")})
+    strata = keys.groupby(["DAY", "STATION"], sort=False)
+
+    # Rang innerhalb des Stratums in zufälliger Reihenfolge => die ersten ceil(f * N) Fahrten bilden die Stichprobe
+    rank = strata.cumcount().to_numpy()
+    size = strata["DAY"].transform("size").to_numpy()
+    sample_size = np.ceil(fraction * size).astype("int64")
+    keep = rank < sample_size
+
+    sample = shuffled[keep].assign(
+        STRATUM=pd.util.hash_pandas_object(keys[keep], index=False).to_numpy().view("int64"),
+        STRATUM_SIZE=size[keep].astype("int32"),
+        STRATUM_SAMPLE=sample_size[keep].astype("int32"),
+        SAMPLE_WEIGHT=(size[keep] / sample_size[keep]).astype("float32"),
+    )
+    return sample.sort_values("STARTTIME").reset_index(drop=True)
+
+
+def variance_of_total(sample:pd.DataFrame, values) -> float:
+    """Variance of the stratified estimate of the total of values over the sampled trips of a selection.
+
+    Args:
+        sample (pd.DataFrame): sampled trips of the selection (with the stratum columns)
+        values: value per sampled trip, e.g. 1 for every trip (count) or an indicator
+
+    Returns:
+        float: estimated variance
+    """
+    # Fahrten eines Stratums außerhalb der Auswahl zählen mit dem Wert 0 (Anteil n_h bleibt die Stichprobengröße des Stratums)
+    per_stratum = pd.DataFrame({"STRATUM": sample["STRATUM"].to_numpy(), "Y": np.asarray(values, dtype="float64")})
+    per_stratum["Y2"] = per_stratum["Y"] ** 2
+    per_stratum = per_stratum.groupby("STRATUM").agg(Y=("Y", "sum"), Y2=("Y2", "sum")).join(
+        sample.groupby("STRATUM")[["STRATUM_SIZE", "STRATUM_SAMPLE"]].first())
+
+    n = per_stratum["STRATUM_SAMPLE"].to_numpy("float64")
+    big_n = per_stratum["STRATUM_SIZE"].to_numpy("float64")
+    y, y2 = per_stratum["Y"].to_numpy(), per_stratum["Y2"].to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        s2 = np.where(n > 1, (y2 - y ** 2 / n) / (n - 1), 0.0)
+    return float(np.sum(big_n ** 2 * (1 - n / big_n) * np.clip(s2, 0, None) / n))
+
+
+def estimate_count(sample:pd.DataFrame, mask=None, z:float=Z_95) -> tuple:
+    """Estimated number of trips of the selection (optionally restricted by a mask) with confidence interval.
+
+    Args:
+        sample (pd.DataFrame): sampled trips of the selection
+        mask (optional): boolean array/Series over the sample, e.g. station rentals only. Defaults to all.
+        z (float, optional): quantile of the normal distribution. Defaults to Z_95.
+
+    Returns:
+        tuple: (estimate, lower bound, upper bound)
+    """
+    indicator = np.ones(len(sample)) if mask is None else np.asarray(mask, dtype="float64")
+    estimate = float(np.sum(sample["SAMPLE_WEIGHT"].to_numpy("float64") * indicator))
+    half_width = z * np.sqrt(variance_of_total(sample, indicator))
+    return estimate, max(estimate - half_width, 0.0), estimate + half_width
+
+
+def estimate_median(sample:pd.DataFrame, values, z:float=Z_95) -> tuple:
+    """Weighted median of values over the sampled trips with Woodruff confidence interval.
+
+    Args:
+        sample (pd.DataFrame): sampled trips of the selection
+        values: value per sampled trip, e.g. durations in seconds
+        z (float, optional): quantile of the normal distribution. Defaults to Z_95.
+
+    Returns:
+        tuple: (estimate, lower bound, upper bound), Nones if the sample is empty
+    """
+    values = np.asarray(values, dtype="float64")
+    if len(values) == 0:
+        return None, None, None
+    weights = sample["SAMPLE_WEIGHT"].to_numpy("float64")
+    order = np.argsort(values, kind="stable")
+    cumulative = np.cumsum(weights[order])
+    total = cumulative[-1]
+
+    def weighted_quantile(share):
+        index = np.searchsorted(cumulative, np.clip(share, 0, 1) * total)
+        return float(values[order][min(index, len(values) - 1)])
+
+    median = weighted_quantile(0.5)
+    # Standardfehler des geschätzten Anteils der Fahrten <= Median
+    standard_error = np.sqrt(variance_of_total(sample, values <= median)) / total
+    return median, weighted_quantile(0.5 - z * standard_error), weighted_quantile(0.5 + z * standard_error)
+
+
+def weighted_mode(sample:pd.DataFrame, column:str):
+    """Most frequent value of a column, weighted with the sample weights (None if the sample is empty)."""
+    counts = sample.groupby(column)["SAMPLE_WEIGHT"].sum()
+    return counts.idxmax() if not counts.empty else None
+
+
+def format_interval(estimate, low, high, formatter=str) -> str:
+    """Formats an estimate with its confidence interval, e.g. "≈ 1200 (1150 – 1250)"."""
+    if estimate is None:
+        return "-"
+    return f"≈ {formatter(estimate)} ({formatter(low)} – {formatter(high)})"
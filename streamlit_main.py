@@ -1,17 +1,20 @@
-import pandas as pd
+import os
 import numpy as np
-import geopandas as gpd
+import pandas as pd
 import data_preprocessing as dp
-import folium
+import duration_stats as dstat
+import map_layers as ml
+from artifact_cache import ArtifactCache, config_key
 import streamlit as st
-# from streamlit.components.v1 import html
-from streamlit_folium import st_folium
-from folium.plugins import HeatMap
+import streamlit.components.v1 as components
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import time, timedelta, datetime, date
-import plotly.express as px
-from prophet import Prophet
-from prophet.plot import plot_plotly, plot_components_plotly
-import plotly.graph_objs as go
+
+# Schwere Bibliotheken (prophet, plotly, folium, geopandas) werden erst in der
+# Ansicht importiert, die sie braucht. Das verkürzt den Kaltstart und jeden Rerun ohne diese Ansicht.
+# Datenspeicher und SQL-Schicht (ingestion, query mit duckdb) nur ohne Abfragedienst, district_cube
+# und sampling erst in der Ansicht, die sie braucht (als Client des Dienstes lädt die App keine Fahrten).
+# Ladezeiten der Importe messen: python import_time_report.py
 
 start_year = 2020
 end_year = 2023
@@ -20,7 +23,7 @@ end_year = 2023
 # Einlesen der Dateien
 @st.cache_data
 def read_files(start_year=2020, end_year=2023):
-    """Reading csv files and concatenating them in a Pandas DataFrame
+    """Reading csv files and concatenating them in a Pandas DataFrame (cached, see dp.read_files)
 
     Args:
         start_year (int, optional): year to start with. Defaults to 2020.
@@ -29,28 +32,13 @@ def read_files(start_year=2020, end_year=2023):
     Returns:
         pd.DataFrame: Pandas DataFrame
     """
-    years = range(start_year, end_year + 1)
-    data_list = []
-    # Schleife über jedes Jahr
-    for year in years:
-        df = pd.read_csv(f"MVG_Rad_Fahrten_{year}.csv", sep=";", decimal=",", parse_dates=["STARTTIME       ", "ENDTIME         "])
-        
-        # Entfernen von Leerzeichen in den Columns
-        column_names = [dp.remove_space(column) for column in df.columns]
-        df.columns = column_names
-
-        # Hinzufügen des eingelesenen DataFrames zur Liste
-        data_list.append(df)
-
-    # alle Daten zu einem einzigen DataFrame kombinieren 
-    df = pd.concat(data_list, ignore_index=True)
-    return df
+    return dp.read_files(start_year=start_year, end_year=end_year)
 
 
 # Formatieren der Dateien
 @st.cache_data
 def format_files(df):
-    """Formatting and Cleaning Pandas DataFrame. Combines several functions defined and executes them consecutively.
+    """Formatting and Cleaning Pandas DataFrame (cached, see dp.format_files)
 
     Args:
         df (pd.DataFrame): Pandas DataFrame
@@ -58,58 +46,562 @@ def format_files(df):
     Returns:
         pd.DataFrame: formatted and cleaned DataFrame
     """
-    # Entfernen von Leerzeichen bei Stationsnamen
-    df["RENTAL_STATION_NAME"] = df["RENTAL_STATION_NAME"].apply(dp.remove_space)
-    df["RETURN_STATION_NAME"] = df["RETURN_STATION_NAME"].apply(dp.remove_space)
+    return dp.format_files(df)
 
-    # Löschen von "Row"
-    df = df.drop("Row", axis=1)
+# Laden aus dem Datenspeicher (inkrementell befüllt mit python ingestion.py)
+@st.cache_data
+def load_store(version):
+    """Reading cleaned trips from the data store (cached per data version, see ingestion.py)
 
-    # Formatierung der Koordinaten + Entfernung ungültiger Daten
-    df = dp.handle_coordinates(df)
+    Args:
+        version (str): data version of the store, new versions invalidate the cache
 
-    # Formatierung von is_station
-    df = dp.handle_is_station(df)
+    Returns:
+        pd.DataFrame: formatted and cleaned DataFrame
+    """
+    import ingestion as ing
 
-    # Auffüllen fehlender Werte anhand des Vorhandenseins oder Fehlens von "station_name"-Werten
-    df = dp.fill_is_station_values(df)
+    return ing.load_trips()
 
-    # Hinzufügen einer Spalte für die Dauer
-    df["DURATION"] = df["ENDTIME"] - df["STARTTIME"]
+# Optional: Daten und Abfragen aus dem lokalen Abfragedienst (python query_service.py), die App ist dann nur Client
+# und lädt selbst keine Fahrten, z.B. MVG_QUERY_SERVICE=http://127.0.0.1:8765 streamlit run streamlit_main.py
+QUERY_SERVICE = os.environ.get("MVG_QUERY_SERVICE")
 
-    # Entfernen ungültiger Daten
-    df = dp.remove_invalid_datetime(df)
+@st.cache_resource
+def get_query_client(url):
+    """Client of the query service with pooled keep-alive connections, shared by all sessions (see query_client.py)
 
-    # Removing data with NULL values
-    df = df.dropna()
+    Args:
+        url (str): address of the service
 
-    # Hinzufügen der Distanz
-    # dauert lange, uncomment nur, wenn erwünscht und ausreichend Rechenleistung verfügbar!
-    # wird später zur Angabe der mittleren Distanz verwendet
-    # diese Zeilen müssten dann entsprechend auch ent-kommentiert werden: suche nach "Entfernung" und "DISTANCE"
-    # df = dp.calculate_distance(df)
+    Returns:
+        qc.QueryClient: client
+    """
+    import query_client as qc
+    return qc.QueryClient(url)
 
-    # Hinzufügen des Stadtviertels
-    df = dp.add_city_district(df)
+# Load Dataframe
+if QUERY_SERVICE:
+    service = get_query_client(QUERY_SERVICE)
+    service_info = service.call("info")
+    data_version = service_info["version"]
+    start_year, end_year = service_info["years"][0], service_info["years"][-1]
+    df = None
+    sample_available = service_info["sample"]
+else:
+    import ingestion as ing
+
+    if ing.store_exists():
+        data_version = ing.dataset_version()
+        start_year, end_year = ing.available_years()[0], ing.available_years()[-1]
+        df = load_store(data_version)
+        # Stichprobe für vorläufige Ergebnisse großer Auswahlen (siehe sampling.py)
+        sample_available = ing.has_sample()
+    else:
+        data_version = f"csv-{start_year}-{end_year}"
+        df = format_files(read_files(start_year=start_year, end_year=end_year))
+        sample_available = False
 
-    # Hinzufügen, ob Punkte in Stadtbereich ("city area")
-    df = dp.add_city_status(df)
+@st.cache_resource
+def get_duration_cube(version):
+    """Dense day x bucket array of the duration sketches, shared by all sessions (cached per data version).
 
-    return df
+    Args:
+        version (str): data version, new versions invalidate the cache
 
-# Load Dataframe
-df = format_files(read_files(start_year=start_year, end_year=end_year))
+    Returns:
+        dstat.DurationCube: duration statistics per day
+    """
+    if QUERY_SERVICE:
+        return dstat.DurationCube(service.call("aggregate", name="duration_sketches"))
+    import ingestion as ing
 
-@st.cache_data
-def load_geojson(geojson):
-    geojson_file = gpd.read_file(geojson)
-    return geojson_file
+    if ing.store_exists() and ing.has_aggregate("duration_sketches"):
+        return dstat.DurationCube(ing.load_aggregate("duration_sketches"))
+    return dstat.DurationCube(dstat.build_sketches(df))
+
+
+@st.cache_resource
+def get_district_cube(version):
+    """Dense district x month x hour-of-week array of starts and ends, shared by all sessions (cached per data version).
+
+    Args:
+        version (str): data version, new versions invalidate the cache
+
+    Returns:
+        dcube.DistrictCube: starts / ends per district, month and hour of the week
+    """
+    import district_cube as dcube
+
+    if QUERY_SERVICE:
+        return dcube.DistrictCube(service.call("aggregate", name="district_flows"))
+    import ingestion as ing
+
+    if ing.store_exists() and ing.has_aggregate("district_flows"):
+        return dcube.DistrictCube(ing.load_aggregate("district_flows"))
+    return dcube.DistrictCube(dcube.build_flows(df))
+
+
+@st.cache_resource
+def load_hourly_forecast(version, stamp):
+    """Precomputed hourly Prophet model and forecast (python forecasting.py --hourly), shared by all sessions
+    (cached per data version and file time, see fc.load_hourly)
+
+    Args:
+        version (str): data version, the model must have been fitted on this data
+        stamp (float): modification time of the stored model, None if none is stored
+
+    Returns:
+        tuple: (model, forecast), None if no model for this data version is stored
+    """
+    import forecasting as fc
+    if stamp is None:
+        return None
+    if QUERY_SERVICE:
+        model_json = service.call("hourly_model")
+        if model_json is None:
+            return None
+        from prophet.serialize import model_from_json
+        return model_from_json(model_json), service.call("hourly_forecast")
+    return fc.load_hourly(version)
+
+
+# Höchstens so lange (Sekunden) wartet ein Lauf der Monatsansicht auf die exakte Abfrage, bevor er neu startet
+QUERY_POLL_SECONDS = 2
+
+
+@st.cache_resource
+def get_query_pool():
+    """Thread pool for exact queries that run in the background while the sample is shown, shared by all sessions
+
+    Returns:
+        ThreadPoolExecutor: pool
+    """
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="exact_query")
+
+
+def select_months(selection:dict, table:str="trips") -> pd.DataFrame:
+    """Trips of the month selection from the query service or the local SQL layer (see q.select_months)
+
+    Args:
+        selection (dict): years and months
+        table (str, optional): "trips" or "trips_sample". Defaults to "trips".
+
+    Returns:
+        pd.DataFrame: selected trips
+    """
+    if QUERY_SERVICE:
+        return service.call("select_months", table=table, **selection)
+    import query as q
+
+    return q.select_months(**selection, con=q.get_connection(df=df), table=table)
+
+
+def select_days(start:date, end:date, daytime:tuple) -> pd.DataFrame:
+    """Trips of the day selection from the query service or the local SQL layer (see q.select_days)
+
+    Args:
+        start (date): first day
+        end (date): last day
+        daytime (tuple): (from, to) time of day
+
+    Returns:
+        pd.DataFrame: selected trips
+    """
+    if QUERY_SERVICE:
+        return service.call("select_days", start=start, end=end, daytime=daytime)
+    import query as q
+
+    return q.select_days(start, end, daytime, con=q.get_connection(df=df))
+
+
+def build_district_figure(cube:"dcube.DistrictCube", mask:np.ndarray, measure:str):
+    """Builds the animated choropleth of the city districts: one frame per hour of the week, the frames are
+    slices of the cube and switched in the browser (time slider / play button).
+
+    Args:
+        cube (dcube.DistrictCube): district cube
+        mask (np.ndarray): selected months, see cube.select_months
+        measure (str): "STARTS", "ENDS" or "NET_FLOW"
+
+    Returns:
+        plotly.graph_objs.Figure: figure with frames and slider
+    """
+    import json
+    import plotly.graph_objs as go
+    import district_cube as dcube
+
+    values = cube.frames(mask, measure)
+    # Nettofluss symmetrisch um 0 einfärben, sonst von 0 bis zum Maximum über alle Stunden (feste Farbskala beim Abspielen)
+    if measure == "NET_FLOW":
+        limit = max(np.abs(values).max(), 1)
+        color = dict(colorscale="RdBu", zmin=-limit, zmax=limit)
+    else:
+        color = dict(colorscale="Blues", zmin=0, zmax=max(values.max(), 1))
+
+    districts = list(cube.districts)
+    labels = [dcube.hour_label(hour) for hour in range(dcube.HOURS_OF_WEEK)]
+    trace = go.Choroplethmapbox(
+        geojson=json.loads(ml.layer_geojson("neighbourhoods.geojson", zoom=11)),
+        featureidkey="properties.neighbourhood",
+        locations=districts,
+        z=values[0],
+        marker_opacity=0.7,
+        marker_line_width=0.5,
+        colorbar_title=dcube.MEASURES[measure].split(" ")[0],
+        **color
+    )
+    # Frames enthalten nur die Werte, die Geometrie wird einmal übertragen
+    frames = [go.Frame(data=[go.Choroplethmapbox(z=values[hour])], name=labels[hour])
+              for hour in range(dcube.HOURS_OF_WEEK)]
+    slider_steps = [dict(method="animate", label=label,
+                         args=[[label], dict(mode="immediate", frame=dict(duration=0, redraw=True), transition=dict(duration=0))])
+                    for label in labels]
+
+    figure = go.Figure(data=[trace], frames=frames)
+    figure.update_layout(
+        mapbox=dict(style="carto-positron", center=dict(lat=48.137154, lon=11.576124), zoom=9.8),
+        height=600,
+        margin=dict(l=0, r=0, t=40, b=0),
+        title=f"{dcube.MEASURES[measure]} je Stadtviertel und Stunde der Woche",
+        sliders=[dict(steps=slider_steps, currentvalue=dict(prefix="Zeit: "), pad=dict(t=30))],
+        updatemenus=[dict(type="buttons", x=0, y=0, xanchor="right", yanchor="top", pad=dict(t=30, r=10), buttons=[
+            dict(label="▶", method="animate",
+                 args=[None, dict(frame=dict(duration=300, redraw=True), fromcurrent=True, transition=dict(duration=0))]),
+            dict(label="❚❚", method="animate",
+                 args=[[None], dict(mode="immediate", frame=dict(duration=0, redraw=False), transition=dict(duration=0))]),
+        ])],
+    )
+    return figure
+
+
+def import_map_libraries():
+    """Imports the libraries needed for the geographic views on first use.
+
+    Returns:
+        tuple: folium module, HeatMap class
+    """
+    import folium
+    from folium.plugins import HeatMap
+
+    return folium, HeatMap
+
+
+@st.cache_resource
+def get_map_cache():
+    """Map cache shared by all sessions of the server process: rendered map HTML, keyed by selection and layer configuration.
+
+    Returns:
+        ArtifactCache: LRU cache bounded by the total HTML size
+    """
+    return ArtifactCache(max_bytes=256 * 1024 ** 2, name="maps")
 
-# Lade die GeoJSON-Datei der Stadtviertel
-city_districts = load_geojson("neighbourhoods.geojson")
 
-# Lade die GeoJSON-Datei der City Area
-city_area = load_geojson("city_area.geojson")
+def build_month_map(chosen:pd.DataFrame, map_config:dict) -> str:
+    """Builds the folium map of the month view and renders it to HTML.
+
+    Args:
+        chosen (pd.DataFrame): selected trips
+        map_config (dict): layer configuration (show_stations, show_heatmap, show_city_districts, show_city_area)
+
+    Returns:
+        str: HTML of the rendered map
+    """
+    folium, HeatMap = import_map_libraries()
+
+    # Initialisieren der Karte
+    map_center = [48.137154, 11.576124] # Munich city centre
+    munich_map = folium.Map(location=map_center, zoom_start=11)
+
+    # benutzte Stationen ermitteln
+    stations = dp.get_station_data(chosen)
+
+    # Nutzungshäufigkeit der Stationen ermitteln
+    # (bei einer Stichprobe, siehe sampling.py, mit den Stichprobengewichten hochgerechnet)
+    is_sample = "SAMPLE_WEIGHT" in chosen.columns
+    weights = chosen["SAMPLE_WEIGHT"] if is_sample else pd.Series(1, index=chosen.index)
+    frequency_start = weights.groupby(chosen["RENTAL_STATION_NAME"], observed=True).sum().round().astype(int)
+    frequency_end = weights.groupby(chosen["RETURN_STATION_NAME"], observed=True).sum().round().astype(int)
+    approx = "≈ " if is_sample else ""
+
+    # Heatmap
+    if map_config["show_heatmap"]:
+        # heat-Daten für Stationen:
+        # (geht schneller, umfasst aber nur Stationen)
+        # heat_data = dp.get_heatmap_data(chosen, stations)
+
+        # heat-Daten für alle Punkte:
+        # (dauert länger, ist aber spannender, da auch mit freien Rückgaben)
+        heat_data_start = list(zip(chosen["STARTLAT"], chosen["STARTLON"]))
+        heat_data_end = list(zip(chosen["STARTLAT"], chosen["STARTLON"]))
+        heat_data = heat_data_start + heat_data_end
+
+        heat_map = HeatMap(heat_data, min_opacity=0.2, radius=25, blur=18)
+        heat_map.add_to(munich_map)
+
+    # Hinzufügen der Stationen
+    if map_config["show_stations"]:
+        # Prüfen, ob Ausleih- und Rückgabewerte für jede Station vorhanden, ansonsten 0 einsetzen (kein Wert vorhanden => Wert = 0)
+        for station, coordinates in stations.items():
+            if station not in frequency_start.index.values:
+                frequency_start[station] = 0
+            if station not in frequency_end.index.values:
+                frequency_end[station] = 0
+
+            # Hinzufügen zur Karte    
+            folium.Marker(location=coordinates,
+                          icon=folium.Icon(color="darkblue",
+                                 icon="bicycle",
+                                 prefix="fa"),
+                           tooltip=f"{station}: insgesamt {approx}{frequency_start[station] + frequency_end[station]}\
+                            <br>(Ausleihe: {approx}{frequency_start[station]}, Rückgabe: {approx}{frequency_end[station]})"
+                                ).add_to(munich_map)
+        
+    # Füge die Stadtviertel als GeoJSON auf der Karte hinzu
+    # (vereinfachte, vorab serialisierte Layer aus dem Cache, siehe map_layers.py)
+    if map_config["show_city_districts"]:
+        folium.GeoJson(
+            ml.layer_geojson("neighbourhoods.geojson", zoom=11),
+            name="Stadtviertel",
+            style_function=lambda feature: {
+                "fillColor": "lightblue",  # Füllfarbe der Stadtviertel
+                "color": "blue",
+                "weight": 3,
+                "opacity": 0.3,
+                "fillOpacity": 0.2
+            }
+        ).add_to(munich_map)
+
+        # Füge den Stadtbereich als GeoJSON auf der Karte hinzu
+    if map_config["show_city_area"]:
+        folium.GeoJson(
+            ml.layer_geojson("city_area.geojson", zoom=11),
+            name="Stadtbereich",
+            style_function=lambda feature: {
+                "fillColor": "lightgreen",  # Füllfarbe des Stadtbereichs
+                "color": "green",
+                "weight": 2,
+                "opacity": 0.6,
+                "fillOpacity": 0.25
+            }
+        ).add_to(munich_map)
+
+    return munich_map.get_root().render()
+
+
+def build_day_map(chosen:pd.DataFrame, map_config:dict) -> str:
+    """Builds the folium map of the day view and renders it to HTML.
+
+    Args:
+        chosen (pd.DataFrame): selected trips
+        map_config (dict): layer configuration (show_startpoints, show_endpoints, show_lines, show_city_districts, show_city_area)
+
+    Returns:
+        str: HTML of the rendered map
+    """
+    folium, HeatMap = import_map_libraries()
+
+    # Initialisieren der Karte
+    map_center = [48.137154, 11.576124] # Munich city centre
+    munich_map = folium.Map(location=map_center, zoom_start=12)
+    
+    for index, row in chosen.iterrows():
+        start_coordinates = [row["STARTLAT"], row["STARTLON"]]
+        end_coordinates = [row["ENDLAT"], row["ENDLON"]]
+
+        # Hinzufügen der Startpunkte
+        if map_config["show_startpoints"]:
+            folium.Circle(location=start_coordinates,
+                                color="purple",
+                                fill=True,
+                                fill_color="purple",
+                                fill_opacity=0.5
+                                ).add_to(munich_map)
+        
+        # Hinzufügen der Endpunkte
+        if map_config["show_endpoints"]: 
+                folium.Circle(location=end_coordinates,
+                                    radius=20,
+                                    color="green",
+                                    fill=True,
+                                    fill_color="green",
+                                    fill_opacity=0.5
+                                    ).add_to(munich_map)
+        
+        # Hinzufügen einer Linie zwischen Start- und Rückgabeort
+        if map_config["show_lines"]:
+                folium.PolyLine(locations=[start_coordinates, end_coordinates],
+                                color="grey",
+                                weight=2.5,
+                                opacity=0.3).add_to(munich_map)
+        
+    # Füge die Stadtviertel als GeoJSON auf der Karte hinzu
+    # (vereinfachte, vorab serialisierte Layer aus dem Cache, siehe map_layers.py)
+    if map_config["show_city_districts"]:
+        folium.GeoJson(
+            ml.layer_geojson("neighbourhoods.geojson", zoom=12),
+            name="Stadtviertel",
+            style_function=lambda feature: {
+                "fillColor": "lightblue",  # Füllfarbe der Stadtviertel
+                "color": "blue",
+                "weight": 3,
+                "opacity": 0.3,
+                "fillOpacity": 0.2
+            }
+        ).add_to(munich_map)
+
+        # Füge den Stadtbereich als GeoJSON auf der Karte hinzu
+    if map_config["show_city_area"]:
+        folium.GeoJson(
+            ml.layer_geojson("city_area.geojson", zoom=12),
+            name="Stadtbereich",
+            style_function=lambda feature: {
+                "fillColor": "lightgreen",  # Füllfarbe des Stadtbereichs
+                "color": "green",
+                "weight": 2,
+                "opacity": 0.6,
+                "fillOpacity": 0.25
+            }
+        ).add_to(munich_map)
+
+    return munich_map.get_root().render()
+
+
+def write_stats(rows:list):
+    """Writes the key figures of a selection as two columns (label, value).
+
+    Args:
+        rows (list): (label, value) tuples
+    """
+    col1, col2 = st.columns(2)
+    with col1:
+        for label, _ in rows:
+            st.write(label)
+    with col2:
+        for _, value in rows:
+            st.write(value)
+
+
+def station_masks(chosen:pd.DataFrame) -> list:
+    """Masks of the station rentals / returns in and outside the city area (order as in the key figures)."""
+    return [
+        (chosen["RENTAL_IS_STATION"] == 1) & (chosen["RENTAL_IS_CITY"] == 1),
+        (chosen["RENTAL_IS_STATION"] == 1) & (chosen["RENTAL_IS_CITY"] == 0),
+        (chosen["RETURN_IS_STATION"] == 1) & (chosen["RETURN_IS_CITY"] == 1),
+        (chosen["RETURN_IS_STATION"] == 1) & (chosen["RETURN_IS_CITY"] == 0),
+    ]
+
+
+def selection_stats(chosen:pd.DataFrame, duration_quantiles) -> list:
+    """Key figures of a month or day selection (exact result).
+
+    Args:
+        chosen (pd.DataFrame): trips of the selection
+        duration_quantiles: median, 90% and 99% percentile of the duration in seconds
+
+    Returns:
+        list: (label, value) tuples for write_stats
+    """
+    # Ausleihen / Rückgaben an Stationen in- und außerhalb des Stadtgebiets
+    rental_city, rental_not_city, return_city, return_not_city = [int(mask.sum()) for mask in station_masks(chosen)]
+    return [
+        ("Anzahl Fahrten:", f"{chosen.shape[0]}"),
+        ("Mittlere Fahrtenlänge:", dstat.format_duration(duration_quantiles[0])),
+        ("90%- / 99%-Perzentil der Fahrtenlänge:",
+         f"{dstat.format_duration(duration_quantiles[1])} / {dstat.format_duration(duration_quantiles[2])}"),
+        # ("Mittlere Entfernung (Luftlinie):", f"{chosen['DISTANCE'].median():.1f} Kilometer"),
+        ("Beliebtestes Startviertel:", f"{chosen['CITY_DISTRICT_START'].mode()[0]}"),
+        ("Beliebtestes Zielviertel:", f"{chosen['CITY_DISTRICT_END'].mode()[0]}"),
+        ("Stationsausleihen in-/außerhalb des Stadtgebiets:", f"{rental_city} / {rental_not_city}"),
+        ("Stationsrückgaben in-/außerhalb des Stadtgebiets:", f"{return_city} / {return_not_city}"),
+    ]
+
+
+def sample_month_stats(sample:pd.DataFrame) -> list:
+    """Estimated key figures of the month view from the stratified sample, with 95% confidence intervals.
+
+    Args:
+        sample (pd.DataFrame): sampled trips of the selection (see sampling.py)
+
+    Returns:
+        list: (label, value) tuples for write_stats
+    """
+    import sampling as smp
+
+    def count_str(estimate):
+        return smp.format_interval(*estimate, formatter=lambda value: f"{value:.0f}")
+
+    rental_city, rental_not_city, return_city, return_not_city = [smp.estimate_count(sample, mask) for mask in station_masks(sample)]
+    median = smp.estimate_median(sample, dstat.duration_seconds(sample))
+    return [
+        ("Anzahl Fahrten:", count_str(smp.estimate_count(sample))),
+        ("Mittlere Fahrtenlänge:", smp.format_interval(*median, formatter=dstat.format_duration)),
+        ("90%- / 99%-Perzentil der Fahrtenlänge:", "…"),
+        ("Beliebtestes Startviertel:", f"{smp.weighted_mode(sample, 'CITY_DISTRICT_START')}"),
+        ("Beliebtestes Zielviertel:", f"{smp.weighted_mode(sample, 'CITY_DISTRICT_END')}"),
+        ("Stationsausleihen in-/außerhalb des Stadtgebiets:", f"{count_str(rental_city)} / {count_str(rental_not_city)}"),
+        ("Stationsrückgaben in-/außerhalb des Stadtgebiets:", f"{count_str(return_city)} / {count_str(return_not_city)}"),
+    ]
+
+
+# Größte Exportdatei, die zum Herunterladen angeboten wird: der Download läuft über den Speicher der App
+# (Streamlit liest die Datei bei jedem Lauf, in dem die Schaltfläche angezeigt wird), größere Dateien nur lokal
+DOWNLOAD_MAX_BYTES = 50 * 1024 ** 2
+
+
+def export_panel(view:str, selection):
+    """Export of the current selection (trips, OD matrix, station counts), streamed from the store into files
+    (see export.py). The files stay on disk; files up to DOWNLOAD_MAX_BYTES can be downloaded, they are read
+    from the file (no DataFrame is built again), larger ones are only available locally.
+
+    Args:
+        view (str): "months" or "days"
+        selection: years and months (dict) or first day, last day and time of day (tuple) of the selection
+    """
+    if view == "months":
+        selection_args = {"years": sorted(selection["years"]), "months": sorted(selection["months"])}
+    else:
+        selection_args = dict(zip(["start", "end", "daytime"], selection))
+    # Verzeichnis nur nach Auswahl und Datenversion (nicht nach den Karten-Einstellungen)
+    key = config_key(export=view, data=data_version, **selection_args)[:16]
+
+    with st.expander("Export der Auswahl"):
+        # als Client des Dienstes ohne export.py (duckdb, pyarrow), die Formate kommen vom Dienst
+        if QUERY_SERVICE:
+            formats = service_info["export_formats"]
+        else:
+            import export as ex
+
+            formats = list(ex.FORMATS)
+        fmt = st.radio("Format:", formats, horizontal=True, key=f"export_format_{key}")
+        if st.button("Export erstellen", key=f"export_{key}"):
+            if QUERY_SERVICE:
+                # Der Dienst schreibt die Dateien (gleicher Rechner)
+                report = service.call("export", view=view, selection=selection_args, fmt=fmt, name=key)
+            else:
+                import query as q
+
+                condition, params = q.months_filter(**selection_args) if view == "months" else q.days_filter(**selection_args)
+                report = ex.export_selection(condition, params, fmt, os.path.join(ex.EXPORT_DIR, key), con=q.get_connection(df=df))
+            # Bericht im Session State, damit die Downloads auch nach dem Rerun eines Klicks bleiben
+            st.session_state[f"export_report_{key}"] = report
+
+        report = st.session_state.get(f"export_report_{key}")
+        if report:
+            st.dataframe(pd.DataFrame(report)[["path", "rows", "bytes", "seconds", "rows_per_second", "mb_per_second"]],
+                         hide_index=True)
+            st.caption(f"Dateien gespeichert in {os.path.dirname(report[0]['path'])}")
+            for entry in report:
+                name = os.path.basename(entry["path"])
+                if not os.path.exists(entry["path"]):
+                    # inzwischen durch einen neueren Export der gleichen Auswahl ersetzt
+                    continue
+                if entry["bytes"] > DOWNLOAD_MAX_BYTES:
+                    st.caption(f"{name}: {entry['bytes'] / 1024 ** 2:.0f} MB, zu groß zum Herunterladen "
+                               f"(höchstens {DOWNLOAD_MAX_BYTES / 1024 ** 2:.0f} MB), nur lokal verfügbar")
+                    continue
+                with open(entry["path"], "rb") as file:
+                    st.download_button(f"{name} herunterladen", file, file_name=name, key=f"download_{key}_{name}")
 
 
 # Zeitreihenanalyse mit Plotly und Prophet
@@ -123,12 +615,18 @@ if "fig_forecast" not in st.session_state:
     st.session_state.fig_forecast = False
 if "fig_components" not in st.session_state:
     st.session_state.fig_components = False
+# Session State für die Prognosen nach Stadtviertel / Station (Batch-Prognosen aus forecasting.py)
+if "forecast_view" not in st.session_state:
+    st.session_state.forecast_view = False
 
 # Session States für geographische Auswertung initialisieren
 if "geo_days" not in st.session_state:
     st.session_state.geo_days = False
 if "geo_months" not in st.session_state:
     st.session_state.geo_months = False
+# Session State für den Wochenverlauf der Stadtviertel (Choroplethenkarte mit Zeitregler)
+if "district_view" not in st.session_state:
+    st.session_state.district_view = False
 # if "geo_years" not in st.session_state:
 #     st.session_state.years = False
 # Session State für die Karte initialisieren
@@ -157,6 +655,8 @@ def reset_views():
     # st.session_state.geo_years = False
     st.session_state.geo_months = False
     st.session_state.geo_days = False
+    st.session_state.district_view = False
+    st.session_state.forecast_view = False
     st.session_state.show_map = False
     st.session_state.map_config_months["show_stations"] = False
     st.session_state.map_config_months["show_heatmap"] = False
@@ -174,21 +674,38 @@ st.header(f":blue[MVG-Mieträder] :bike: :blue[in München {start_year} - {end_y
 st.sidebar.header(""); st.sidebar.header("")
 st.sidebar.header("Zeitreihenanalyse")
 
+# Auflösung der Prophet-Vorhersage: täglich oder stündlich (mit Tages- und Wochensaisonalität)
+resolution = st.sidebar.radio("Auflösung der Vorhersage", ["täglich", "stündlich"], horizontal=True)
+
 if st.sidebar.button("Zeitreihenanalyse starten", type="primary"):
-    # Extrahieren von Date / Hour
-    st.session_state.time = df.copy()
-    st.session_state.time['DATE'] = st.session_state.time['STARTTIME'].dt.date  # Datum extrahieren
-    st.session_state.time['HOUR'] = st.session_state.time['STARTTIME'].dt.hour  # Stunde extrahieren
+    import plotly.express as px
+    from prophet import Prophet
+    from prophet.plot import plot_plotly, plot_components_plotly
+
+    if resolution == "stündlich":
+        import forecasting as fc
+
+        # vorberechnetes Modell mit Prognose (python forecasting.py --hourly), None wenn keines für diese Daten vorliegt
+        hourly_stored = load_hourly_forecast(data_version, service_info["hourly_forecast"] if QUERY_SERVICE else fc.hourly_stamp())
+
+    if QUERY_SERVICE:
+        # tägliche und (nur ohne vorberechnete Prognose) stündliche Reihe in einer Anfrage an den Abfragedienst
+        fit_inline = resolution == "stündlich" and hourly_stored is None
+        daily_counts, *hourly_counts = service.batch([("daily_counts", {})] + ([("hourly_series", {})] if fit_inline else []))
+    else:
+        # Datum / Stunde aus den vorberechneten Kalenderspalten (START_YEAR, START_DOY, START_HOUR), keine Kopie von df
+        st.session_state.time = df
 
-    # Anzahl der Fahrten pro Tag
-    daily_counts = st.session_state.time.groupby('DATE').size().reset_index(name='DAILY_COUNTS')
+        # Anzahl der Fahrten pro Tag: Gruppierung nach Integer-Schlüsseln, nur die Tage selbst werden in Datumswerte umgewandelt
+        daily_counts = st.session_state.time.groupby(['START_YEAR', 'START_DOY']).size().reset_index(name='DAILY_COUNTS')
+        daily_counts['DATE'] = dp.calendar_dates(daily_counts['START_YEAR'], daily_counts['START_DOY'])
 
     # Linienplot der täglichen Anzahl der Fahrten
     st.session_state.fig_daily = px.line(
         daily_counts,
         x='DATE',
         y='DAILY_COUNTS',
-        title='Tägliche Anzahl der Fahrten (2020-2023)',
+        title=f'Tägliche Anzahl der Fahrten ({start_year}-{end_year})',
         labels={'DAILY_COUNTS': 'Fahrten', 'DATE': 'Datum'},
         template="plotly_white"
     )
@@ -196,7 +713,7 @@ if st.sidebar.button("Zeitreihenanalyse starten", type="primary"):
     # Titel in die Mitte setzen
     st.session_state.fig_daily.update_layout(
         title={
-            'text': "Tägliche Anzahl der Fahrten (2020-2023)",
+            'text': f"Tägliche Anzahl der Fahrten ({start_year}-{end_year})",
             'y': 0.9,  # Y-Position des Titels
             'x': 0.5,  # X-Position des Titels
             'xanchor': 'center',
@@ -205,14 +722,22 @@ if st.sidebar.button("Zeitreihenanalyse starten", type="primary"):
         }
     )
 
-    # Prophet-Modell initialisieren
-    prophet_data = daily_counts.rename(columns={'DATE': 'ds', 'DAILY_COUNTS': 'y'})
-    model = Prophet(growth='linear', seasonality_mode='additive', interval_width=0.90)
-    model.fit(prophet_data)
+    if resolution == "stündlich" and hourly_stored is not None:
+        model, forecast = hourly_stored
+    elif resolution == "stündlich":
+        # ohne vorberechnete Prognose: stündliche Reihe aus den Kalenderspalten, Parameter aus der Hyperparametersuche
+        # (python forecasting.py --hourly --tune)
+        hourly_counts = hourly_counts[0] if QUERY_SERVICE else fc.build_hourly_series(st.session_state.time)
+        model, forecast = fc.fit_hourly(hourly_counts, periods=24 * 14, **fc.best_hourly_params())
+    else:
+        # Prophet-Modell initialisieren
+        prophet_data = daily_counts.rename(columns={'DATE': 'ds', 'DAILY_COUNTS': 'y'})
+        model = Prophet(growth='linear', seasonality_mode='additive', interval_width=0.90)
+        model.fit(prophet_data)
 
-    # Zukunftsdaten erstellen und Vorhersage
-    future = model.make_future_dataframe(periods=365, freq='D', include_history=True)
-    forecast = model.predict(future)
+        # Zukunftsdaten erstellen und Vorhersage
+        future = model.make_future_dataframe(periods=365, freq='D', include_history=True)
+        forecast = model.predict(future)
 
     # Prophet-Visualisierung
     st.session_state.fig_forecast = plot_plotly(model, forecast)
@@ -236,6 +761,10 @@ if st.sidebar.button("Prophet-Vorhersage"):
     st.plotly_chart(st.session_state.fig_components, use_container_width=True)
 
 
+if st.sidebar.button("Prognosen nach Viertel / Station"):
+    reset_views()
+    st.session_state.forecast_view = True
+
 
 
 
@@ -266,6 +795,11 @@ if st.sidebar.button("Detailansicht nach Tagen"):
     if "chosen_days" not in st.session_state:
         st.session_state.chosen_days = None
 
+if st.sidebar.button("Stadtviertel im Wochenverlauf"):
+    # Session States aktualisieren
+    reset_views()
+    st.session_state.district_view = True
+
 st.sidebar.header(""); st.sidebar.header(""); st.sidebar.header(""); st.sidebar.header("");
 
 if st.sidebar.button("Let it snow!", type="primary"):
@@ -282,6 +816,57 @@ if st.sidebar.button("Let it snow!", type="primary"):
 # tagsüber (Tagmodus): rgb(0, 104, 201), abends (Nachtmodus): rgb(96, 180, 255)
 
 
+# Wenn die Batch-Prognosen angezeigt werden sollen
+if st.session_state.forecast_view:
+    import forecasting as fc
+
+    if not (service_info["forecasts"] if QUERY_SERVICE else os.path.exists(fc.FORECAST_STORE)):
+        st.write("Noch keine Prognosen vorhanden. Bitte zuerst ausführen: python forecasting.py")
+    else:
+        kind_label = st.radio("Prognose für:", ["Stadtviertel", "Station"], horizontal=True)
+        kind = "district" if kind_label == "Stadtviertel" else "station"
+        key = st.selectbox(f"Wähle {'das Stadtviertel' if kind == 'district' else 'die Station'} aus:",
+                           service.call("forecast_keys", kind=kind) if QUERY_SERVICE else fc.list_forecasts(kind))
+
+        if key is not None:
+            import plotly.graph_objs as go
+
+            # nur die gewählte Reihe wird aus dem Prognosespeicher gelesen
+            forecast = service.call("forecast", kind=kind, key=key) if QUERY_SERVICE else fc.load_forecast(kind, key)
+            fig_forecast = go.Figure([
+                go.Scatter(x=forecast["ds"], y=forecast["yhat_upper"], line=dict(width=0), showlegend=False),
+                go.Scatter(x=forecast["ds"], y=forecast["yhat_lower"], line=dict(width=0), fill="tonexty",
+                           fillcolor="rgba(0, 104, 201, 0.2)", name="90%-Intervall"),
+                go.Scatter(x=forecast["ds"], y=forecast["yhat"], line=dict(color="rgb(0, 104, 201)"), name="Vorhersage"),
+            ])
+            fig_forecast.update_layout(title=f"Tägliche Fahrten: {key}", xaxis_title="Datum", yaxis_title="Fahrten",
+                                       template="plotly_white")
+            st.plotly_chart(fig_forecast, use_container_width=True)
+
+
+# Wenn der Wochenverlauf der Stadtviertel angezeigt werden soll
+if st.session_state.district_view:
+    import district_cube as dcube
+
+    district_cube = get_district_cube(data_version)
+
+    district_years = st.multiselect("Wähle die Jahre aus:", list(range(start_year, end_year + 1)),
+                                    default=list(range(start_year, end_year + 1)), key="district_years")
+    district_months = st.multiselect("Wähle die Monate aus:", list(range(1, 13)),
+                                     default=list(range(1, 13)), key="district_months")
+    measure_label = st.radio("Kennzahl:", list(dcube.MEASURES.values()), horizontal=True)
+    measure = [key for key, label in dcube.MEASURES.items() if label == measure_label][0]
+
+    if not district_years or not district_months:
+        st.write("Bitte wähle Jahre und Monate aus.")
+    else:
+        # Summe über die gewählten Monate, danach ist jeder Frame nur noch ein Ausschnitt des Arrays
+        district_mask = district_cube.select_months(district_years, district_months)
+        st.plotly_chart(build_district_figure(district_cube, district_mask, measure), use_container_width=True)
+        st.caption("Summe der Fahrten in den gewählten Monaten je Stunde der Woche. "
+                   "Nettofluss > 0: mehr Fahrten enden im Stadtviertel als dort beginnen.")
+
+
 # Wenn Monate ausgewertet werden sollen
 if st.session_state.geo_months:
     # Auswahl der Jahre und Monate
@@ -309,145 +894,98 @@ if st.session_state.geo_months:
             valid_month = True
 
         if valid_month:
-            # Speichern des DataFrames im Session State
-            df_list = []
-            for year in year_input:
-                df_temp = df[((df["STARTTIME"].dt.year == year) | (df["ENDTIME"].dt.year == year))].copy()
-                df_list.append(df_temp)
-            df_years_temp = pd.concat(df_list)
-            df_list = []
-            for month in month_input:
-                df_temp = df_years_temp[((df_years_temp["STARTTIME"].dt.month == month) | (df_years_temp["ENDTIME"].dt.month == month))].copy()
-                df_list.append(df_temp)
-            st.session_state.chosen_months = pd.concat(df_list)
+            # Speichern der Auswahl im Session State; die exakte Abfrage läuft im Hintergrund,
+            # bis sie fertig ist, wird das Ergebnis aus der Stichprobe angezeigt (siehe unten).
+            # Nur eine neue Auswahl startet eine neue Abfrage (nicht die Wiederholungen während sie läuft)
+            query_key = config_key(data=data_version, years=sorted(year_input), months=sorted(month_input))
+            if st.session_state.get("months_query_key") != query_key:
+                st.session_state.months_query_key = query_key
+                st.session_state.chosen_months = None
+                st.session_state.sample_months = None
+                st.session_state.months_selection = {"years": year_input, "months": month_input}
+                st.session_state.months_query = get_query_pool().submit(select_months, st.session_state.months_selection)
             
             # Speichern der Checkbox-Werte im Session State
             st.session_state.map_config_months["show_stations"] = show_stations
             st.session_state.map_config_months["show_heatmap"] = show_heatmap
             st.session_state.map_config_months["show_city_districts"] = show_city_districts
             st.session_state.map_config_months["show_city_area"] = show_city_area
+
+            # Schlüssel für den Karten-Cache: gleiche Auswahl und Konfiguration => gleiche Karte
+            st.session_state.map_key_months = config_key(view="months", data=data_version, years=sorted(year_input), months=sorted(month_input),
+                                                         **st.session_state.map_config_months)
             
             st.session_state.show_map = True
 
     # Zeige die Karte nur, wenn "show_map" True ist
-    if st.session_state.show_map and st.session_state.chosen_months is not None:
-
-        # Initialisieren der Karte
-        map_center = [48.137154, 11.576124] # Munich city centre
-        munich_map = folium.Map(location=map_center, zoom_start=11)
-
-        # benutzte Stationen ermitteln
-        stations = dp.get_station_data(st.session_state.chosen_months)
-
-        # Nutzungshäufigkeit der Stationen ermitteln
-        frequency_start = st.session_state.chosen_months["RENTAL_STATION_NAME"].value_counts()
-        frequency_end = st.session_state.chosen_months["RETURN_STATION_NAME"].value_counts()
-
-        # Heatmap
-        if st.session_state.map_config_months["show_heatmap"]:
-            # heat-Daten für Stationen:
-            # (geht schneller, umfasst aber nur Stationen)
-            # heat_data = dp.get_heatmap_data(st.session_state.chosen_months, stations)
-
-            # heat-Daten für alle Punkte:
-            # (dauert länger, ist aber spannender, da auch mit freien Rückgaben)
-            heat_data_start = list(zip(st.session_state.chosen_months["STARTLAT"], st.session_state.chosen_months["STARTLON"]))
-            heat_data_end = list(zip(st.session_state.chosen_months["STARTLAT"], st.session_state.chosen_months["STARTLON"]))
-            heat_data = heat_data_start + heat_data_end
-
-            heat_map = HeatMap(heat_data, min_opacity=0.2, radius=25, blur=18)
-            heat_map.add_to(munich_map)
-
-        # Hinzufügen der Stationen
-        if st.session_state.map_config_months["show_stations"]:
-            # Prüfen, ob Ausleih- und Rückgabewerte für jede Station vorhanden, ansonsten 0 einsetzen (kein Wert vorhanden => Wert = 0)
-            for station, coordinates in stations.items():
-                if station not in frequency_start.index.values:
-                    frequency_start[station] = 0
-                if station not in frequency_end.index.values:
-                    frequency_end[station] = 0
-
-                # Hinzufügen zur Karte    
-                folium.Marker(location=coordinates,
-                              icon=folium.Icon(color="darkblue",
-                                     icon="bicycle",
-                                     prefix="fa"),
-                               tooltip=f"{station}: insgesamt {frequency_start[station] + frequency_end[station]}\
-                                <br>(Ausleihe: {frequency_start[station]}, Rückgabe: {frequency_end[station]})"
-                                    ).add_to(munich_map)
-            
-        # Füge die Stadtviertel als GeoJSON auf der Karte hinzu
-        if st.session_state.map_config_months["show_city_districts"]:
-            folium.GeoJson(
-                city_districts,
-                name="Stadtviertel",
-                style_function=lambda feature: {
-                    "fillColor": "lightblue",  # Füllfarbe der Stadtviertel
-                    "color": "blue",
-                    "weight": 3,
-                    "opacity": 0.3,
-                    "fillOpacity": 0.2
-                }
-            ).add_to(munich_map)
-
-            # Füge den Stadtbereich als GeoJSON auf der Karte hinzu
-        if st.session_state.map_config_months["show_city_area"]:
-            folium.GeoJson(
-                city_area,
-                name="Stadtbereich",
-                style_function=lambda feature: {
-                    "fillColor": "lightgreen",  # Füllfarbe des Stadtbereichs
-                    "color": "green",
-                    "weight": 2,
-                    "opacity": 0.6,
-                    "fillOpacity": 0.25
-                }
-            ).add_to(munich_map)
-        
-        # Anzeigen der Karte
-        st_folium(munich_map, width=700)
-
-        # Weitere Infos
-        # Berechnungen
-        # Durchschnittliche Dauer
-        avg_length = st.session_state.chosen_months["DURATION"].median().seconds // 60
-        if avg_length > 60:
-            avg_length_str = f"{avg_length // 60} Stunden, {avg_length%60} Minuten"
-        else:
-            avg_length_str = f"{avg_length} Minuten"
-
-        # Ausleihen an Stationen im Stadtgebiet:
-        rental_station_city_number = st.session_state.chosen_months[((st.session_state.chosen_months["RENTAL_IS_STATION"] == 1)\
-                                            & (st.session_state.chosen_months["RENTAL_IS_CITY"] == 1))].shape[0]
-        # Ausleihen an Stationen außerhalb des Stadtgebiets:
-        rental_station_not_city_number = st.session_state.chosen_months[((st.session_state.chosen_months["RENTAL_IS_STATION"] == 1)\
-                                            & (st.session_state.chosen_months["RENTAL_IS_CITY"] == 0))].shape[0]
-        # Rückgaben an Stationen im Stadtgebiet:
-        return_station_city_number = st.session_state.chosen_months[((st.session_state.chosen_months["RETURN_IS_STATION"] == 1)\
-                                            & (st.session_state.chosen_months["RETURN_IS_CITY"] == 1))].shape[0]
-        # Rückgaben an Stationen außerhalb des Stadtgebiets:
-        return_station_not_city_number = st.session_state.chosen_months[((st.session_state.chosen_months["RENTAL_IS_STATION"] == 1)\
-                                            & (st.session_state.chosen_months["RETURN_IS_CITY"] == 0))].shape[0]
-
-        # Textausgabe
-        col1, col2 = st.columns(2)
-        with col1:
-            st.write(f"Anzahl Fahrten:")
-            st.write(f"Mittlere Fahrtenlänge:")
-            # st.write(f"Mittlere Entfernung (Luftlinie):")
-            st.write(f"Beliebtestes Startviertel:")
-            st.write(f"Beliebtestes Zielviertel:")
-            st.write(f"Stationsausleihen in-/außerhalb des Stadtgebiets:")
-            st.write(f"Stationsrückgaben in-/außerhalb des Stadtgebiets:")
-        with col2:
-            st.write(f"{st.session_state.chosen_months.shape[0]}")
-            st.write(f"{avg_length_str}")
-            # st.write(f"{st.session_state.chosen_months["DISTANCE"].median():.1f} Kilometer")
-            st.write(f"{st.session_state.chosen_months["CITY_DISTRICT_START"].mode()[0]}")
-            st.write(f"{st.session_state.chosen_months["CITY_DISTRICT_END"].mode()[0]}")
-            
-            st.write(f"{rental_station_city_number} / {rental_station_not_city_number}")
-            st.write(f"{return_station_city_number} / {return_station_not_city_number}")
+    if st.session_state.show_map and "months_selection" in st.session_state:
+        # Platzhalter: zuerst Karte und Kennzahlen aus der Stichprobe, danach an gleicher Stelle das exakte Ergebnis
+        map_placeholder = st.empty()
+        stats_placeholder = st.empty()
+
+        if st.session_state.chosen_months is None:
+            months_query = st.session_state.months_query
+            waiting = False
+            cached_map = get_map_cache().get(st.session_state.map_key_months) if st.session_state.map_key_months in get_map_cache() else None
+            if cached_map is not None:
+                # exakte Karte liegt schon im Cache: sofort anzeigen, nur die Kennzahlen warten auf die Abfrage
+                with map_placeholder:
+                    components.html(cached_map, width=700, height=500)
+            elif sample_available and not months_query.done():
+                # Stichprobe, solange die exakte Abfrage läuft (Karte und Kennzahlen einmal je Auswahl berechnet)
+                import sampling as smp
+
+                if st.session_state.sample_months is None:
+                    st.session_state.sample_months = select_months(st.session_state.months_selection, table="trips_sample")
+                    st.session_state.sample_months_stats = sample_month_stats(st.session_state.sample_months)
+                sample_key = config_key(sample=True, key=st.session_state.map_key_months)
+                sample_html = get_map_cache().get_or_build(sample_key,
+                                                           lambda: build_month_map(st.session_state.sample_months, st.session_state.map_config_months))
+                with map_placeholder:
+                    components.html(sample_html, width=700, height=500)
+                with stats_placeholder.container():
+                    st.caption(f"Vorläufiges Ergebnis aus einer Stichprobe ({smp.SAMPLE_FRACTION:.0%} je Tag und Station), "
+                               "95%-Konfidenzintervall in Klammern. Das exakte Ergebnis wird berechnet …")
+                    write_stats(st.session_state.sample_months_stats)
+
+                # Die Sitzung bleibt bedienbar: das Skript wartet höchstens QUERY_POLL_SECONDS auf die Abfrage
+                # (Eingaben werden erst danach verarbeitet) und wird dann neu ausgeführt. Ein Rerun führt das ganze
+                # Skript aus und sendet Widgets, Stichprobenkarte (HTML aus dem Cache) und Kennzahlen erneut an
+                # den Browser, deshalb nicht öfter. Ohne automatische Aktualisierung lädt die Schaltfläche neu.
+                if st.checkbox("Automatisch aktualisieren, bis das exakte Ergebnis vorliegt", value=True, key="auto_refresh_months"):
+                    wait([months_query], timeout=QUERY_POLL_SECONDS)
+                    if not months_query.done():
+                        st.rerun()
+                else:
+                    st.button("Exaktes Ergebnis anzeigen", key="refresh_months")
+                    waiting = not months_query.done()
+
+            # exaktes Ergebnis der Hintergrundabfrage (ohne Stichprobe wird hier auf sie gewartet)
+            if not waiting:
+                st.session_state.chosen_months = months_query.result()
+
+        if st.session_state.chosen_months is not None:
+            # Karte aus dem Cache laden oder neu erstellen (Schlüssel: Auswahl + Kartenkonfiguration)
+            map_html = get_map_cache().get_or_build(st.session_state.map_key_months,
+                                                    lambda: build_month_map(st.session_state.chosen_months, st.session_state.map_config_months))
+
+            # Anzeigen der Karte
+            with map_placeholder:
+                components.html(map_html, width=700, height=500)
+
+            # Weitere Infos
+            # Berechnungen
+            # Durchschnittliche Dauer
+            # Median, 90%- und 99%-Perzentil aus den vorberechneten Dauer-Sketches der Fahrten, die in den gewählten
+            # Monaten beginnen oder enden (wie die Auswahl, Fehler <= 1 %)
+            duration_cube = get_duration_cube(data_version)
+            duration_quantiles = duration_cube.quantiles(duration_cube.select_days(**st.session_state.months_selection))
+
+            # Textausgabe
+            with stats_placeholder.container():
+                write_stats(selection_stats(st.session_state.chosen_months, duration_quantiles))
+
+            export_panel("months", st.session_state.months_selection)
 
 
 
@@ -457,15 +995,15 @@ if st.session_state.geo_months:
 if st.session_state.geo_days:
     # Auswahl des Startdatums
     day_input_start = st.date_input("Wähle ein Startdatum:",
-                        value=date(2023,12,31),
-                        min_value=date(2020, 1, 1),
-                        max_value=date(2023, 12, 31))
+                        value=date(end_year, 12, 31),
+                        min_value=date(start_year, 1, 1),
+                        max_value=date(end_year, 12, 31))
 
     # Auswahl des Enddatums
     day_input_end = st.date_input("Wähle ein Enddatum:",
-                        value=date(2023,12,31),
-                        min_value=date(2020, 1, 1),
-                        max_value=date(2023, 12, 31))
+                        value=date(end_year, 12, 31),
+                        min_value=date(start_year, 1, 1),
+                        max_value=date(end_year, 12, 31))
     
     # Prüfen der Daten auf Gültigkeit
     if day_input_end < day_input_start:
@@ -499,10 +1037,8 @@ if st.session_state.geo_days:
 
         if st.button("Hier klicken für Auswertung und Aktualisierung der Karte", key="map_days"):
             # Speichern des DataFrames im Session State
-            st.session_state.chosen_days = df[(((df["STARTTIME"].dt.date >= day_input_start) & (df["STARTTIME"].dt.date <= day_input_end))\
-                            | ((df["ENDTIME"].dt.date >= day_input_start) & (df["ENDTIME"].dt.date <= day_input_end)))\
-                            & (((df["STARTTIME"].dt.time >= daytime_input[0]) & (df["STARTTIME"].dt.time <= daytime_input[1]))
-                            | ((df["ENDTIME"].dt.time >= daytime_input[0]) & (df["ENDTIME"].dt.time <= daytime_input[1])))].dropna().copy()
+            st.session_state.chosen_days = select_days(day_input_start, day_input_end, daytime_input).dropna()
+            st.session_state.days_selection = (day_input_start, day_input_end, daytime_input)
             
             # Speichern der Checkbox-Werte im Session State
             st.session_state.map_config_days["show_startpoints"] = show_startpoints
@@ -510,112 +1046,38 @@ if st.session_state.geo_days:
             st.session_state.map_config_days["show_lines"] = show_lines
             st.session_state.map_config_days["show_city_districts"] = show_city_districts
             st.session_state.map_config_days["show_city_area"] = show_city_area
+
+            # Schlüssel für den Karten-Cache: gleiche Auswahl und Konfiguration => gleiche Karte
+            st.session_state.map_key_days = config_key(view="days", data=data_version, start=day_input_start, end=day_input_end,
+                                                       daytime=daytime_input, **st.session_state.map_config_days)
             
             st.session_state.show_map = True
         
         # Zeige die Karte nur, wenn "show_map" True ist
         if st.session_state.show_map and st.session_state.chosen_days is not None:
 
-            # Initialisieren der Karte
-            map_center = [48.137154, 11.576124] # Munich city centre
-            munich_map = folium.Map(location=map_center, zoom_start=12)
-            
-            for index, row in st.session_state.chosen_days.iterrows():
-                start_coordinates = [row["STARTLAT"], row["STARTLON"]]
-                end_coordinates = [row["ENDLAT"], row["ENDLON"]]
-
-                # Hinzufügen der Startpunkte
-                if st.session_state.map_config_days["show_startpoints"]:
-                    folium.Circle(location=start_coordinates,
-                                        color="purple",
-                                        fill=True,
-                                        fill_color="purple",
-                                        fill_opacity=0.5
-                                        ).add_to(munich_map)
-                
-                # Hinzufügen der Endpunkte
-                if st.session_state.map_config_days["show_endpoints"]: 
-                        folium.Circle(location=end_coordinates,
-                                            radius=20,
-                                            color="green",
-                                            fill=True,
-                                            fill_color="green",
-                                            fill_opacity=0.5
-                                            ).add_to(munich_map)
-                
-                # Hinzufügen einer Linie zwischen Start- und Rückgabeort
-                if st.session_state.map_config_days["show_lines"]:
-                        folium.PolyLine(locations=[start_coordinates, end_coordinates],
-                                        color="grey",
-                                        weight=2.5,
-                                        opacity=0.3).add_to(munich_map)
-                
-            # Füge die Stadtviertel als GeoJSON auf der Karte hinzu
-            if st.session_state.map_config_days["show_city_districts"]:
-                folium.GeoJson(
-                    city_districts,
-                    name="Stadtviertel",
-                    style_function=lambda feature: {
-                        "fillColor": "lightblue",  # Füllfarbe der Stadtviertel
-                        "color": "blue",
-                        "weight": 3,
-                        "opacity": 0.3,
-                        "fillOpacity": 0.2
-                    }
-                ).add_to(munich_map)
-
-                # Füge den Stadtbereich als GeoJSON auf der Karte hinzu
-            if st.session_state.map_config_days["show_city_area"]:
-                folium.GeoJson(
-                    city_area,
-                    name="Stadtbereich",
-                    style_function=lambda feature: {
-                        "fillColor": "lightgreen",  # Füllfarbe des Stadtbereichs
-                        "color": "green",
-                        "weight": 2,
-                        "opacity": 0.6,
-                        "fillOpacity": 0.25
-                    }
-                ).add_to(munich_map)
-            
+            # Karte aus dem Cache laden oder neu erstellen (Schlüssel: Auswahl + Kartenkonfiguration)
+            map_html = get_map_cache().get_or_build(st.session_state.map_key_days,
+                                                    lambda: build_day_map(st.session_state.chosen_days, st.session_state.map_config_days))
+
             # Anzeigen der Karte
-            st_folium(munich_map, width=700)
+            components.html(map_html, width=700, height=500)
 
             # Berechnung weiterer Informationen
             # Durchschnittliche Dauer
-            avg_length = st.session_state.chosen_days["DURATION"].median().seconds // 60
-            if avg_length > 60:
-                avg_length_str = f"{avg_length // 60} Stunden, {avg_length%60} Minuten"
+            # Median, 90%- und 99%-Perzentil: ganze Tage aus den Dauer-Sketches der Fahrten, die an den gewählten
+            # Tagen beginnen oder enden (wie die Auswahl, Fehler <= 1 %),
+            # bei eingeschränkter Tageszeit exakt aus der (höchstens 7 Tage umfassenden) Auswahl
+            day_start, day_end, daytime = st.session_state.days_selection
+            if daytime == (time(0), time(23, 59, 59)):
+                duration_cube = get_duration_cube(data_version)
+                duration_quantiles = duration_cube.quantiles(duration_cube.select_days(start=day_start, end=day_end))
+            elif st.session_state.chosen_days.empty:
+                duration_quantiles = [None, None, None]
             else:
-                avg_length_str = f"{avg_length} Minuten"
-            # Ausleihen an Stationen im Stadtgebiet:
-            rental_station_city_number = st.session_state.chosen_days[((st.session_state.chosen_days["RENTAL_IS_STATION"] == 1)\
-                                             & (st.session_state.chosen_days["RENTAL_IS_CITY"] == 1))].shape[0]
-            # Ausleihen an Stationen außerhalb des Stadtgebiets:
-            rental_station_not_city_number = st.session_state.chosen_days[((st.session_state.chosen_days["RENTAL_IS_STATION"] == 1)\
-                                             & (st.session_state.chosen_days["RENTAL_IS_CITY"] == 0))].shape[0]
-            # Rückgaben an Stationen im Stadtgebiet:
-            return_station_city_number = st.session_state.chosen_days[((st.session_state.chosen_days["RETURN_IS_STATION"] == 1)\
-                                             & (st.session_state.chosen_days["RETURN_IS_CITY"] == 1))].shape[0]
-            # Rückgaben an Stationen außerhalb des Stadtgebiets:
-            return_station_not_city_number = st.session_state.chosen_days[((st.session_state.chosen_days["RENTAL_IS_STATION"] == 1)\
-                                             & (st.session_state.chosen_days["RETURN_IS_CITY"] == 0))].shape[0]
+                duration_quantiles = np.quantile(dstat.duration_seconds(st.session_state.chosen_days), (0.5, 0.9, 0.99), method="lower")
+
             # Output
-            col1, col2 = st.columns(2)
-            with col1:
-                st.write(f"Anzahl Fahrten:")
-                st.write(f"Mittlere Fahrtenlänge:")
-                # st.write(f"Mittlere Entfernung (Luftlinie):")
-                st.write(f"Beliebtestes Startviertel:")
-                st.write(f"Beliebtestes Zielviertel:")
-                st.write(f"Stationsausleihen in-/außerhalb des Stadtgebiets:")
-                st.write(f"Stationsrückgaben in-/außerhalb des Stadtgebiets:")
-            with col2:
-                st.write(f"{st.session_state.chosen_days.shape[0]}")
-                st.write(f"{avg_length_str}")
-                # st.write(f"{st.session_state.chosen_days["DISTANCE"].median():.1f} Kilometer")
-                st.write(f"{st.session_state.chosen_days["CITY_DISTRICT_START"].mode()[0]}")
-                st.write(f"{st.session_state.chosen_days["CITY_DISTRICT_END"].mode()[0]}")
-                
-                st.write(f"{rental_station_city_number} / {rental_station_not_city_number}")
-                st.write(f"{return_station_city_number} / {return_station_not_city_number}")
+            write_stats(selection_stats(st.session_state.chosen_days, duration_quantiles))
+
+            export_panel("days", st.session_state.days_selection)
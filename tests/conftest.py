@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Die Module der App liegen im Wurzelverzeichnis des Repositorys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,86 @@
+"""Tests of the duration sketches: quantiles of DurationCube against np.quantile on synthetic durations."""
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import data_preprocessing as dp
+import duration_stats as dstat
+import query as q
+
+QS = (0, 0.1, 0.5, 0.9, 0.99, 1)
+
+
+@pytest.fixture(scope="module")
+def trips():
+    """Synthetic trips around the turn of the year: minutes, zero and multi-day durations."""
+    rng = np.random.default_rng(0)
+    n = 20_000
+    seconds = np.round(rng.lognormal(np.log(900), 0.8, n))
+    seconds[rng.random(n) < 0.05] = 0
+    long = rng.random(n) < 0.03
+    seconds[long] = rng.uniform(1, 5, long.sum()) * 24 * 3600
+    starts = pd.Timestamp("2022-12-01") + pd.to_timedelta(rng.integers(0, 90 * 24 * 3600, n), unit="s")
+    df = pd.DataFrame({"STARTTIME": starts, "DURATION": pd.to_timedelta(seconds, unit="s"),
+                       "CITY_DISTRICT_START": rng.choice(["Altstadt-Lehel", "Maxvorstadt", "Schwabing-West"], n),
+                       "RENTAL_IS_STATION": rng.random(n) < 0.5, "RETURN_IS_STATION": rng.random(n) < 0.5})
+    df["ENDTIME"] = df["STARTTIME"] + df["DURATION"]
+    cwd = os.getcwd()
+    # die Feiertage werden relativ zum Arbeitsverzeichnis gelesen
+    os.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        return dp.add_calendar_features(df)
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope="module")
+def cube(trips):
+    return dstat.DurationCube(dstat.build_sketches(trips))
+
+
+@pytest.fixture(scope="module")
+def connection(trips, tmp_path_factory):
+    return q.connect(str(tmp_path_factory.mktemp("no_store")), trips)
+
+
+def assert_within_bound(approximate, durations):
+    exact = np.quantile(durations, QS, method="lower")
+    for value, expected in zip(approximate, exact):
+        if expected == 0:
+            assert value == 0
+        else:
+            assert abs(value - expected) <= dstat.ALPHA * expected * (1 + 1e-9)
+
+
+@pytest.mark.parametrize("selection", [{"years": [2023], "months": [1]}, {"years": [2023], "months": [12]},
+                                       {"years": [2022, 2023], "months": [1, 2]}])
+def test_month_quantiles_match_selection(cube, connection, selection):
+    # gleiche Fahrten wie die Monatsauswahl (Start oder Ende im Monat, auch über den Jahreswechsel)
+    durations = dstat.duration_seconds(q.select_months(**selection, columns=["DURATION"], con=connection))
+    assert len(durations) > 0
+    assert_within_bound(cube.quantiles(cube.select_days(**selection), QS), durations)
+
+
+@pytest.mark.parametrize("start, end", [(date(2022, 12, 31), date(2022, 12, 31)), (date(2023, 1, 2), date(2023, 1, 8)),
+                                        (date(2022, 12, 1), date(2023, 3, 31))])
+def test_day_quantiles_match_selection(cube, connection, start, end):
+    durations = dstat.duration_seconds(q.select_days(start, end, columns=["DURATION"], con=connection))
+    assert len(durations) > 0
+    assert_within_bound(cube.quantiles(cube.select_days(start=start, end=end), QS), durations)
+
+
+def test_zero_and_multi_day_durations():
+    seconds = np.array([0, 0, 0, 59, 3 * 24 * 3600 + 17])
+    index = dstat.bucket_index(seconds)
+    assert list(index[:3]) == [dstat.ZERO_BUCKET] * 3
+    assert (index[3:] < dstat.N_BUCKETS).all()
+    values = dstat.bucket_value(index)
+    assert list(values[:3]) == [0, 0, 0]
+    assert np.all(np.abs(values[3:] - seconds[3:]) <= dstat.ALPHA * seconds[3:])
+
+
+def test_empty_selection(cube):
+    assert cube.quantiles(cube.select_days(years=[2030])) == [None, None, None]
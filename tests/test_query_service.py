@@ -0,0 +1,143 @@
+"""Tests of the query service: a server from serve_in_background on a small synthetic data store."""
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import ingestion as ing
+import load_test as lt
+import query_service as qs
+
+
+def _make_store(directory) -> str:
+    lt.make_dataset(str(directory), years=(2023,), trips_per_year=2000, n_stations=10)
+    return os.path.join(str(directory), ing.STORE_DIR)
+
+
+@pytest.fixture(scope="module")
+def service(tmp_path_factory):
+    server = qs.serve_in_background(qs.QueryBackend(_make_store(tmp_path_factory.mktemp("store"))), workers=4)
+    client = qs.QueryClient(server.url)
+    yield server, client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    """Counts the executions of select_months in the service."""
+    calls = []
+    function, cacheable = qs.OPERATIONS["select_months"]
+
+    def counting(backend, **args):
+        calls.append(args)
+        return function(backend, **args)
+
+    monkeypatch.setitem(qs.OPERATIONS, "select_months", (counting, cacheable))
+    return calls
+
+
+def test_batch_returns_results_in_request_order(service):
+    _, client = service
+    june, info, counts, july = client.batch([("select_months", {"years": [2023], "months": [6]}), ("info", {}),
+                                             ("daily_counts", {}), ("select_months", {"years": [2023], "months": [7]})])
+    assert isinstance(june, pd.DataFrame) and isinstance(july, pd.DataFrame)
+    assert set(june["START_MONTH"]) == {6} and set(july["START_MONTH"]) == {7}
+    assert info["years"] == [2023]
+    assert counts["DAILY_COUNTS"].sum() >= len(june) + len(july)
+
+
+def test_batch_runs_equal_requests_once(service, counted):
+    _, client = service
+    # gleiche Argumente in anderer Schlüsselreihenfolge gelten als gleiche Anfrage
+    results = client.batch([("select_months", {"years": [2023], "months": [1]}),
+                            ("select_months", {"months": [1], "years": [2023]}),
+                            ("select_months", {"years": [2023], "months": [2]})])
+    assert len(counted) == 2
+    pd.testing.assert_frame_equal(results[0], results[1])
+    assert set(results[2]["START_MONTH"]) == {2}
+
+
+def test_responses_are_cached(service, counted):
+    server, client = service
+    first = client.call("select_months", years=[2023], months=[3])
+    hits = server.cache.stats()["hits"]
+    second = client.call("select_months", years=[2023], months=[3])
+    assert len(counted) == 1
+    assert server.cache.stats()["hits"] == hits + 1
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_unknown_operation_raises(service):
+    _, client = service
+    with pytest.raises(qs.QueryServiceError, match="Unbekannte Operation"):
+        client.call("drop_table")
+
+
+def test_client_replaces_connection_closed_by_service(service, monkeypatch):
+    server, _ = service
+    # nur neue Verbindungen des Dienstes übernehmen die kurze Wartezeit
+    monkeypatch.setattr(qs.QueryHandler, "timeout", 0.2)
+    client = qs.QueryClient(server.url)
+    try:
+        client.health()
+        time.sleep(0.6)
+        assert client.health()["status"] == "ok"
+        assert client.connections == 2
+        assert client.requests == 2
+    finally:
+        client.close()
+
+
+def test_client_retries_only_once(service, monkeypatch):
+    server, _ = service
+    client = qs.QueryClient(server.url)
+    attempts = []
+
+    class ClosedConnection:
+        def request(self, *args, **kwargs):
+            attempts.append(args)
+            raise ConnectionResetError("Verbindung geschlossen")
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(client, "_acquire", ClosedConnection)
+    with pytest.raises(ConnectionResetError):
+        client.health()
+    assert len(attempts) == 2
+
+
+def test_new_data_version_uses_new_connection_and_cache_keys(tmp_path, monkeypatch, counted):
+    store = _make_store(tmp_path)
+    backend = qs.QueryBackend(store)
+    server = qs.serve_in_background(backend, workers=2)
+    client = qs.QueryClient(server.url)
+    try:
+        before = client.call("info")
+        assert before["years"] == [2023]
+        assert client.call("select_months", years=[2022], months=[6]).empty
+        old_connection = backend._connection
+
+        # ein weiteres Jahr nachladen (die Pipeline liest die geojson-Dateien relativ zum Arbeitsverzeichnis)
+        lt.write_trip_file(str(tmp_path / "MVG_Rad_Fahrten_2022.csv"), 2022, 2000,
+                           np.column_stack([np.full(10, 48.15), np.linspace(11.52, 11.63, 10)]),
+                           np.random.default_rng(1))
+        monkeypatch.chdir(tmp_path)
+        ing.ingest(".", ing.STORE_DIR)
+
+        after = client.call("info")
+        assert after["version"] != before["version"]
+        assert after["years"] == [2022, 2023]
+        # gleiche Anfrage, aber neue Datenversion: kein Ergebnis aus dem Cache
+        assert not client.call("select_months", years=[2022], months=[6]).empty
+        assert len(counted) == 2
+        assert backend._connection is not old_connection
+        assert old_connection not in backend._users
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()